@@ -7,12 +7,718 @@
 # File Desc: worker class definition                #
 #####################################################
 
+import io
+import os
 import sys
 import csv
+import bz2
+import gzip
 import json
+import mmap
+import heapq
+import locale
+import hashlib
+import logging
+import marshal
+import operator
+import collections
+import multiprocessing
 import datetime
+import tempfile
+import itertools
+import time
+import fatturazione_db
+import fatturazione_cache
+from array import array
 from calendar import monthrange
 
+# xz files are only supported from python 3
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+
+# Process cpu time in seconds, time.clock is gone from python 3.8
+def cpuTime():
+    if hasattr(time, 'process_time'):
+        return time.process_time()
+    return time.clock()
+
+
+# Types of file names, under python 2 a name can be a str or a unicode coming from the config file
+fileNameTypes = (str, type(u''))
+
+# Lazy map and zip, under python 2 the builtins return lists
+imap = getattr(itertools, 'imap', map)
+izip = getattr(itertools, 'izip', zip)
+
+
+# The csv module needs a binary handle under python 2 and a newline='' text handle under python 3,
+# both produce the same bytes on disk. With append the rows are added to the end of the file, compressed files
+# get a new stream
+def openCsvOutput(fileName, bufferSize=-1, append=False):
+    compression = fileCompression(fileName)
+    if compression is not None:
+        if append and compression == 'bz2' and sys.version_info[0] < 3:
+            return rewriteBz2File(fileName)
+        compressedFile = openCompressedFile(fileName, compression, 'ab' if append else 'wb')
+        if sys.version_info[0] < 3:
+            return compressedFile
+        return io.TextIOWrapper(io.BufferedWriter(compressedFile, max(bufferSize, io.DEFAULT_BUFFER_SIZE)),
+                                newline='')
+    if sys.version_info[0] < 3:
+        return open(fileName, 'ab' if append else 'wb', bufferSize)
+    return open(fileName, 'a' if append else 'w', bufferSize, newline='')
+
+
+# The python 2 bz2 module can neither append to a file nor read more than one stream, so the content of the file
+# is copied to a new one which is returned open for writing
+def rewriteBz2File(fileName):
+    previousFileName = fileName + '.tmp'
+    os.rename(fileName, previousFileName)
+    compressedFile = bz2.BZ2File(fileName, 'wb')
+    previousFile = bz2.BZ2File(previousFileName, 'rb')
+    try:
+        while True:
+            fileBlock = previousFile.read(1024 * 1024)
+            if not fileBlock:
+                break
+            compressedFile.write(fileBlock)
+    finally:
+        previousFile.close()
+    os.remove(previousFileName)
+    return compressedFile
+
+
+# Opens a CSV file for reading as open() does. Compressed files are decompressed while they are read, plain files
+# of at least mmapThreshold bytes are memory mapped (never if mmapThreshold is None)
+def openCsvInput(fileName, bufferSize=-1, mmapThreshold=None):
+    compression = fileCompression(fileName)
+    if compression is not None:
+        compressedFile = openCompressedFile(fileName, compression, 'rb')
+        if sys.version_info[0] < 3:
+            return compressedFile
+        return io.TextIOWrapper(io.BufferedReader(compressedFile, max(bufferSize, io.DEFAULT_BUFFER_SIZE)),
+                                encoding=locale.getpreferredencoding(False))
+    if mmapThreshold is not None:
+        fileSize = os.path.getsize(fileName)
+        if fileSize > 0 and fileSize >= mmapThreshold:
+            return MappedFile(fileName, max(bufferSize, io.DEFAULT_BUFFER_SIZE))
+    return open(fileName, 'r', bufferSize)
+
+
+# Compression of a file from its extension: 'gz', 'bz2', 'xz' or None
+def fileCompression(fileName):
+    lowerName = fileName.lower()
+    for compression in ('gz', 'bz2', 'xz'):
+        if lowerName.endswith('.' + compression):
+            return compression
+    return None
+
+
+# Opens a compressed file in binary mode
+def openCompressedFile(fileName, compression, mode):
+    if compression == 'gz':
+        # level 6 as the gzip command, level 9 is much slower for a few percent
+        return gzip.GzipFile(fileName, mode, 6)
+    if compression == 'bz2':
+        return bz2.BZ2File(fileName, mode)
+    if lzma is None:
+        raise IOError('xz files need python 3: {}'.format(fileName))
+    return lzma.LZMAFile(fileName, mode)
+
+
+# Memory mapped input file, iterated by line like a file opened by open(). The map is decoded in blocks of about
+# blockSize bytes cut at a newline, so lines are split by the io module instead of a python loop. When a
+# contentHash object is given, the blocks are added to it as they are read
+class MappedFile:
+
+    def __init__(self, fileName, blockSize, contentHash=None):
+        self.file = open(fileName, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.blockSize = blockSize
+        self.encoding = locale.getpreferredencoding(False)
+        self.contentHash = contentHash
+
+    # Yields the blocks of the map as in memory files
+    def readBlocks(self):
+        position = 0
+        mapSize = len(self.map)
+        while position < mapSize:
+            blockEnd = position + self.blockSize
+            if blockEnd >= mapSize:
+                blockEnd = mapSize
+            else:
+                # cut after the last newline of the block, or after the first one of a longer line
+                newline = self.map.rfind(b'\n', position, blockEnd)
+                if newline < 0:
+                    newline = self.map.find(b'\n', blockEnd)
+                blockEnd = newline + 1 if newline >= 0 else mapSize
+
+            block = self.map[position:blockEnd]
+            position = blockEnd
+            if self.contentHash is not None:
+                self.contentHash.update(block)
+            if sys.version_info[0] < 3:
+                yield io.BytesIO(block)
+            else:
+                yield io.StringIO(block.decode(self.encoding), newline='')
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.readBlocks())
+
+    def close(self):
+        self.map.close()
+        self.file.close()
+
+
+# Logging handler that keeps the messages in memory, used by the worker processes which hand their
+# messages back to the main process
+class MessageCollector(logging.Handler):
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append((record.levelno, record.getMessage()))
+
+
+# Creates the logger of a worker process, its messages are kept by the collector
+def createCollectorLogger(collector):
+
+    logger = logging.Logger('fatturazione.worker')
+    logger.addHandler(collector)
+    return logger
+
+
+# Worker process entry point of Fatturazione.runParallel(): parses the rows of a byte range of the input file
+# and spills them in runs grouped by DSP. Returns (run file names, row counters, reject report, log messages, error,
+# stage times)
+def processInputRange(task):
+
+    inputFile, cfgData, fileCols, rangeStart, rangeEnd = task
+
+    collector = MessageCollector()
+    fattWorker = Fatturazione(inputFile, None, createCollectorLogger(collector))
+    fattWorker.applyCfgData(cfgData)
+    fattWorker.fileCols = fileCols
+
+    sortedRuns = []
+    try:
+        if fattWorker.engine == 'compact':
+            inputRows = csv.reader(fattWorker.readInputRange(rangeStart, rangeEnd), delimiter=fattWorker.csvDelimiter)
+        else:
+            inputRows = csv.DictReader(fattWorker.readInputRange(rangeStart, rangeEnd), fieldnames=fileCols,
+                                       delimiter=fattWorker.csvDelimiter)
+        outputRows = fattWorker.parseStream(inputRows)
+        sortedRuns = fattWorker.spillGroupedRuns(outputRows)
+    except Exception as e:
+        # handle unexpected script errors
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fattWorker.errorHandler(e, 'processInputRange()', exc_tb.tb_lineno)
+
+    return (sortedRuns, fattWorker.getCounters(), fattWorker.rejectReport, collector.messages, fattWorker.error,
+            fattWorker.stageTimes)
+
+
+# Worker process entry point of runBatch(): processes a whole input file with an already loaded config.
+# With mergeOutput the sorted runs are returned instead of writing the output file, otherwise the output is written
+# to the given output file name. Returns (input file, output file name, run file names, row counters, reject report,
+# log messages, error)
+def processInputFile(task):
+
+    inputFile, cfgData, stream, mergeOutput, outputFileName = task
+
+    collector = MessageCollector()
+    fattWorker = Fatturazione(inputFile, None, createCollectorLogger(collector))
+    fattWorker.applyCfgData(cfgData)
+    fattWorker.outputFileName = outputFileName
+
+    sortedRuns = []
+    try:
+        if mergeOutput:
+            inputRows = fattWorker.openInputStream(fattWorker.engine == 'compact')
+            if fattWorker.error is None:
+                sortedRuns = fattWorker.spillGroupedRuns(fattWorker.parseStream(inputRows))
+                fattWorker.csvFile.close()
+                fattWorker.logRejects()
+                if fattWorker.error is None and fattWorker.rowCount == 0:
+                    fattWorker.error = {'error': 'Empty file'}
+        elif stream:
+            fattWorker.runStream()
+        else:
+            fattWorker.run()
+    except Exception as e:
+        # handle unexpected script errors
+        exc_type, exc_obj, exc_tb = sys.exc_info()
+        fattWorker.errorHandler(e, 'processInputFile()', exc_tb.tb_lineno)
+
+    if fattWorker.error is not None:
+        # a failed file does not take part in the merge
+        for runFileName in sortedRuns:
+            os.remove(runFileName)
+        sortedRuns = []
+
+    return (inputFile, fattWorker.outputFileName, sortedRuns, fattWorker.getCounters(), fattWorker.rejectReport,
+            collector.messages, fattWorker.error)
+
+
+# Processes many input files with the same config, which is loaded and checked only once. Files are spread
+# over a pool of processes when workers > 1. Each file gets its own output file, unless mergeOutput is set:
+# then all the rows are merged into a single DSP sorted output file. An error on a file does not stop the
+# others, a file whose output name is taken by an earlier file of the batch or by an existing file fails instead
+# of overwriting it. Returns the list of (input file, output file name, error) and the merged output file name
+def runBatch(inputFiles, configFile, logger, workers=1, stream=False, mergeOutput=False, mergeFileName=None):
+
+    batchWorker = Fatturazione(None, configFile, logger)
+    batchWorker.openCfgFile()
+    if batchWorker.error is not None:
+        return [(inputFile, None, batchWorker.error) for inputFile in inputFiles], None
+
+    # the output names are given here, so two processes never write the same path
+    results = [None] * len(inputFiles)
+    tasks = []
+    taskIndexes = []
+    outputFileNames = set()
+    for fileIndex, inputFile in enumerate(inputFiles):
+        outputFileName = None
+        if not mergeOutput:
+            batchWorker.inputFile = inputFile
+            outputFileName = batchWorker.createOutputFileName()
+            if outputFileName in outputFileNames or os.path.exists(outputFileName):
+                fileError = {'error': 'Output file {} already exists'.format(outputFileName)}
+                results[fileIndex] = (inputFile, None, [], None, RejectReport(), [], fileError)
+                continue
+            outputFileNames.add(outputFileName)
+        tasks.append((inputFile, batchWorker.cfgData, stream, mergeOutput, outputFileName))
+        taskIndexes.append(fileIndex)
+
+    if workers > 1:
+        pool = multiprocessing.Pool(workers)
+        try:
+            taskResults = pool.map(processInputFile, tasks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        taskResults = [processInputFile(task) for task in tasks]
+    for fileIndex, taskResult in zip(taskIndexes, taskResults):
+        results[fileIndex] = taskResult
+
+    fileResults = []
+    sortedRuns = []
+    for inputFile, outputFileName, fileRuns, fileCounters, fileRejects, fileMessages, fileError in results:
+        for level, message in fileMessages:
+            logger.log(level, '{}: {}'.format(inputFile, message))
+        if fileError is not None:
+            logger.error('Error while processing file {}: {}'.format(inputFile, fileError['error']))
+        fileResults.append((inputFile, outputFileName, fileError))
+        # files are kept in the given order, so ties on the DSP follow the file order
+        sortedRuns.extend(fileRuns)
+        if fileError is None:
+            batchWorker.rejectReport.merge(fileRejects)
+            batchWorker.addCounters(fileCounters)
+
+    if not mergeOutput:
+        return fileResults, None
+
+    batchWorker.inputFile = 'batch'
+    batchWorker.outputFileName = mergeFileName
+    batchWorker.saveGroupedRunsToFile(sortedRuns)
+    if batchWorker.error is not None:
+        logger.error('Error while writing merged output: {}'.format(batchWorker.error['error']))
+        return fileResults, None
+    batchWorker.saveRejects()
+    batchWorker.saveSummary()
+
+    return fileResults, batchWorker.outputFileName
+
+
+# Rejected rows of a run: counts per reason, the first sampleSize messages of each reason for the log and,
+# when keepRows is set, all the rejected rows for the rejects file
+class RejectReport:
+
+    def __init__(self, sampleSize=10, keepRows=False):
+        self.sampleSize = sampleSize
+        self.keepRows = keepRows
+        self.counts = {}
+        self.samples = {}
+        self.rows = []
+
+    # Adds a rejected row, row is the list written to the rejects file
+    def add(self, reason, errorMessage, row):
+        reasonCount = self.counts.get(reason, 0)
+        self.counts[reason] = reasonCount + 1
+        if reasonCount < self.sampleSize:
+            self.samples.setdefault(reason, []).append(errorMessage)
+        if self.keepRows:
+            self.rows.append(row)
+
+    # Adds the rejected rows of another report, they come after the ones of this report
+    def merge(self, otherReport):
+        for reason, reasonCount in otherReport.counts.items():
+            self.counts[reason] = self.counts.get(reason, 0) + reasonCount
+            reasonSamples = self.samples.setdefault(reason, [])
+            reasonSamples.extend(otherReport.samples.get(reason, [])[:self.sampleSize - len(reasonSamples)])
+        if self.keepRows:
+            self.rows.extend(otherReport.rows)
+
+    def total(self):
+        return sum(self.counts.values())
+
+    # Logs the count and the samples of every reason
+    def logSummary(self, logger):
+        for reason in sorted(self.counts):
+            reasonSamples = self.samples.get(reason, [])
+            logger.error('{}: {} rows rejected, first {} follow'.format(reason, self.counts[reason], len(reasonSamples)))
+            for errorMessage in reasonSamples:
+                logger.error(errorMessage)
+
+
+# Rejected rows that are not written to a rejects file are error lines of the output: their DSP field holds the
+# error message, which starts with the reject reason
+rejectReasons = ('Invalid Date', 'Invalid Mode', 'Invalid Tenant')
+
+
+# Returns True when the DSP field of an output row is the error message of a rejected row
+def isErrorDueDate(dueDateStr):
+    return dueDateStr.startswith(rejectReasons)
+
+
+# Returns the distinct DSP strings in sorted order. YYYY-MM-DD dates are placed by a counting pass over their day
+# ordinals, the other strings (error lines, dates in other formats) are sorted and merged in. The result is the
+# same as sorted(dueDates)
+def orderDueDates(dueDates):
+
+    dayKeys = {}
+    otherKeys = []
+    for dueDate in dueDates:
+        if len(dueDate) == 10 and dueDate[4] == '-' and dueDate[7] == '-':
+            try:
+                dateValue = datetime.date(int(dueDate[:4]), int(dueDate[5:7]), int(dueDate[8:]))
+            except ValueError:
+                dateValue = None
+            if dateValue is not None and dateValue.isoformat() == dueDate:
+                dayKeys[dateValue.toordinal()] = dueDate
+                continue
+        otherKeys.append(dueDate)
+
+    dayOrder = []
+    if dayKeys:
+        firstDay = min(dayKeys)
+        daySpan = max(dayKeys) - firstDay + 1
+        if daySpan > 10 * len(dayKeys):
+            # few dates spread over centuries, not worth the slots
+            dayOrder = [dayKeys[dueOrdinal] for dueOrdinal in sorted(dayKeys)]
+        else:
+            daySlots = [None] * daySpan
+            for dueOrdinal, dueDate in dayKeys.items():
+                daySlots[dueOrdinal - firstDay] = dueDate
+            dayOrder = [dueDate for dueDate in daySlots if dueDate is not None]
+
+    otherKeys.sort()
+    return heapq.merge(dayOrder, otherKeys)
+
+
+# Lazily filled lookup table from a date string plus mode to its DSP, and from a date string to its validity.
+# Invoice dates fall in a narrow window, so after warm up every row costs a dictionary lookup
+class DueDateTable:
+
+    def __init__(self, checkFunc, computeFuncs, maxSize=100000):
+        # checkFunc(dateStr) tells if a date is valid, computeFuncs maps a mode to its DSP function. rollFunc, when
+        # set, moves the computed DSP to a business day
+        self.checkFunc = checkFunc
+        self.computeFuncs = computeFuncs
+        self.maxSize = maxSize
+        self.rollFunc = None
+
+        self.validDates = {}
+        self.dueDates = {}
+
+        # statistics
+        self.hits = 0
+        self.misses = 0
+
+    # Returns True if the date string is a valid date
+    def isValid(self, dateStr):
+        try:
+            valid = self.validDates[dateStr]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            valid = self.checkFunc(dateStr)
+            self.store(self.validDates, dateStr, valid)
+        return valid
+
+    # Returns the DSP string of a valid date string for the given mode
+    def lookup(self, dateStr, mode):
+        key = (dateStr, mode)
+        try:
+            dueDate = self.dueDates[key]
+            self.hits += 1
+        except KeyError:
+            self.misses += 1
+            dueDate = self.computeFuncs[mode](dateStr)
+            if self.rollFunc is not None:
+                dueDate = self.rollFunc(dueDate)
+            self.store(self.dueDates, key, dueDate)
+        return dueDate
+
+    # Stores a new entry, the tables are emptied when they grow over maxSize
+    def store(self, table, key, value):
+        if len(table) >= self.maxSize:
+            table.clear()
+        table[key] = value
+
+    # Returns the hit/miss statistics as a dict
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRatio': float(self.hits) / lookups if lookups else 0.0,
+            'size': len(self.validDates) + len(self.dueDates)
+        }
+
+
+# Italian bank holidays, fixed days as MM-DD. easterMonday is computed for every year
+italianHolidays = ['01-01', '01-06', 'easterMonday', '04-25', '05-01', '06-02', '08-15', '11-01', '12-08', '12-25',
+                   '12-26']
+
+
+# Returns the date of Easter Sunday of a year, anonymous Gregorian algorithm
+def easterSunday(year):
+
+    a = year % 19
+    b, c = divmod(year, 100)
+    d, e = divmod(b, 4)
+    f = (b + 8) // 25
+    g = (b - f + 1) // 3
+    h = (19 * a + b - d - g + 15) % 30
+    i, k = divmod(c, 4)
+    l = (32 + 2 * e + 2 * i - h - k) % 7
+    m = (a + 11 * h + 22 * l) // 451
+    month, day = divmod(h + l - 7 * m + 114, 31)
+    return datetime.date(year, month, day + 1)
+
+
+# Moves DSPs falling on weekends or holidays to the next business day. With roll 'modifiedFollowing' a DSP that would
+# move to the next month goes back to the previous business day instead. holidays are MM-DD days of every year,
+# YYYY-MM-DD single days or 'easterMonday'. The closed days of a year are a bitmap built the first time the year is
+# met, from which every day gets its adjusted day ordinal, so each DSP costs a table lookup
+class BusinessCalendar:
+
+    def __init__(self, holidays=None, roll='following'):
+
+        if roll not in ('following', 'modifiedFollowing'):
+            raise ValueError('Invalid business day roll: {}'.format(roll))
+        self.roll = roll
+
+        self.yearlyHolidays = []
+        self.fixedHolidays = set()
+        self.easterMonday = False
+        for holiday in (italianHolidays if holidays is None else holidays):
+            if holiday == 'easterMonday':
+                self.easterMonday = True
+            elif len(holiday) == 5:
+                # the day must exist in a leap year
+                datetime.date(2000, int(holiday[:2]), int(holiday[3:]))
+                self.yearlyHolidays.append((int(holiday[:2]), int(holiday[3:])))
+            else:
+                self.fixedHolidays.add(datetime.datetime.strptime(holiday, '%Y-%m-%d').date().toordinal())
+
+        # year -> (first day ordinal, adjusted ordinal of every day of the year, 0 for business days)
+        self.yearTables = {}
+        self.dateStrings = {}
+
+    # Returns the day ordinals of the holidays of a year
+    def holidayOrdinals(self, year):
+
+        ordinals = set()
+        for month, day in self.yearlyHolidays:
+            if day <= monthrange(year, month)[1]:
+                ordinals.add(datetime.date(year, month, day).toordinal())
+        if self.easterMonday:
+            ordinals.add(easterSunday(year).toordinal() + 1)
+        return ordinals | self.fixedHolidays
+
+    # Returns the table of a year, built from the closed days bitmap of the year and of the first weeks of the next
+    # one, where the last days of the year can move
+    def yearTable(self, year):
+
+        table = self.yearTables.get(year)
+        if table is not None:
+            return table
+
+        firstDay = datetime.date(year, 1, 1).toordinal()
+        yearDays = datetime.date(year, 12, 31).toordinal() - firstDay + 1
+        spanDays = yearDays + 31 if year < datetime.MAXYEAR else yearDays
+        holidays = self.holidayOrdinals(year)
+        if year < datetime.MAXYEAR:
+            holidays |= self.holidayOrdinals(year + 1)
+
+        # day ordinal 1 is a monday, so saturdays have ordinal % 7 == 6 and sundays 0
+        closedDays = bytearray(spanDays)
+        for dayIndex in range(spanDays):
+            dayOrdinal = firstDay + dayIndex
+            if dayOrdinal % 7 in (0, 6) or dayOrdinal in holidays:
+                closedDays[dayIndex] = 1
+
+        rolledOrdinals = array('l', [0]) * yearDays
+        nextOpen = None
+        for dayIndex in range(spanDays - 1, -1, -1):
+            if not closedDays[dayIndex]:
+                nextOpen = dayIndex
+            elif dayIndex < yearDays and nextOpen is not None:
+                rolledOrdinals[dayIndex] = firstDay + nextOpen
+
+        if self.roll == 'modifiedFollowing':
+            previousOpen = None
+            for dayIndex in range(yearDays):
+                if not closedDays[dayIndex]:
+                    previousOpen = dayIndex
+                elif rolledOrdinals[dayIndex] and previousOpen is not None:
+                    dayDate = datetime.date.fromordinal(firstDay + dayIndex)
+                    if datetime.date.fromordinal(rolledOrdinals[dayIndex]).month != dayDate.month:
+                        rolledOrdinals[dayIndex] = firstDay + previousOpen
+
+        table = (firstDay, rolledOrdinals)
+        self.yearTables[year] = table
+        return table
+
+    # Returns the business day of a valid date string, the string itself if it already is a business day
+    def rollDate(self, dateStr):
+
+        dateValue = datetime.datetime.strptime(dateStr, '%Y-%m-%d').date()
+        rolledOrdinal = self.rollOrdinal(dateValue.toordinal(), dateValue.year)
+        if rolledOrdinal == dateValue.toordinal():
+            return dateStr
+        dateString = self.dateStrings.get(rolledOrdinal)
+        if dateString is None:
+            dateString = datetime.date.fromordinal(rolledOrdinal).isoformat()
+            self.dateStrings[rolledOrdinal] = dateString
+        return dateString
+
+    # Returns the business day ordinal of a day ordinal of the given year
+    def rollOrdinal(self, dayOrdinal, year):
+
+        firstDay, rolledOrdinals = self.yearTable(year)
+        return rolledOrdinals[dayOrdinal - firstDay] or dayOrdinal
+
+    # Moves the DSP ordinals of the rows of a column to business days, every distinct DSP is looked up once
+    def rollColumn(self, rowIndexes, dueOrdinals):
+
+        rolled = {}
+        for rowIndex in rowIndexes:
+            dueOrdinal = dueOrdinals[rowIndex]
+            rolledOrdinal = rolled.get(dueOrdinal)
+            if rolledOrdinal is None:
+                rolledOrdinal = self.rollOrdinal(dueOrdinal, datetime.date.fromordinal(dueOrdinal).year)
+                rolled[dueOrdinal] = rolledOrdinal
+            dueOrdinals[rowIndex] = rolledOrdinal
+
+
+# Output of the columnar engine: ids and dates are kept as they were read, the DSP as a day ordinal column.
+# DSP strings are only built when the rows are sorted and written, errors and dates that are not in the
+# canonical YYYY-MM-DD format keep their DSP string in specialDueDates
+class ColumnarBatch:
+
+    def __init__(self, ids, dates):
+        self.ids = ids
+        self.dates = dates
+        self.dueOrdinals = array('l', [0]) * len(ids)
+        self.specialDueDates = {}
+
+        # row order used when iterating, input order until sortByDsp() is called. Once sorted, the DSP column is
+        # kept as (DSP string, number of rows) runs in output order
+        self.order = None
+        self.dueDateRuns = None
+        self.dueDateStrings = {}
+
+    def __len__(self):
+        return len(self.rowIndexes())
+
+    # Returns the indexes of the output rows, in output order
+    def rowIndexes(self):
+        return self.order if self.order is not None else range(len(self.ids))
+
+    # Removes rows from the output, keeping the order of the others
+    def dropRows(self, dropIndexes):
+        dropIndexes = set(dropIndexes)
+        self.order = [rowIndex for rowIndex in self.rowIndexes() if rowIndex not in dropIndexes]
+        self.dueDateRuns = None
+
+    # Returns the DSP string of a row
+    def dueDate(self, rowIndex):
+        dueDateStr = self.specialDueDates.get(rowIndex)
+        if dueDateStr is None:
+            dueDateStr = self.ordinalDate(self.dueOrdinals[rowIndex])
+        return dueDateStr
+
+    # Returns the DSP string of a day ordinal
+    def ordinalDate(self, dueOrdinal):
+        dueDateStr = self.dueDateStrings.get(dueOrdinal)
+        if dueDateStr is None:
+            dueDateStr = datetime.date.fromordinal(dueOrdinal).isoformat()
+            self.dueDateStrings[dueOrdinal] = dueDateStr
+        return dueDateStr
+
+    # Sorts the rows by DSP string, same ordering as Fatturazione.sortOutput(). Rows are grouped in input order
+    # by DSP day ordinal, so only the distinct DSPs are sorted. Rows with a DSP string have ordinal 0 and are
+    # grouped by the string afterwards
+    def sortByDsp(self):
+        specialDueDates = self.specialDueDates
+        dueOrdinals = self.dueOrdinals
+        if self.order is None:
+            rowOrdinals = enumerate(dueOrdinals)
+        else:
+            rowOrdinals = izip(self.order, [dueOrdinals[rowIndex] for rowIndex in self.order])
+
+        ordinalBuckets = {}
+        for rowIndex, dueOrdinal in rowOrdinals:
+            bucket = ordinalBuckets.get(dueOrdinal)
+            if bucket is None:
+                ordinalBuckets[dueOrdinal] = [rowIndex]
+            else:
+                bucket.append(rowIndex)
+
+        buckets = {}
+        for rowIndex in ordinalBuckets.pop(0, []):
+            dueDateStr = specialDueDates[rowIndex]
+            bucket = buckets.get(dueDateStr)
+            if bucket is None:
+                buckets[dueDateStr] = [rowIndex]
+            else:
+                bucket.append(rowIndex)
+
+        for dueOrdinal, bucket in ordinalBuckets.items():
+            dueDateStr = self.ordinalDate(dueOrdinal)
+            if dueDateStr in buckets:
+                # same DSP from a row handler, keep the input order
+                bucket = sorted(buckets[dueDateStr] + bucket)
+            buckets[dueDateStr] = bucket
+
+        sortedDueDates = list(orderDueDates(buckets))
+        self.order = list(itertools.chain.from_iterable(map(buckets.__getitem__, sortedDueDates)))
+        self.dueDateRuns = [(dueDateStr, len(buckets[dueDateStr])) for dueDateStr in sortedDueDates]
+
+    # Returns an iterator over the output rows as (id, date, DSP) tuples, zipped from the columns. Sorted rows take
+    # their DSP from the runs, so every DSP string is looked up once
+    def __iter__(self):
+        rowIndexes = self.rowIndexes()
+        if self.dueDateRuns is None:
+            dueDates = imap(self.dueDate, rowIndexes)
+        else:
+            dueDates = itertools.chain.from_iterable(itertools.starmap(itertools.repeat, self.dueDateRuns))
+        if self.order is None:
+            return izip(self.ids, self.dates, dueDates)
+        ids = self.ids
+        dates = self.dates
+        return izip([ids[rowIndex] for rowIndex in rowIndexes], [dates[rowIndex] for rowIndex in rowIndexes], dueDates)
+
+
 class Fatturazione:
 
     # Fatturazione Init
@@ -28,6 +734,7 @@ class Fatturazione:
 
         # Cfg file data
         self.cfgData = {}
+        self.cfgLoaded = False
 
         # Fields to process with default values that can be overwritten by the cfg file
         self.inputCols = ['NrFattura', 'DataFattura', 'ModalitaDiPagamento']
@@ -37,6 +744,26 @@ class Fatturazione:
         self.dateField = 'DataFattura'
         self.modeField = 'ModalitaDiPagamento'
         self.csvDelimiter = ';'
+        # max number of output rows sorted in memory by the streaming run, bigger outputs are spilled to temp files
+        self.sortBufferRows = 500000
+        self.sortTempDir = None
+        # read/write buffer of the input and output files, plain inputs of at least mmapThreshold bytes are
+        # memory mapped (null in the config to never map them). outputCompression 'gz', 'bz2' or 'xz' compresses
+        # the output files, compressed inputs are recognized by their extension
+        self.ioBufferSize = 1024 * 1024
+        # 'comparison' sorts the output rows with list.sort, 'bucket' groups them by DSP and orders the distinct DSPs.
+        # partitionOutput 'month' or 'week' writes one output file per DSP month or ISO week
+        self.sortMethod = 'bucket'
+        self.partitionOutput = None
+        self.partitionFileNames = []
+        # parsed input columns are cached in inputCacheDir, up to inputCacheMaxBytes, see fatturazione_cache.py
+        self.inputCacheDir = None
+        self.inputCacheMaxBytes = 1024 * 1024 * 1024
+        self.inputCacheHit = False
+        # SQLite database also receiving the output rows, upserted by invoice id, see fatturazione_db.py
+        self.sqliteOutput = None
+        self.mmapThreshold = 64 * 1024 * 1024
+        self.outputCompression = None
 
         '''
         # Lines reserved for debugging
@@ -56,21 +783,79 @@ class Fatturazione:
                         'DF60': self.df60Handler
         }
 
+        # column functions used by the columnar engine, modes without one go through their funcPointer handler
+        self.engine = 'row'
+        self.columnPointer = {
+                        'DF' : self.dfColumn,
+                        'DFFM': self.dffmColumn,
+                        'DF60': self.df60Column
+        }
+        # (first day ordinal, number of days) of the months met by the columnar engine
+        self.monthTable = {}
+        # (id, date, mode) column indexes of the compact engine, which reads the rows as lists and writes the
+        # output rows as tuples
+        self.fieldIndexes = None
+
+        # payment rules of the config, mode -> rule. They are compiled into a DSP function of the due date table
+        # and a handler of funcPointer, see compilePaymentRule()
+        self.paymentRules = {}
+
+        # business day adjustment of the DSP, from the businessDays config: {"roll": ..., "holidays": [...]}
+        self.businessCalendar = None
+
+        # DSP lookup table, filled while parsing
+        self.dueDateTable = DueDateTable(self.checkDate, {
+                        'DFFM': self.endOfMonth,
+                        'DF60': self.addTwoMonthsToDate
+        })
+
         #output variables
         self.error = None
         self.outputData = []    # define the output as a list of array of strings, sortable
+        self.rowCount = 0       # number of input rows
+        self.outputRowCount = 0 # number of rows written to the output file
+
+        # metrics: stage timings and row counters of the last run
+        self.stageTimes = {}
+        self.modeCounts = {}
+        self.df60FallbackCount = 0
+        self.df60FallbackDates = set()  # DF60 dates whose DSP is DF + 60 days
+
+        # rejected rows: with errorReporting 'aggregate' the log gets counts and samples once the input is parsed,
+        # with 'row' every rejected row is logged right away. With rejectsFile the rejected rows are written to a
+        # REJ_ file next to the output instead of being error lines of the DSP output
+        self.errorReporting = 'aggregate'
+        self.errorSamples = 10
+        self.rejectsFile = False
+        self.rejectsFileName = None
+        self.rejectReport = RejectReport()
         self.outputFileName = None
 
+        # with summaryFile a SUM_ json file next to the output gets the invoice counts per DSP, DSP week and mode and
+        # the rejected counts per reason. DSPs are counted while the output is written, the rest comes from the parse
+        self.summaryFile = False
+        self.summaryFileName = None
+        self.dueDateCounts = collections.Counter()
+
+        # multi tenant files: tenant key -> worker with the tenant config, see loadTenants(). Rows are routed by the
+        # tenantField column or by the id up to tenantIdSeparator. tenantOutput 'merged' writes one output file,
+        # 'split' one file per tenant
+        self.tenantWorkers = None
+        self.tenantField = None
+        self.tenantIdSeparator = None
+        self.tenantOutput = 'merged'
+
 
     # Main Fatturazione method, opens input file and creates output
     def run(self):
 
         # Stage 1 - Import cfg file
-        self.openCfgFile()
+        if not self.cfgLoaded:
+            self.timeStage('openCfgFile', self.openCfgFile)
 
         # Stage 2 - Import file and save it into a variable
         self.logger.info('Stage 2 - Import file data')
-        self.openInputFile()
+        self.timeStage('openInputFile', self.openInputFile)
 
         if self.error is not None:
             # return error message, stop execution
@@ -79,7 +864,15 @@ class Fatturazione:
 
         # stage 3 - Run through file and create output if there was no error in S2 and inputData has a value
         self.logger.info('Stage 3 - Parsing input and preparing output')
-        self.parseInput()
+        if self.engine == 'columnar':
+            self.timeStage('parseInput', self.parseInputColumnar)
+        elif self.engine == 'compact':
+            self.timeStage('parseInput', self.parseInputCompact)
+            self.logger.info('Due date table: {}'.format(self.dueDateTable.stats()))
+        else:
+            self.timeStage('parseInput', self.parseInput)
+            self.logger.info('Due date table: {}'.format(self.dueDateTable.stats()))
+        self.logRejects()
 
         if self.error is not None:
             # return error message, stop execution
@@ -87,41 +880,237 @@ class Fatturazione:
             return self.error
 
 
-        # Stage 4 - Save output to file if there was no error in S3
-        self.logger.info('Stage 4 - Save output to file')
-        self.saveToFile()
+        # Stage 4 - Sort output by DSP (Data Scadenza Pagamento) and save it to file if there was no error in S3
+        self.logger.info('Stage 4 - Sort output and save it to file')
+        self.timeStage('sortOutput', self.sortOutput)
+        self.timeStage('saveToFile', self.saveToFile)
+        self.saveRejects()
+        self.saveSummary()
 
         # return Error None
         return self.error
 
+    # Streaming version of run(): rows are read, validated, dispatched and written one by one through
+    # generators, the DSP sort spills to temp files over sortBufferRows rows. The output is the same as run()
+    def runStream(self):
+
+        # Stage 1 - Import cfg file
+        if not self.cfgLoaded:
+            self.timeStage('openCfgFile', self.openCfgFile)
+
+        # Stage 2 - Open the input file, rows are read lazily by the next stages
+        self.logger.info('Stage 2 - Open input file stream')
+        inputRows = self.timeStage('openInputStream', self.openInputStream, self.engine == 'compact')
+
+        if self.error is not None:
+            # return error message, stop execution
+            self.logger.error('Error while trying to open input file')
+            return self.error
+
+        # Stage 3 and 4 - Parse the rows while they are read and save them to file
+        self.logger.info('Stage 3 - Parsing input stream')
+        self.logger.info('Stage 4 - Save output stream to file')
+        # reading, parsing, sorting and writing are interleaved, they are timed as a single stage
+        self.timeStage('parseAndSave', self.saveStreamToFile, self.parseStream(inputRows))
+        self.logger.info('Due date table: {}'.format(self.dueDateTable.stats()))
+        # the file is already closed unless parsing stopped early
+        self.csvFile.close()
+        self.logRejects()
+        self.saveRejects()
+        self.saveSummary()
+
+        if self.error is not None:
+            self.logger.error('Error while trying to process input stream')
+
+        return self.error
+
+    # Parallel version of runStream(): the input file is split into newline aligned byte ranges which are
+    # parsed by a pool of processes, the sorted runs of every process are merged into the output file.
+    # Rows must not contain quoted newlines, since the ranges are split on plain newlines
+    def runParallel(self, workers):
+
+        # Stage 1 - Import cfg file
+        if not self.cfgLoaded:
+            self.timeStage('openCfgFile', self.openCfgFile)
+
+        # the pool workers get the merged tenant output setting with cfgData
+        self.mergeTenantOutput()
+
+        # compressed files can not be split into byte ranges
+        if fileCompression(self.inputFile) is not None:
+            self.logger.info('Compressed input file, processing it as a stream')
+            return self.runStream()
+
+        # Stage 2 - Split the input file into byte ranges
+        self.logger.info('Stage 2 - Split input file into {} ranges'.format(workers))
+        inputRanges = self.timeStage('splitInputFile', self.splitInputFile, workers)
+
+        if self.error is not None:
+            # return error message, stop execution
+            self.logger.error('Error while trying to open input file')
+            return self.error
+
+        if not self.checkInputCols():
+            return self.error
+
+        # Stage 3 - Parse the ranges in the process pool
+        self.logger.info('Stage 3 - Parsing input in {} processes'.format(workers))
+        tasks = [(self.inputFile, self.cfgData, self.fileCols, rangeStart, rangeEnd)
+                 for rangeStart, rangeEnd in inputRanges]
+        pool = multiprocessing.Pool(workers)
+        try:
+            results = self.timeStage('parseInput', pool.map, processInputRange, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        # runs are kept in input order, so the merge is stable as the single process sort
+        sortedRuns = []
+        for workerRuns, workerCounters, workerRejects, workerMessages, workerError, workerTimes in results:
+            sortedRuns.extend(workerRuns)
+            self.addCounters(workerCounters)
+            for stageName, stageTimes in workerTimes.items():
+                self.addWorkerStageTime(stageName, stageTimes['wallSeconds'], stageTimes['cpuSeconds'])
+            self.rejectReport.merge(workerRejects)
+            for level, message in workerMessages:
+                self.logger.log(level, message)
+            if workerError is not None and self.error is None:
+                self.error = workerError
+
+        self.logRejects()
+
+        # Stage 4 - Merge the sorted runs into the output file
+        self.logger.info('Stage 4 - Merge sorted runs into output file')
+        if self.error is None:
+            self.timeStage('saveToFile', self.saveGroupedRunsToFile, sortedRuns)
+            self.saveRejects()
+            self.saveSummary()
+        else:
+            # drop the runs
+            for runFileName in sortedRuns:
+                os.remove(runFileName)
+
+        if self.error is not None:
+            self.logger.error('Error while trying to process input file')
+
+        return self.error
+
+    # Incremental version of runStream(): the index file keeps, for every invoice id, the hash of its input row
+    # and its DSP. Only new or changed rows are parsed, the unchanged ones are taken from the previous output,
+    # deleted ids are dropped. The index is rebuilt from scratch when the config changes
+    def runIncremental(self, indexFileName):
+
+        # Stage 1 - Import cfg file
+        if not self.cfgLoaded:
+            self.timeStage('openCfgFile', self.openCfgFile)
+
+        # the next run merges the previous output, which must be a single file
+        if self.partitionOutput:
+            self.logger.info('Partitioned output is not supported by incremental runs, writing a single file')
+            self.partitionOutput = None
+        self.mergeTenantOutput()
+        # unchanged rows are not parsed, so their modes are not known
+        if self.summaryFile:
+            self.logger.info('Summary file is not supported by incremental runs')
+            self.summaryFile = False
+
+        # Stage 2 - Open the input file and the index of the previous run
+        self.logger.info('Stage 2 - Open input file stream and run index')
+        inputRows = self.openInputStream()
+
+        if self.error is not None:
+            # return error message, stop execution
+            self.logger.error('Error while trying to open input file')
+            return self.error
+
+        cfgFingerprint = json.dumps(self.cfgData, sort_keys=True)
+        runIndex = self.loadRunIndex(indexFileName)
+        if runIndex is None or runIndex['cfg'] != cfgFingerprint or not os.path.exists(runIndex['outputFile']):
+            self.logger.info('No valid run index, all the rows are parsed')
+            runIndex = {'outputFile': None, 'rows': {}}
+
+        # Stage 3 - Parse the new and changed rows
+        self.logger.info('Stage 3 - Parsing new and changed rows')
+        indexRows = runIndex['rows']
+        newIndexRows = {}
+        changedRows = []
+        unchangedIds = set()
+        try:
+            if self.checkInputCols():
+                self.outputData = changedRows
+                for singleLine in inputRows:
+                    self.rowCount += 1
+                    rowId = singleLine[self.idField]
+                    if rowId in newIndexRows:
+                        errorMessage = 'Duplicate ID {}, incremental runs need unique ids'.format(rowId)
+                        self.logger.error(errorMessage)
+                        self.error = {'error': errorMessage}
+                        break
+
+                    rowDigest = self.rowDigest(singleLine)
+                    indexRow = indexRows.get(rowId)
+                    # rejected rows have no DSP in the index, they are parsed again on every run so they are
+                    # reported in the reject counts, the log and the rejects file each time
+                    if indexRow is not None and indexRow[0] == rowDigest and indexRow[1] is not None:
+                        unchangedIds.add(rowId)
+                        newIndexRows[rowId] = indexRow
+                    else:
+                        rejectCount = self.rejectReport.total()
+                        self.parseLine(singleLine)
+                        dueDate = None
+                        if self.rejectReport.total() == rejectCount:
+                            dueDate = changedRows[-1][2]
+                        newIndexRows[rowId] = (rowDigest, dueDate)
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'runIncremental()', exc_tb.tb_lineno)
+        self.csvFile.close()
+
+        if self.error is not None:
+            self.logger.error('Error while trying to parse input file')
+            return self.error
+
+        self.logRejects()
+        deletedRows = len([rowId for rowId in indexRows if rowId not in newIndexRows])
+        self.logger.info('Incremental run: {} unchanged, {} new or changed, {} deleted rows'.format(
+            len(unchangedIds), len(changedRows), deletedRows))
+
+        # Stage 4 - Merge the parsed rows into the previous output
+        self.logger.info('Stage 4 - Merge new rows into previous output')
+        self.sortOutput()
+        sortedRuns = [self.outputData]
+        if runIndex['outputFile'] is not None:
+            sortedRuns.insert(0, self.readPreviousOutput(runIndex['outputFile'], unchangedIds))
+
+        # write to a temp name first, the previous output could have the same name
+        outputFileName = self.createOutputFileName()
+        # the temp name keeps the extension, which gives the compression
+        outputDir, outputName = os.path.split(outputFileName)
+        self.outputFileName = os.path.join(outputDir, '.part_' + outputName)
+        self.saveSortedStreamToFile(self.mergeSortedRuns(sortedRuns))
+
+        if self.error is not None:
+            if os.path.exists(self.outputFileName):
+                os.remove(self.outputFileName)
+            self.outputFileName = None
+            self.logger.error('Error while trying to save output file')
+            return self.error
+
+        os.rename(self.outputFileName, outputFileName)
+        self.outputFileName = outputFileName
+        self.saveRejects()
+        self.saveRunIndex(indexFileName, {'cfg': cfgFingerprint, 'outputFile': outputFileName, 'rows': newIndexRows})
+
+        return self.error
+
     # Opens config file and saves it to local variable, it will also overwrite default values if valid
     def openCfgFile(self):
 
         try:
             # Open config file as dictionary
             with open(self.configFile) as cfgFile:
-                self.cfgData = json.load(cfgFile)
-
-                # if not empty or null
-                if self.cfgData:
-                    # overwrite values if present
-                    if 'inputCols' in self.cfgData:
-                        self.inputCols = self.cfgData['inputCols']
-                    if 'outputCols' in self.cfgData:
-                        self.outputCols = self.cfgData['outputCols']
-                    if 'validModes' in self.cfgData:
-                        self.validModes = self.cfgData['validModes']
-                    if 'idField' in self.cfgData:
-                        self.idField = self.cfgData['idField']
-                    if 'dateField' in self.cfgData:
-                        self.dateField = self.cfgData['dateField']
-                    if 'modeField' in self.cfgData:
-                        self.modeField = self.cfgData['modeField']
-                    if 'csvDelimiter' in self.cfgData:
-                        # the str() is necessary under linux
-                        self.csvDelimiter = str(self.cfgData['csvDelimiter'])
-                else:
-                    self.logger('Config file empty, sticking with default values')
+                self.applyCfgData(json.load(cfgFile))
 
         except Exception as e:
             # handle unexpected script errors
@@ -129,6 +1118,251 @@ class Fatturazione:
             self.errorHandler(e, 'openCfgFile()', exc_tb.tb_lineno)
 
 
+    # Overwrites the default values with the ones of an already loaded config, the run methods do not
+    # read the config file again afterwards
+    def applyCfgData(self, cfgData):
+
+        self.cfgData = cfgData
+        self.cfgLoaded = True
+
+        # if not empty or null
+        if self.cfgData:
+            # overwrite values if present
+            if 'inputCols' in self.cfgData:
+                self.inputCols = self.cfgData['inputCols']
+            if 'outputCols' in self.cfgData:
+                self.outputCols = self.cfgData['outputCols']
+            if 'validModes' in self.cfgData:
+                self.validModes = self.cfgData['validModes']
+            if 'idField' in self.cfgData:
+                self.idField = self.cfgData['idField']
+            if 'dateField' in self.cfgData:
+                self.dateField = self.cfgData['dateField']
+            if 'modeField' in self.cfgData:
+                self.modeField = self.cfgData['modeField']
+            if 'csvDelimiter' in self.cfgData:
+                # the str() is necessary under linux
+                self.csvDelimiter = str(self.cfgData['csvDelimiter'])
+            if 'sortBufferRows' in self.cfgData:
+                self.sortBufferRows = int(self.cfgData['sortBufferRows'])
+            if 'sortTempDir' in self.cfgData:
+                self.sortTempDir = self.cfgData['sortTempDir']
+            if 'sortMethod' in self.cfgData:
+                self.sortMethod = self.cfgData['sortMethod']
+            if 'inputCacheDir' in self.cfgData:
+                self.inputCacheDir = self.cfgData['inputCacheDir']
+            if 'inputCacheMaxBytes' in self.cfgData:
+                self.inputCacheMaxBytes = int(self.cfgData['inputCacheMaxBytes'])
+            if 'sqliteOutput' in self.cfgData:
+                self.sqliteOutput = self.cfgData['sqliteOutput']
+            if 'partitionOutput' in self.cfgData:
+                self.partitionOutput = self.cfgData['partitionOutput']
+            if 'ioBufferSize' in self.cfgData:
+                self.ioBufferSize = int(self.cfgData['ioBufferSize'])
+            if 'mmapThreshold' in self.cfgData:
+                self.mmapThreshold = self.cfgData['mmapThreshold']
+            if 'outputCompression' in self.cfgData:
+                self.outputCompression = self.cfgData['outputCompression']
+            if 'errorReporting' in self.cfgData:
+                self.errorReporting = self.cfgData['errorReporting']
+            if 'errorSamples' in self.cfgData:
+                self.errorSamples = int(self.cfgData['errorSamples'])
+            if 'rejectsFile' in self.cfgData:
+                self.rejectsFile = bool(self.cfgData['rejectsFile'])
+            if 'tenantField' in self.cfgData:
+                self.tenantField = self.cfgData['tenantField']
+            if 'tenantIdSeparator' in self.cfgData:
+                self.tenantIdSeparator = str(self.cfgData['tenantIdSeparator'])
+            if 'tenantOutput' in self.cfgData:
+                self.tenantOutput = self.cfgData['tenantOutput']
+            if 'summaryFile' in self.cfgData:
+                self.summaryFile = bool(self.cfgData['summaryFile'])
+            if 'engine' in self.cfgData:
+                self.engine = self.cfgData['engine']
+            if 'dueDateTableSize' in self.cfgData:
+                self.dueDateTable.maxSize = int(self.cfgData['dueDateTableSize'])
+            if 'businessDays' in self.cfgData:
+                businessDays = self.cfgData['businessDays']
+                self.businessCalendar = BusinessCalendar(businessDays.get('holidays'),
+                                                         businessDays.get('roll', 'following'))
+                # DF goes through the table too, so its DSP can move
+                self.dueDateTable.computeFuncs['DF'] = lambda dateStr: dateStr
+                self.dueDateTable.rollFunc = self.businessCalendar.rollDate
+            if 'paymentRules' in self.cfgData:
+                for modeType in sorted(self.cfgData['paymentRules']):
+                    self.addPaymentRule(modeType, self.cfgData['paymentRules'][modeType])
+        else:
+            self.logger.info('Config file empty, sticking with default values')
+
+        self.rejectReport = RejectReport(self.errorSamples, self.rejectsFile)
+        if self.cfgData and 'tenants' in self.cfgData:
+            self.loadTenants(self.cfgData['tenants'])
+
+
+    # Loads the tenant configs, a config dict or a file name relative to the config file for every tenant key. Each
+    # tenant gets a worker with its own modes, rules and DSP table, while the output settings, the reject report and
+    # the counters are the ones of this worker. File names are replaced by their content in cfgData, so the pool
+    # workers and the run index get the tenant configs too
+    def loadTenants(self, tenants):
+
+        if self.tenantField is None and self.tenantIdSeparator is None:
+            raise ValueError('Invalid tenants: tenantField or tenantIdSeparator is needed')
+        if self.tenantOutput not in ('merged', 'split'):
+            raise ValueError('Invalid tenantOutput: {}'.format(self.tenantOutput))
+
+        cfgDir = os.path.dirname(self.configFile) if self.configFile else ''
+        # the tenant configs start from the column names of the main config, they can still override them
+        fieldCfg = dict((cfgKey, self.cfgData[cfgKey]) for cfgKey in ('inputCols', 'outputCols', 'idField', 'dateField',
+                                                                     'modeField') if cfgKey in self.cfgData)
+        tenantCfgs = {}
+        self.tenantWorkers = {}
+        for tenantKey in sorted(tenants):
+            tenantCfg = tenants[tenantKey]
+            if not isinstance(tenantCfg, dict):
+                with open(os.path.join(cfgDir, tenantCfg)) as cfgFile:
+                    tenantCfg = json.load(cfgFile)
+            if 'tenants' in tenantCfg:
+                raise ValueError('Invalid tenant config {}: tenants can not be nested'.format(tenantKey))
+            tenantCfgs[tenantKey] = tenantCfg
+
+            tenantWorker = Fatturazione(self.inputFile, None, self.logger)
+            tenantWorker.applyCfgData(dict(fieldCfg, **tenantCfg))
+            tenantWorker.rejectsFile = self.rejectsFile
+            tenantWorker.errorReporting = self.errorReporting
+            tenantWorker.rejectReport = self.rejectReport
+            tenantWorker.modeCounts = self.modeCounts
+            tenantWorker.sortMethod = self.sortMethod
+            self.tenantWorkers[tenantKey] = tenantWorker
+        self.cfgData = dict(self.cfgData, tenants=tenantCfgs)
+
+        # the rows are routed by parseLine(), which only the row engine uses
+        if self.engine != 'row':
+            self.logger.info('Tenant configs need the row engine, {} engine not used'.format(self.engine))
+            self.engine = 'row'
+        if self.tenantOutput == 'split' and self.partitionOutput:
+            self.logger.info('Partitioned output is not supported with split tenant output, writing a file per tenant')
+            self.partitionOutput = None
+        self.parseLine = self.parseTenantLine
+
+
+    # Uses the DSP tables of a worker with the same config, the tenant tables too, so the tables of a resident
+    # template are kept between the workers created from it
+    def shareDueDateTables(self, template):
+
+        self.dueDateTable = template.dueDateTable
+        self.df60FallbackDates = template.df60FallbackDates
+        if self.tenantWorkers is not None:
+            for tenantKey, tenantWorker in self.tenantWorkers.items():
+                tenantWorker.shareDueDateTables(template.tenantWorkers[tenantKey])
+
+
+    # Takes the config of a worker that already applied it, as the resident service and the API do for every request:
+    # the settings are copied, the compiled rules, the business calendar and the DSP tables are shared, and the tenant
+    # workers are copied the same way. Nothing is compiled again, the run state stays the one of this worker
+    def copyConfig(self, template):
+
+        self.cfgData = template.cfgData
+        self.cfgLoaded = template.cfgLoaded
+        for attrName in ('inputCols', 'outputCols', 'validModes', 'idField', 'dateField', 'modeField', 'csvDelimiter',
+                         'sortBufferRows', 'sortTempDir', 'sortMethod', 'inputCacheDir', 'inputCacheMaxBytes',
+                         'sqliteOutput', 'partitionOutput', 'ioBufferSize', 'mmapThreshold', 'outputCompression',
+                         'errorReporting', 'errorSamples', 'rejectsFile', 'tenantField', 'tenantIdSeparator',
+                         'tenantOutput', 'summaryFile', 'engine', 'paymentRules', 'businessCalendar'):
+            setattr(self, attrName, getattr(template, attrName))
+        for modeType in self.paymentRules:
+            self.addRuleHandler(modeType)
+        self.shareDueDateTables(template)
+        self.rejectReport = RejectReport(self.errorSamples, self.rejectsFile)
+
+        if template.tenantWorkers is not None:
+            self.tenantWorkers = {}
+            for tenantKey, tenantTemplate in template.tenantWorkers.items():
+                tenantWorker = Fatturazione(self.inputFile, None, self.logger)
+                tenantWorker.copyConfig(tenantTemplate)
+                tenantWorker.rejectReport = self.rejectReport
+                tenantWorker.modeCounts = self.modeCounts
+                self.tenantWorkers[tenantKey] = tenantWorker
+            self.parseLine = self.parseTenantLine
+
+
+    # Split tenant output is only written by run(), the streaming, parallel and incremental runs write merged output
+    def mergeTenantOutput(self):
+
+        if self.tenantOutput == 'split':
+            self.logger.info('Split tenant output is only supported by run(), writing a merged output file')
+            self.tenantOutput = 'merged'
+            self.cfgData = dict(self.cfgData, tenantOutput='merged')
+
+
+    # Adds a payment mode defined by a config rule, it can also replace one of the built in modes. When the config
+    # has no validModes the rule modes are valid, otherwise they must be listed there like the built in ones
+    def addPaymentRule(self, modeType, rule):
+
+        self.paymentRules[modeType] = rule
+        self.dueDateTable.computeFuncs[modeType] = self.compilePaymentRule(modeType, rule)
+        self.addRuleHandler(modeType)
+        if 'validModes' not in self.cfgData and modeType not in self.validModes:
+            self.validModes = self.validModes + [modeType]
+
+    # Adds the funcPointer handler of a rule mode, the rule itself is already compiled in the due date table
+    def addRuleHandler(self, modeType):
+
+        # same work as dffmHandler: one table lookup per row
+        def ruleHandler(line):
+            newDate = self.dueDateTable.lookup(line[self.dateField], modeType)
+            self.outputData.append([line[self.idField], line[self.dateField], newDate])
+
+        self.funcPointer[modeType] = ruleHandler
+        # the columnar engine goes through the handler
+        self.columnPointer.pop(modeType, None)
+
+
+    # Compiles a payment rule into the function from an invoice date string to its DSP string. A rule is a dict:
+    #   base      'DF' starts from the invoice date, 'DFFM' from the end of its month (default 'DF')
+    #   months    months added to the base; from 'DFFM' the DSP is the end of the month reached
+    #   overflow  when the day does not exist in the month reached: 'clamp' to its last day (default), 'roll' the
+    #             extra days into the next month, or a number of days added to the invoice date instead, as DF60
+    #   days      days added at the end
+    # For example DF60 is {"months": 2, "overflow": 60} and "end of month then +10 days" {"base": "DFFM", "days": 10}
+    def compilePaymentRule(self, modeType, rule):
+
+        unknownKeys = set(rule) - set(['base', 'months', 'overflow', 'days'])
+        if unknownKeys:
+            raise ValueError('Invalid payment rule {}: unknown keys {}'.format(modeType, sorted(unknownKeys)))
+
+        base = rule.get('base', 'DF')
+        months = int(rule.get('months', 0))
+        overflow = rule.get('overflow', 'clamp')
+        days = datetime.timedelta(days=int(rule.get('days', 0)))
+        if base not in ('DF', 'DFFM'):
+            raise ValueError('Invalid payment rule {}: unknown base {}'.format(modeType, base))
+        if overflow not in ('clamp', 'roll'):
+            if isinstance(overflow, bool) or not isinstance(overflow, int):
+                raise ValueError('Invalid payment rule {}: unknown overflow {}'.format(modeType, overflow))
+            overflow = datetime.timedelta(days=overflow)
+
+        def computeDueDate(dateStr):
+            invoiceDate = datetime.datetime.strptime(dateStr, '%Y-%m-%d').date()
+            year, month = divmod(invoiceDate.year * 12 + invoiceDate.month - 1 + months, 12)
+            month += 1
+            lastDay = monthrange(year, month)[1]
+
+            if base == 'DFFM':
+                dueDate = datetime.date(year, month, lastDay)
+            elif invoiceDate.day <= lastDay:
+                dueDate = datetime.date(year, month, invoiceDate.day)
+            elif overflow == 'clamp':
+                dueDate = datetime.date(year, month, lastDay)
+            elif overflow == 'roll':
+                dueDate = datetime.date(year, month, lastDay) + datetime.timedelta(days=invoiceDate.day - lastDay)
+            else:
+                dueDate = invoiceDate + overflow
+
+            return (dueDate + days).isoformat()
+
+        return computeDueDate
+
+
     # Opens input file and saves it to local variable
     def openInputFile(self):
 
@@ -136,68 +1370,763 @@ class Fatturazione:
             # Open file as dictionary
             # Note: A list could use less memory but a dictionary is more useful
             # if we add a new column. Also the code is more readable.
-            self.csvFile = open(self.inputFile)
-            fileHandler = csv.DictReader(self.csvFile, delimiter=self.csvDelimiter)
-            self.inputData = [row for row in fileHandler]
+            if self.inputCacheDir and self.loadInputCache():
+                return
+
+            # the cache key is the hash of the content parsed here, taken while reading it
+            contentHash = None
+            if self.inputCacheDir and fileCompression(self.inputFile) is None and os.path.getsize(self.inputFile) > 0:
+                contentHash = fatturazione_cache.newContentHash()
+                self.csvFile = MappedFile(self.inputFile, max(self.ioBufferSize, io.DEFAULT_BUFFER_SIZE), contentHash)
+            else:
+                self.csvFile = openCsvInput(self.inputFile, self.ioBufferSize, self.mmapThreshold)
+            if self.engine == 'compact':
+                # plain lists, the fields are found by column index
+                fileHandler = csv.reader(self.csvFile, delimiter=self.csvDelimiter)
+                self.fileCols = next(fileHandler, None)
+                self.inputData = [row for row in fileHandler if row]
+            else:
+                fileHandler = csv.DictReader(self.csvFile, delimiter=self.csvDelimiter)
+                self.inputData = [row for row in fileHandler]
+                # extract columns
+                self.fileCols = fileHandler.fieldnames
 
             # check for empty file
+            self.rowCount = len(self.inputData)
             if len(self.inputData) == 0:
                 self.error = {'error': 'Empty file'}
 
-            # extract columns
-            self.fileCols = fileHandler.fieldnames
-
             # Close file
             self.csvFile.close()
+
+            if self.inputCacheDir and self.error is None:
+                self.saveInputCache(contentHash.hexdigest() if contentHash is not None else None)
         except Exception as e:
             # handle unexpected script errors
             exc_type, exc_obj, exc_tb = sys.exc_info()
             self.errorHandler(e, 'openInputFile()', exc_tb.tb_lineno)
 
 
+    # Fills inputData from the input cache, returns False if the input file is not cached or changed since.
+    # Rows are rebuilt as the engine reads them: tuples for the compact engine, dicts for the others
+    def loadInputCache(self):
+
+        try:
+            inputCache = fatturazione_cache.InputCache(self.inputCacheDir, self.inputCacheMaxBytes)
+            cachedColumns = inputCache.load(self.inputFile, (self.idField, self.dateField, self.modeField),
+                                            self.csvDelimiter)
+        except Exception as e:
+            self.logger.warning('Input cache not readable, parsing the input file: {}'.format(e))
+            return False
+        if cachedColumns is None:
+            return False
+
+        fileCols, ids, dates, modes = cachedColumns
+        columns = {self.idField: ids, self.dateField: dates, self.modeField: modes}
+        inputRows = zip(*[columns[fileCol] for fileCol in fileCols])
+        if self.engine == 'compact':
+            self.inputData = list(inputRows)
+        else:
+            self.inputData = [dict(zip(fileCols, inputRow)) for inputRow in inputRows]
+        self.fileCols = fileCols
+        self.rowCount = len(self.inputData)
+        self.inputCacheHit = True
+        self.logger.info('Input file read from cache, {} rows'.format(self.rowCount))
+        return True
+
+
+    # Saves the id, date and mode columns of inputData in the input cache. Only files with exactly these columns
+    # and no missing fields are cached, so the cached rows are the same as the parsed ones. contentHash is the hash
+    # of the parsed content, None to hash the file again
+    def saveInputCache(self, contentHash=None):
+
+        fieldNames = [self.idField, self.dateField, self.modeField]
+        if sorted(self.fileCols) != sorted(fieldNames):
+            return
+
+        if self.engine == 'compact':
+            fieldIndexes = [self.fileCols.index(fieldName) for fieldName in fieldNames]
+            if any(len(inputRow) != len(self.fileCols) for inputRow in self.inputData):
+                return
+            columns = [[inputRow[fieldIndex] for inputRow in self.inputData] for fieldIndex in fieldIndexes]
+        else:
+            columns = [[inputRow[fieldName] for inputRow in self.inputData] for fieldName in fieldNames]
+            if any(None in column for column in columns):
+                return
+
+        try:
+            inputCache = fatturazione_cache.InputCache(self.inputCacheDir, self.inputCacheMaxBytes)
+            inputCache.save(self.inputFile, fieldNames, self.csvDelimiter, self.fileCols, *columns,
+                            contentHash=contentHash)
+        except Exception as e:
+            self.logger.warning('Input file not cached: {}'.format(e))
+
+
+    # Opens the input file and returns a row iterator, the header is read immediately to check the columns.
+    # Rows are dicts, or plain lists with compactRows
+    def openInputStream(self, compactRows=False):
+
+        try:
+            self.csvFile = openCsvInput(self.inputFile, self.ioBufferSize, self.mmapThreshold)
+            if compactRows:
+                fileHandler = csv.reader(self.csvFile, delimiter=self.csvDelimiter)
+                self.fileCols = next(fileHandler, None)
+            else:
+                fileHandler = csv.DictReader(self.csvFile, delimiter=self.csvDelimiter)
+                # extract columns
+                self.fileCols = fileHandler.fieldnames
+            if self.fileCols is None:
+                self.csvFile.close()
+                self.error = {'error': 'Empty file'}
+                return None
+
+            return self.readInputStream(fileHandler)
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'openInputStream()', exc_tb.tb_lineno)
+
+
+    # Reads the header of the input file and splits the rest of the file into (start, end) byte ranges aligned
+    # to the beginning of a line, at most one per worker
+    def splitInputFile(self, workers):
+
+        try:
+            with open(self.inputFile, 'rb') as inputFile:
+                headerLine = inputFile.readline()
+                if not headerLine.strip():
+                    self.error = {'error': 'Empty file'}
+                    return None
+
+                # extract columns
+                self.fileCols = next(csv.reader(self.decodeLines([headerLine]), delimiter=self.csvDelimiter))
+
+                dataStart = inputFile.tell()
+                fileSize = os.path.getsize(self.inputFile)
+                rangeSize = (fileSize - dataStart) // workers
+
+                # move every boundary to the beginning of the next line
+                boundaries = [dataStart]
+                for worker in range(1, workers):
+                    inputFile.seek(max(dataStart + worker * rangeSize - 1, boundaries[-1]))
+                    inputFile.readline()
+                    boundaries.append(min(inputFile.tell(), fileSize))
+                boundaries.append(fileSize)
+
+            return [(rangeStart, rangeEnd) for rangeStart, rangeEnd in zip(boundaries, boundaries[1:])
+                    if rangeStart < rangeEnd]
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'splitInputFile()', exc_tb.tb_lineno)
+
+
+    # Yields the lines of a byte range of the input file
+    def readInputRange(self, rangeStart, rangeEnd):
+
+        with open(self.inputFile, 'rb') as inputFile:
+            inputFile.seek(rangeStart)
+            position = rangeStart
+            lines = []
+            while position < rangeEnd:
+                line = inputFile.readline()
+                if not line:
+                    break
+                position += len(line)
+                lines.append(line)
+                if len(lines) == 4096:
+                    for decodedLine in self.decodeLines(lines):
+                        yield decodedLine
+                    lines = []
+            for decodedLine in self.decodeLines(lines):
+                yield decodedLine
+
+
+    # Binary lines read from the input file to the str the csv module expects, like open() does
+    def decodeLines(self, lines):
+
+        if sys.version_info[0] < 3:
+            return lines
+        encoding = locale.getpreferredencoding(False)
+        return [line.decode(encoding) for line in lines]
+
+
+    # Hash of the input columns of a row, used by the incremental run to find the changed rows
+    def rowDigest(self, singleLine):
+
+        rowStr = '\x1f'.join([singleLine[col] for col in self.inputCols])
+        if sys.version_info[0] >= 3:
+            rowStr = rowStr.encode('utf-8')
+        return hashlib.md5(rowStr).digest()
+
+
+    # Loads the index of the previous incremental run, None if there is no index
+    def loadRunIndex(self, indexFileName):
+
+        if not os.path.exists(indexFileName):
+            return None
+        with open(indexFileName, 'rb') as indexFile:
+            return marshal.load(indexFile)
+
+
+    # Saves the index of the incremental run, through a temp file so a failure keeps the previous index
+    def saveRunIndex(self, indexFileName, runIndex):
+
+        with open(indexFileName + '.tmp', 'wb') as indexFile:
+            marshal.dump(runIndex, indexFile)
+        if os.path.exists(indexFileName):
+            os.remove(indexFileName)
+        os.rename(indexFileName + '.tmp', indexFileName)
+
+
+    # Yields the rows of a previous output file whose id is in keepIds, they are already sorted by DSP
+    def readPreviousOutput(self, outputFileName, keepIds):
+
+        outputFile = openCsvInput(outputFileName, self.ioBufferSize)
+        try:
+            outputRows = csv.reader(outputFile, delimiter=self.csvDelimiter)
+            # skip header
+            next(outputRows, None)
+            for outputRow in outputRows:
+                if outputRow[0] in keepIds:
+                    yield outputRow
+        finally:
+            outputFile.close()
+
+
+    # Yields the rows of the input file and closes it once exhausted
+    def readInputStream(self, fileHandler):
+
+        try:
+            for row in fileHandler:
+                yield row
+        finally:
+            self.csvFile.close()
+
+
+    # Generator version of parseInput(), yields the output rows produced by the handlers for each input row
+    def parseStream(self, inputRows):
+
+        try:
+            if not self.checkInputCols():
+                return
+
+            self.mergeTenantOutput()
+
+            if self.engine == 'compact':
+                for outputLine in self.parseCompactRows(inputRows, countRows=True):
+                    yield outputLine
+                return
+
+            # the handlers append to outputData, which here only buffers the rows of the current line
+            self.outputData = []
+            for singleLine in inputRows:
+                self.rowCount += 1
+                self.parseLine(singleLine)
+                for outputLine in self.outputData:
+                    yield outputLine
+                del self.outputData[:]
+
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'parseStream()', exc_tb.tb_lineno)
+
+
     # Parses the input data after the file has been loaded into a dict
     def parseInput(self):
 
         try:
-            # check if file has the correct input columns
-            checkInputColsResult = sorted(self.inputCols) == sorted(self.fileCols)
-
             # if the column name are as expected from the config file
-            if checkInputColsResult:
+            if self.checkInputCols():
 
                 # iterate through lines
                 for singleLine in self.inputData:
+                    self.parseLine(singleLine)
 
-                    # check for correct/valid date format
-                    if self.checkDate(singleLine[self.dateField]):
-
-                        # Try to determine type
-                        modeType = singleLine[self.modeField]
-                        # find the handler function, if it's valid
-                        if modeType in self.funcPointer and modeType in self.validModes :
-                            handlerFunc = self.funcPointer[modeType]
-                            handlerFunc(singleLine)
-                        else:   # else write error line
-                            errorMessage = 'Invalid Mode at ID {}: {}'.format(singleLine[self.idField], modeType)
-                            self.logger.error(errorMessage)
-                            errorLine = [singleLine[self.idField], singleLine[self.dateField], errorMessage]
-                            self.outputData.append(errorLine)
-
-                    else:   # else write error line
-                        errorMessage = 'Invalid Date at ID {}: {}'.format(singleLine[self.idField], singleLine[self.dateField])
-                        self.logger.error(errorMessage)
-                        errorLine = [singleLine[self.idField], singleLine[self.dateField], errorMessage]
-                        self.outputData.append(errorLine)
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'parseInput()', exc_tb.tb_lineno)
+
+
+    # Compact version of parseInput(): the rows are lists read by csv.reader, the output rows are tuples
+    def parseInputCompact(self):
 
-            else:   # wrong columns
-                errorMessage = 'Invalid CSV Columns: {}'.format(self.fileCols)
-                self.logger.error(errorMessage)
-                self.error = {'error': errorMessage}
+        try:
+            if self.checkInputCols():
+                self.outputData = list(self.parseCompactRows(self.inputData))
 
         except Exception as e:
             # handle unexpected script errors
             exc_type, exc_obj, exc_tb = sys.exc_info()
-            self.errorHandler(e, 'parseInput()', exc_tb.tb_lineno)
+            self.errorHandler(e, 'parseInputCompact()', exc_tb.tb_lineno)
+
+
+    # Yields the (id, date, DSP) output tuples of rows read as lists, same validation and DSP as parseLine().
+    # DF, DFFM and DF60 are computed in place, other modes go through their handler with the row as a dict
+    def parseCompactRows(self, inputRows, countRows=False):
+
+        # the fields are resolved to column indexes once, from the header
+        self.fieldIndexes = (self.fileCols.index(self.idField), self.fileCols.index(self.dateField),
+                             self.fileCols.index(self.modeField))
+        idIndex, dateIndex, modeIndex = self.fieldIndexes
+        colCount = len(self.fileCols)
+        isValid = self.dueDateTable.isValid
+        lookup = self.dueDateTable.lookup
+        modeCounts = self.modeCounts
+        fallbackDates = self.df60FallbackDates
+
+        # mode -> None for DF, the due date table mode for DFFM, DF60 and the payment rules, the handler for the
+        # others. Only the DF60 handler counts the DF + 60 days fallbacks
+        modeActions = {}
+        fallbackMode = None
+        for modeType in self.validModes:
+            handlerFunc = self.funcPointer.get(modeType)
+            if handlerFunc is None:
+                continue
+            if handlerFunc == self.dfHandler:
+                modeActions[modeType] = None if self.businessCalendar is None else 'DF'
+            elif handlerFunc == self.dffmHandler:
+                modeActions[modeType] = 'DFFM'
+            elif handlerFunc == self.df60Handler:
+                modeActions[modeType] = 'DF60'
+                fallbackMode = 'DF60'
+            elif modeType in self.paymentRules:
+                modeActions[modeType] = modeType
+            else:
+                modeActions[modeType] = handlerFunc
+
+        # the handlers append their output lines here
+        handlerBuffer = []
+        self.outputData = handlerBuffer
+
+        for row in inputRows:
+            if len(row) < colCount:
+                if not row:
+                    # blank line, skipped as DictReader does
+                    continue
+                row = list(row) + [None] * (colCount - len(row))
+            if countRows:
+                self.rowCount += 1
+
+            dateStr = row[dateIndex]
+            if not isValid(dateStr):
+                errorMessage = 'Invalid Date at ID {}: {}'.format(row[idIndex], dateStr)
+                self.reportReject(row[idIndex], dateStr, row[modeIndex], 'Invalid Date', errorMessage)
+                if not self.rejectsFile:
+                    yield (row[idIndex], dateStr, errorMessage)
+                continue
+
+            modeType = row[modeIndex]
+            try:
+                action = modeActions[modeType]
+            except KeyError:
+                errorMessage = 'Invalid Mode at ID {}: {}'.format(row[idIndex], modeType)
+                self.reportReject(row[idIndex], dateStr, modeType, 'Invalid Mode', errorMessage)
+                if not self.rejectsFile:
+                    yield (row[idIndex], dateStr, errorMessage)
+                continue
+
+            if action is None:
+                yield (row[idIndex], dateStr, dateStr)
+            elif not callable(action):
+                dueDate = lookup(dateStr, action)
+                if action == fallbackMode and dateStr in fallbackDates:
+                    self.df60FallbackCount += 1
+                yield (row[idIndex], dateStr, dueDate)
+            else:
+                action(dict(zip(self.fileCols, row)))
+                for outputLine in handlerBuffer:
+                    yield outputLine
+                del handlerBuffer[:]
+            modeCounts[modeType] = modeCounts.get(modeType, 0) + 1
+
+
+    # Columnar version of parseInput(): dates are parsed once into day ordinals, the rows are split by mode
+    # and the DSP is computed one mode column at a time. outputData becomes a ColumnarBatch
+    def parseInputColumnar(self):
+
+        try:
+            if not self.checkInputCols():
+                return
+
+            ids = []
+            dates = []
+            ordinals = array('l')
+            years = array('l')
+            months = array('l')
+            days = array('l')
+            modeRows = {}
+            dateInfo = {}
+
+            # Stage 3.1 - split the input into columns, every distinct date is parsed only once
+            for rowIndex, singleLine in enumerate(self.inputData):
+                dateStr = singleLine[self.dateField]
+                info = dateInfo.get(dateStr)
+                if info is None:
+                    info = self.parseDateInfo(dateStr)
+                    dateInfo[dateStr] = info
+
+                ids.append(singleLine[self.idField])
+                dates.append(dateStr)
+                ordinals.append(info[0])
+                years.append(info[1])
+                months.append(info[2])
+                days.append(info[3])
+
+                modeType = singleLine[self.modeField]
+                if modeType not in modeRows:
+                    modeRows[modeType] = array('l')
+                modeRows[modeType].append(rowIndex)
+
+            batch = ColumnarBatch(ids, dates)
+            errorLines = []
+
+            # Stage 3.2 - compute the DSP of each mode column
+            for modeType, rowIndexes in modeRows.items():
+                validMode = modeType in self.funcPointer and modeType in self.validModes
+                columnFunc = self.columnPointer.get(modeType) if validMode else None
+
+                columnRows = array('l')
+                for rowIndex in rowIndexes:
+                    if ordinals[rowIndex] < 0:
+                        errorMessage = 'Invalid Date at ID {}: {}'.format(ids[rowIndex], dates[rowIndex])
+                        errorLines.append((rowIndex, modeType, 'Invalid Date', errorMessage))
+                    elif not validMode:
+                        errorMessage = 'Invalid Mode at ID {}: {}'.format(ids[rowIndex], modeType)
+                        errorLines.append((rowIndex, modeType, 'Invalid Mode', errorMessage))
+                    elif columnFunc is None or ordinals[rowIndex] == 0:
+                        # no column function or non canonical date, use the row handler
+                        self.outputData = []
+                        self.funcPointer[modeType](self.inputData[rowIndex])
+                        batch.specialDueDates[rowIndex] = self.outputData[0][2]
+                        self.modeCounts[modeType] = self.modeCounts.get(modeType, 0) + 1
+                    else:
+                        columnRows.append(rowIndex)
+
+                if columnFunc is not None:
+                    columnFunc(columnRows, ordinals, years, months, days, batch.dueOrdinals)
+                    if self.businessCalendar is not None:
+                        self.businessCalendar.rollColumn(columnRows, batch.dueOrdinals)
+                    self.modeCounts[modeType] = self.modeCounts.get(modeType, 0) + len(columnRows)
+
+            # report the errors in input order, as the row engine does
+            errorLines.sort()
+            for rowIndex, modeType, reason, errorMessage in errorLines:
+                self.reportReject(ids[rowIndex], dates[rowIndex], modeType, reason, errorMessage)
+                batch.specialDueDates[rowIndex] = errorMessage
+            if self.rejectsFile:
+                batch.dropRows([errorLine[0] for errorLine in errorLines])
+
+            self.outputData = batch
+
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'parseInputColumnar()', exc_tb.tb_lineno)
+
+
+    # Returns (day ordinal, year, month, day) of a date string, the ordinal is -1 for invalid dates and 0 for
+    # valid dates not written as YYYY-MM-DD, since the DSP string could not be rebuilt from the ordinal
+    def parseDateInfo(self, dateStr):
+
+        if not self.checkDate(dateStr):
+            return (-1, 0, 0, 0)
+
+        dateValue = datetime.datetime.strptime(dateStr, '%Y-%m-%d').date()
+        if dateValue.isoformat() != dateStr:
+            return (0, 0, 0, 0)
+
+        return (dateValue.toordinal(), dateValue.year, dateValue.month, dateValue.day)
+
+
+    # Returns the (first day ordinal, number of days) of a month
+    def monthInfo(self, year, month):
+
+        key = year * 12 + month
+        info = self.monthTable.get(key)
+        if info is None:
+            info = (datetime.date(year, month, 1).toordinal(), monthrange(year, month)[1])
+            self.monthTable[key] = info
+        return info
+
+
+    # Column version of dfHandler, DSP is equal to DF
+    def dfColumn(self, rowIndexes, ordinals, years, months, days, dueOrdinals):
+
+        for rowIndex in rowIndexes:
+            dueOrdinals[rowIndex] = ordinals[rowIndex]
+
+
+    # Column version of dffmHandler, DSP is at the end of the month
+    def dffmColumn(self, rowIndexes, ordinals, years, months, days, dueOrdinals):
+
+        for rowIndex in rowIndexes:
+            firstDay, monthDays = self.monthInfo(years[rowIndex], months[rowIndex])
+            dueOrdinals[rowIndex] = firstDay + monthDays - 1
+
+
+    # Column version of df60Handler, DSP is DF + 2 months, or DF + 60 days if the day does not exist
+    def df60Column(self, rowIndexes, ordinals, years, months, days, dueOrdinals):
+
+        for rowIndex in rowIndexes:
+            year = years[rowIndex]
+            month = months[rowIndex] + 2
+            if month > 12:
+                year += 1
+                month -= 12
+
+            firstDay, monthDays = self.monthInfo(year, month)
+            if days[rowIndex] <= monthDays:
+                dueOrdinals[rowIndex] = firstDay + days[rowIndex] - 1
+            else:
+                dueOrdinals[rowIndex] = ordinals[rowIndex] + 60
+                self.df60FallbackCount += 1
+
+
+    # Checks if the file has the correct input columns, sets the error otherwise
+    def checkInputCols(self):
+
+        if sorted(self.inputCols) == sorted(self.fileCols):
+            return True
+
+        # wrong columns
+        errorMessage = 'Invalid CSV Columns: {}'.format(self.fileCols)
+        self.logger.error(errorMessage)
+        self.error = {'error': errorMessage}
+        return False
+
+
+    # parseLine() of multi tenant configs: the line goes to the worker of its tenant. With merged output the tenant
+    # appends to the output of this worker, with split output to its own
+    def parseTenantLine(self, singleLine):
+
+        if self.tenantField is not None:
+            tenantKey = singleLine[self.tenantField]
+        else:
+            tenantKey = singleLine[self.idField].split(self.tenantIdSeparator, 1)[0]
+
+        tenantWorker = self.tenantWorkers.get(tenantKey)
+        if tenantWorker is None:
+            errorMessage = 'Invalid Tenant at ID {}: {}'.format(singleLine[self.idField], tenantKey)
+            self.rejectLine(singleLine, 'Invalid Tenant', errorMessage)
+            return
+
+        if self.tenantOutput == 'merged':
+            tenantWorker.outputData = self.outputData
+        tenantWorker.parseLine(singleLine)
+
+
+    # Validates a single input line and dispatches it to its handler, the result is appended to the output
+    def parseLine(self, singleLine):
+
+        # check for correct/valid date format
+        if self.dueDateTable.isValid(singleLine[self.dateField]):
+
+            # Try to determine type
+            modeType = singleLine[self.modeField]
+            # find the handler function, if it's valid
+            if modeType in self.funcPointer and modeType in self.validModes :
+                handlerFunc = self.funcPointer[modeType]
+                handlerFunc(singleLine)
+                self.modeCounts[modeType] = self.modeCounts.get(modeType, 0) + 1
+            else:   # else write error line
+                errorMessage = 'Invalid Mode at ID {}: {}'.format(singleLine[self.idField], modeType)
+                self.rejectLine(singleLine, 'Invalid Mode', errorMessage)
+
+        else:   # else write error line
+            errorMessage = 'Invalid Date at ID {}: {}'.format(singleLine[self.idField], singleLine[self.dateField])
+            self.rejectLine(singleLine, 'Invalid Date', errorMessage)
+
+
+    # Reports a rejected input line, its error line goes to the output unless there is a rejects file
+    def rejectLine(self, singleLine, reason, errorMessage):
+
+        self.reportReject(singleLine[self.idField], singleLine[self.dateField], singleLine[self.modeField], reason,
+                          errorMessage)
+        if not self.rejectsFile:
+            errorLine = [singleLine[self.idField], singleLine[self.dateField], errorMessage]
+            self.outputData.append(errorLine)
+
+
+    # Adds a rejected row to the reject report, the row is logged right away only with errorReporting 'row'
+    def reportReject(self, rowId, dateStr, modeType, reason, errorMessage):
+
+        self.rejectReport.add(reason, errorMessage, [rowId, dateStr, modeType, errorMessage])
+        if self.errorReporting == 'row':
+            self.logger.error(errorMessage)
+
+
+    # Logs counts and samples of the rejected rows, with errorReporting 'aggregate'
+    def logRejects(self):
+
+        if self.errorReporting == 'aggregate':
+            self.rejectReport.logSummary(self.logger)
+
+
+    # Writes the rejected rows in one go to the rejects file, named as the output file with REJ_ instead of DSP_
+    def saveRejects(self):
+
+        if not self.rejectsFile or self.outputFileName is None:
+            return
+
+        try:
+            outputDir, outputName = os.path.split(self.outputFileName)
+            if outputName.startswith('DSP_'):
+                outputName = outputName[len('DSP_'):]
+            self.rejectsFileName = os.path.join(outputDir, 'REJ_' + outputName)
+
+            with openCsvOutput(self.rejectsFileName, self.ioBufferSize) as rejectsFile:
+                wr = csv.writer(rejectsFile, delimiter=self.csvDelimiter)
+                wr.writerow([self.idField, self.dateField, self.modeField, 'Errore'])
+                wr.writerows(self.rejectReport.rows)
+
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'saveRejects()', exc_tb.tb_lineno)
+
+
+    # Writes the summary file, named as the output file with SUM_ instead of DSP_ and a .json extension. Weeks are
+    # ISO weeks, added up from the counts of the distinct DSPs
+    def saveSummary(self):
+
+        if not self.summaryFile or self.outputFileName is None or self.error is not None:
+            return
+
+        try:
+            outputDir, outputName = os.path.split(self.outputFileName)
+            if outputName.startswith('DSP_'):
+                outputName = outputName[len('DSP_'):]
+            extensionStart = outputName.rfind('.csv')
+            if extensionStart < 0:
+                extensionStart = len(outputName)
+            self.summaryFileName = os.path.join(outputDir, 'SUM_' + outputName[:extensionStart] + '.json')
+
+            dueWeekCounts = {}
+            for dueDateStr, dueDateCount in self.dueDateCounts.items():
+                isoYear, isoWeek, isoDay = datetime.datetime.strptime(dueDateStr, '%Y-%m-%d').date().isocalendar()
+                dueWeek = '{:04d}-W{:02d}'.format(isoYear, isoWeek)
+                dueWeekCounts[dueWeek] = dueWeekCounts.get(dueWeek, 0) + dueDateCount
+
+            summary = {
+                'inputFile': self.inputFile,
+                'outputFile': self.outputFileName,
+                'rowsIn': self.rowCount,
+                'dueDates': self.dueDateCounts,
+                'dueWeeks': dueWeekCounts,
+                'modes': self.modeCounts,
+                'rejected': self.rejectReport.counts
+            }
+            with open(self.summaryFileName, 'w') as summaryFile:
+                summaryFile.write(json.dumps(summary, indent=2, sort_keys=True))
+
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'saveSummary()', exc_tb.tb_lineno)
+
+
+    # Runs a stage function and records its wall and cpu time in the metrics, returns the function result
+    def timeStage(self, stageName, stageFunc, *args):
+
+        wallStart = time.time()
+        cpuStart = cpuTime()
+        result = stageFunc(*args)
+        self.stageTimes[stageName] = {
+            'wallSeconds': time.time() - wallStart,
+            'cpuSeconds': cpuTime() - cpuStart
+        }
+        return result
+
+
+    # Adds wall and cpu seconds to a stage, for stages timed in many pieces or in the worker processes
+    def addStageTime(self, stageName, wallSeconds, cpuSeconds):
+
+        stageTimes = self.stageTimes.setdefault(stageName, {'wallSeconds': 0.0, 'cpuSeconds': 0.0})
+        stageTimes['wallSeconds'] += wallSeconds
+        stageTimes['cpuSeconds'] += cpuSeconds
+
+
+    # Adds the time of a stage run by a worker process: the workers run side by side within the parent parseInput,
+    # so the wall seconds are the ones of the slowest worker while the cpu seconds are summed over them
+    def addWorkerStageTime(self, stageName, wallSeconds, cpuSeconds):
+
+        stageTimes = self.stageTimes.setdefault(stageName, {'wallSeconds': 0.0, 'cpuSeconds': 0.0})
+        stageTimes['wallSeconds'] = max(stageTimes['wallSeconds'], wallSeconds)
+        stageTimes['cpuSeconds'] += cpuSeconds
+
+
+    # Returns the row counters, which can be summed over the workers of a parallel run
+    def getCounters(self):
+
+        return {
+            'rowsIn': self.rowCount,
+            'modes': dict(self.modeCounts),
+            'invalidDate': self.rejectReport.counts.get('Invalid Date', 0),
+            'invalidMode': self.rejectReport.counts.get('Invalid Mode', 0),
+            'invalidTenant': self.rejectReport.counts.get('Invalid Tenant', 0),
+            'df60Fallback': self.df60FallbackCount + sum(tenantWorker.df60FallbackCount
+                                                         for tenantWorker in (self.tenantWorkers or {}).values())
+        }
+
+
+    # Adds the counters of a worker to the ones of this instance, the invalid rows come with the worker reject report
+    def addCounters(self, counters):
+
+        self.rowCount += counters['rowsIn']
+        for modeType, modeCount in counters['modes'].items():
+            self.modeCounts[modeType] = self.modeCounts.get(modeType, 0) + modeCount
+        self.df60FallbackCount += counters['df60Fallback']
+
+
+    # Returns the metrics of the last run as a dict: stage timings, row counters and DSP table statistics
+    def getMetrics(self):
+
+        metrics = self.getCounters()
+        metrics['rowsOut'] = self.outputRowCount
+        metrics['stages'] = dict(self.stageTimes)
+        metrics['dueDateTable'] = self.dueDateTable.stats()
+        return metrics
+
+
+    # Writes the metrics to a json file, or to a Prometheus textfile if the name ends with .prom.
+    # The file is written through a temp name, so a collector never reads a partial file
+    def writeMetrics(self, fileName):
+
+        metrics = self.getMetrics()
+        if fileName.endswith('.prom'):
+            metricLines = []
+
+            def addMetric(name, helpStr, samples):
+                metricLines.append('# HELP fatturazione_{} {}'.format(name, helpStr))
+                metricLines.append('# TYPE fatturazione_{} gauge'.format(name))
+                for labels, value in samples:
+                    metricLines.append('fatturazione_{}{} {}'.format(name, labels, value))
+
+            stages = sorted(metrics['stages'].items())
+            addMetric('stage_wall_seconds', 'Wall time of the run stages.',
+                      [('{{stage="{}"}}'.format(stage), times['wallSeconds']) for stage, times in stages])
+            addMetric('stage_cpu_seconds', 'Cpu time of the run stages.',
+                      [('{{stage="{}"}}'.format(stage), times['cpuSeconds']) for stage, times in stages])
+            addMetric('rows_in', 'Input rows.', [('', metrics['rowsIn'])])
+            addMetric('rows_out', 'Output rows.', [('', metrics['rowsOut'])])
+            addMetric('mode_rows', 'Rows processed by each payment mode.',
+                      [('{{mode="{}"}}'.format(modeType), modeCount) for modeType, modeCount in sorted(metrics['modes'].items())])
+            addMetric('invalid_rows', 'Rows rejected by reason.',
+                      [('{reason="date"}', metrics['invalidDate']), ('{reason="mode"}', metrics['invalidMode']),
+                       ('{reason="tenant"}', metrics['invalidTenant'])])
+            addMetric('df60_fallback_rows', 'DF60 rows whose DSP is DF + 60 days.', [('', metrics['df60Fallback'])])
+            metricsStr = '\n'.join(metricLines) + '\n'
+        else:
+            metricsStr = json.dumps(metrics, indent=2, sort_keys=True)
+
+        with open(fileName + '.tmp', 'w') as metricsFile:
+            metricsFile.write(metricsStr)
+        if os.path.exists(fileName):
+            os.remove(fileName)
+        os.rename(fileName + '.tmp', fileName)
 
 
     # Error Exception handler
@@ -212,7 +2141,11 @@ class Fatturazione:
     # This handler DSP is equalt o DF
     def dfHandler(self, line):
 
-        tempOutputLine = [line[self.idField], line[self.dateField], line[self.dateField]]
+        newDate = line[self.dateField]
+        if self.businessCalendar is not None:
+            newDate = self.dueDateTable.lookup(newDate, 'DF')
+
+        tempOutputLine = [line[self.idField], line[self.dateField], newDate]
         # append to output
         self.outputData.append(tempOutputLine)
 
@@ -220,13 +2153,7 @@ class Fatturazione:
     # This handler DSP is at the end of the month
     def dffmHandler(self, line):
 
-        # calculate last day of the month thanks to the standard library calendar
-        dateFattura = line[self.dateField]
-        yearTemp = dateFattura.split('-')[0]
-        monthTemp = dateFattura.split('-')[1]
-
-        lastDay = monthrange(int(yearTemp), int(monthTemp))[1]
-        newDate = yearTemp + '-' + monthTemp + '-' + str(lastDay)
+        newDate = self.dueDateTable.lookup(line[self.dateField], 'DFFM')
 
         tempOutputLine = [line[self.idField], line[self.dateField], newDate]
         # append to output
@@ -236,13 +2163,26 @@ class Fatturazione:
     # This handler DSP is DF + 60 days
     def df60Handler(self, line):
 
-        newDateStr = self.addTwoMonthsToDate(line[self.dateField])
+        newDateStr = self.dueDateTable.lookup(line[self.dateField], 'DF60')
+        if line[self.dateField] in self.df60FallbackDates:
+            self.df60FallbackCount += 1
 
         tempOutputLine = [line[self.idField], line[self.dateField], newDateStr]
         # append to output
         self.outputData.append(tempOutputLine)
 
 
+    # This method returns the last day of the month of a date
+    def endOfMonth(self, inputDate):
+
+        # calculate last day of the month thanks to the standard library calendar
+        yearTemp = inputDate.split('-')[0]
+        monthTemp = inputDate.split('-')[1]
+
+        lastDay = monthrange(int(yearTemp), int(monthTemp))[1]
+        return yearTemp + '-' + monthTemp + '-' + str(lastDay)
+
+
     # This method adds two months to a date
     def addTwoMonthsToDate(self, inputDate):
 
@@ -268,6 +2208,7 @@ class Fatturazione:
         if self.checkDate(dateToReturn):
             return dateToReturn
         else:
+            self.df60FallbackDates.add(inputDate)
             dateTime = datetime.datetime.strptime(inputDate, '%Y-%m-%d')
             newDate = dateTime + datetime.timedelta(days=60)
             # datetime to string
@@ -283,34 +2224,472 @@ class Fatturazione:
             return False
 
 
-    # Save to file function, creates output file name based on input file name
+    # Save to file function, creates output file name based on input file name. The output must be already sorted
+    # by sortOutput()
     def saveToFile(self):
 
         try:
-            # create new file name for output by adding current datetime to input file name
-            nowDateTime = datetime.datetime.now()
-            nowDateTimeStr = nowDateTime.strftime('%Y-%m-%d_%H-%M-%S')
+            if self.outputFileName is None:
+                self.outputFileName = self.createOutputFileName()
 
-            self.outputFileName = 'DSP_' + self.inputFile.split('.')[0] + '_' + nowDateTimeStr + '.csv'
+            # write file
+            if self.tenantWorkers is not None and self.tenantOutput == 'split':
+                self.writeTenantOutput(self.outputFileName)
+            elif self.partitionOutput:
+                self.writePartitionedOutput(self.outputFileName, self.outputData)
+            else:
+                self.writeOutputFile(self.outputFileName, self.outputData)
 
-            # Sort output by DSP (Data Scadenza Pagamento)
-            self.sortOutput()
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'saveToFile()', exc_tb.tb_lineno)
 
-            # write file
-            with open(self.outputFileName, 'wb') as myfile:
+
+    # Creates the output file name by adding current datetime to input file name, in the input file folder
+    def createOutputFileName(self):
+
+        nowDateTime = datetime.datetime.now()
+        nowDateTimeStr = nowDateTime.strftime('%Y-%m-%d_%H-%M-%S')
+
+        inputDir, inputName = os.path.split(self.inputFile)
+        # only the compression and the last extension are dropped, 'ledger.north.csv' keeps 'ledger.north'
+        inputCompression = fileCompression(inputName)
+        if inputCompression:
+            inputName = inputName[:-len(inputCompression) - 1]
+        outputName = 'DSP_' + os.path.splitext(inputName)[0] + '_' + nowDateTimeStr + '.csv'
+        if self.outputCompression:
+            outputName += '.' + self.outputCompression
+        return os.path.join(inputDir, outputName)
+
+
+    # Writes the header and the (already sorted) output rows, rows can be any iterable. Rows are written in
+    # batches of 4096
+    def writeOutputFile(self, fileName, outputRows):
+
+        outputRows = iter(outputRows)
+        outputDatabase = self.openOutputDatabase()
+        try:
+            with openCsvOutput(fileName, self.ioBufferSize) as myfile:
                 wr = csv.writer(myfile, delimiter=self.csvDelimiter)
                 # write header, then data
                 wr.writerow(self.outputCols)
-                for singleRow in self.outputData:
-                    wr.writerow(singleRow)
+                while True:
+                    rowBatch = list(itertools.islice(outputRows, 4096))
+                    if not rowBatch:
+                        break
+                    wr.writerows(rowBatch)
+                    if outputDatabase is not None:
+                        self.upsertOutputRows(outputDatabase, rowBatch)
+                    if self.summaryFile:
+                        self.countDueDates(rowBatch)
+                    self.outputRowCount += len(rowBatch)
+            if outputDatabase is not None:
+                self.deleteRejectedRows(outputDatabase)
+        except Exception:
+            if outputDatabase is not None:
+                outputDatabase.close(commit=False)
+            raise
+        if outputDatabase is not None:
+            outputDatabase.close()
+
+    # Adds the DSPs of a batch of DSP sorted output rows to the summary counts. Error lines sort after all the dates,
+    # so a batch ending with a date has none
+    def countDueDates(self, rowBatch):
+
+        if not isErrorDueDate(rowBatch[-1][2]):
+            self.dueDateCounts.update(map(operator.itemgetter(2), rowBatch))
+        else:
+            self.dueDateCounts.update([outputRow[2] for outputRow in rowBatch if not isErrorDueDate(outputRow[2])])
+
+    # Opens the SQLite output database of the config, None if there is none
+    def openOutputDatabase(self):
+
+        if not self.sqliteOutput:
+            return None
+        return fatturazione_db.DspDatabase(self.sqliteOutput, self.inputFile)
+
+    # Upserts a batch of output rows into the database. Error lines are not stored, they delete the invoice instead,
+    # so it does not keep the DSP of a previous run
+    def upsertOutputRows(self, outputDatabase, outputRows):
+
+        errorIds = [outputRow[0] for outputRow in outputRows if isErrorDueDate(outputRow[2])]
+        if not errorIds:
+            outputDatabase.upsertRows(outputRows)
+            return
+        outputDatabase.upsertRows([outputRow for outputRow in outputRows if not isErrorDueDate(outputRow[2])])
+        outputDatabase.deleteRows(errorIds)
+
+    # Rows rejected to the rejects file are not in the output, their invoices are deleted from the database
+    def deleteRejectedRows(self, outputDatabase):
+
+        if self.rejectsFile:
+            outputDatabase.deleteRows([rejectRow[0] for rejectRow in self.rejectReport.rows])
+
+    # Writes the DSP sorted output rows into one file per DSP month or week, named as the output file plus the
+    # partition ('_2019-04' or '_2019-W14'). DSPs that are not dates go to the '_errors' file. Only the file of the
+    # current partition is open
+    def writePartitionedOutput(self, fileName, sortedRows):
+
+        outputDir, outputName = os.path.split(fileName)
+        extensionStart = outputName.rfind('.csv')
+        if extensionStart < 0:
+            extensionStart = len(outputName)
+
+        partitionCache = {}
+        writtenPartitions = set()
+        currentPartition = None
+        partitionFile = None
+        outputDatabase = self.openOutputDatabase()
+        databaseRows = []
+        committed = False
+        try:
+            for outputRow in sortedRows:
+                dueDateStr = outputRow[2]
+                partition = partitionCache.get(dueDateStr)
+                if partition is None:
+                    partition = self.dspPartition(dueDateStr)
+                    partitionCache[dueDateStr] = partition
+
+                # the rows come in DSP order, so a partition is done once the next one starts. DSPs not written as
+                # YYYY-MM-DD sort apart from the other dates of their month, their partition file is appended to
+                if partition != currentPartition:
+                    if partitionFile is not None:
+                        partitionFile.close()
+                        partitionFile = None
+                    partitionFileName = os.path.join(outputDir, outputName[:extensionStart] + '_' + partition +
+                                                     outputName[extensionStart:])
+                    if partition in writtenPartitions:
+                        partitionFile = openCsvOutput(partitionFileName, self.ioBufferSize, append=True)
+                        wr = csv.writer(partitionFile, delimiter=self.csvDelimiter)
+                    else:
+                        partitionFile = openCsvOutput(partitionFileName, self.ioBufferSize)
+                        self.partitionFileNames.append(partitionFileName)
+                        writtenPartitions.add(partition)
+                        wr = csv.writer(partitionFile, delimiter=self.csvDelimiter)
+                        wr.writerow(self.outputCols)
+                    currentPartition = partition
+
+                wr.writerow(outputRow)
+                self.outputRowCount += 1
+                if self.summaryFile and partition != 'errors':
+                    self.dueDateCounts[dueDateStr] += 1
+
+                if outputDatabase is not None:
+                    databaseRows.append(outputRow)
+                    if len(databaseRows) == 4096:
+                        self.upsertOutputRows(outputDatabase, databaseRows)
+                        databaseRows = []
+
+            if outputDatabase is not None:
+                self.upsertOutputRows(outputDatabase, databaseRows)
+                self.deleteRejectedRows(outputDatabase)
+                committed = True
+                outputDatabase.close()
+        finally:
+            if partitionFile is not None:
+                partitionFile.close()
+            if outputDatabase is not None and not committed:
+                outputDatabase.close(commit=False)
+
+    # Writes the DSP sorted output of every tenant to its own file, named as the output file plus the tenant key
+    # ('_ACME'). Rows of unknown tenants go to the '_errors' file, tenants without rows get no file
+    def writeTenantOutput(self, fileName):
+
+        outputDir, outputName = os.path.split(fileName)
+        extensionStart = outputName.rfind('.csv')
+        if extensionStart < 0:
+            extensionStart = len(outputName)
+
+        tenantOutputs = [(tenantKey, self.tenantWorkers[tenantKey]) for tenantKey in sorted(self.tenantWorkers)]
+        tenantOutputs.append(('errors', None))
+        for tenantKey, tenantWorker in tenantOutputs:
+            if tenantWorker is not None:
+                outputRows = tenantWorker.outputData
+            else:
+                outputRows = self.outputData
+            if not outputRows:
+                continue
+
+            tenantFileName = os.path.join(outputDir, outputName[:extensionStart] + '_' + tenantKey +
+                                          outputName[extensionStart:])
+            self.partitionFileNames.append(tenantFileName)
+            self.writeOutputFile(tenantFileName, outputRows)
+
+    # Returns the output partition of a DSP string, by month or ISO week
+    def dspPartition(self, dueDateStr):
+
+        if isErrorDueDate(dueDateStr):
+            return 'errors'
+        try:
+            dueDate = datetime.datetime.strptime(dueDateStr, '%Y-%m-%d').date()
+        except ValueError:
+            return 'errors'
+
+        if self.partitionOutput == 'week':
+            isoYear, isoWeek, isoDay = dueDate.isocalendar()
+            return '{:04d}-W{:02d}'.format(isoYear, isoWeek)
+        return '{:04d}-{:02d}'.format(dueDate.year, dueDate.month)
+
+    # Streaming version of saveToFile(), the output rows are sorted and written as they come
+    def saveStreamToFile(self, outputRows):
+        self.saveSortedStreamToFile(self.sortStream(outputRows))
+
+    # Writes rows that are already sorted by DSP, used by the streaming and the parallel run
+    def saveSortedStreamToFile(self, sortedRows):
+
+        try:
+            sortedRows = iter(sortedRows)
+
+            # the first row is pulled before creating the file, so parsing errors and empty files write nothing
+            firstRow = next(sortedRows, None)
+            if self.error is not None:
+                return
+            # with a rejects file all the rows can be rejected, the output then has just the header
+            if firstRow is None and self.rejectReport.total() == 0:
+                self.error = {'error': 'Empty file'}
+                return
+
+            if self.outputFileName is None:
+                self.outputFileName = self.createOutputFileName()
+            if firstRow is not None:
+                sortedRows = itertools.chain([firstRow], sortedRows)
+            if self.partitionOutput:
+                self.writePartitionedOutput(self.outputFileName, sortedRows)
+            else:
+                self.writeOutputFile(self.outputFileName, sortedRows)
 
         except Exception as e:
             # handle unexpected script errors
             exc_type, exc_obj, exc_tb = sys.exc_info()
-            self.errorHandler(e, 'saveToFile()', exc_tb.tb_lineno)
+            self.errorHandler(e, 'saveSortedStreamToFile()', exc_tb.tb_lineno)
 
-    # This method sorts output by DPS (Data Scadenza Pagamento)
+    # This method sorts output by DPS (Data Scadenza Pagamento). With split tenant output the rows of every tenant
+    # are sorted too
     def sortOutput(self):
+        if self.tenantWorkers is not None and self.tenantOutput == 'split':
+            for tenantWorker in self.tenantWorkers.values():
+                tenantWorker.sortOutput()
+        if isinstance(self.outputData, ColumnarBatch):
+            self.outputData.sortByDsp()
+            return
+        if self.sortMethod == 'bucket':
+            self.outputData[:] = self.orderByDsp(self.outputData)
+            return
         # x[2] represents the dps field, and it's used as a key to sort the two-dimensional array
         self.outputData.sort(key = lambda x: x[2])
 
+    # Returns an iterator over the output rows in DSP order, as the stable sort on the DSP. Rows are grouped by DSP
+    # in a single pass, then the groups are walked in DSP order
+    def orderByDsp(self, outputRows):
+        buckets = self.groupByDsp(outputRows)
+        return itertools.chain.from_iterable(map(buckets.__getitem__, orderDueDates(buckets)))
+
+    # Returns a dict of DSP to the list of its rows, rows keep their order inside a group
+    def groupByDsp(self, outputRows):
+        buckets = {}
+        for outputRow in outputRows:
+            bucket = buckets.get(outputRow[2])
+            if bucket is None:
+                buckets[outputRow[2]] = [outputRow]
+            else:
+                bucket.append(outputRow)
+        return buckets
+
+    # Returns an iterator over the output rows sorted by DSP, same ordering as sortOutput().
+    # Rows are sorted in runs of sortBufferRows, the runs are spilled to temp files and merged back
+    def sortStream(self, outputRows):
+        sortedRuns = self.spillSortedRuns(outputRows)
+        return self.mergeSortedRuns(sortedRuns)
+
+    # Sorts the output rows in runs of sortBufferRows rows. Every full run is written to a temp file and
+    # returned as its path, the last run is kept in memory unless spillAll is set
+    def spillSortedRuns(self, outputRows, spillAll=False):
+
+        sortedRuns = []
+        outputRows = iter(outputRows)
+        while True:
+            runRows = list(itertools.islice(outputRows, self.sortBufferRows))
+            if self.sortMethod == 'bucket':
+                runRows = list(self.orderByDsp(runRows))
+            else:
+                runRows.sort(key = lambda x: x[2])
+
+            if len(runRows) < self.sortBufferRows and not spillAll:
+                # last run, no need to spill it
+                sortedRuns.append(runRows)
+                return sortedRuns
+            if len(runRows) == 0:
+                return sortedRuns
+
+            sortedRuns.append(self.writeSortedRun(runRows))
+
+    # Writes a sorted run to a temp file and returns the file path
+    def writeSortedRun(self, runRows):
+
+        fileDescriptor, runFileName = tempfile.mkstemp(prefix='DSP_run_', suffix='.tmp', dir=self.sortTempDir)
+        with os.fdopen(fileDescriptor, 'wb') as runFile:
+            # rows are dumped in blocks, one marshal call per row is much slower
+            for blockStart in range(0, len(runRows), 4096):
+                marshal.dump(runRows[blockStart:blockStart + 4096], runFile)
+
+        return runFileName
+
+    # Yields the rows of a run written by writeSortedRun()
+    def readSortedRun(self, runFileName):
+
+        with open(runFileName, 'rb') as runFile:
+            while True:
+                try:
+                    runBlock = marshal.load(runFile)
+                except EOFError:
+                    return
+                for singleRow in runBlock:
+                    yield singleRow
+
+    # Groups the output rows by DSP in runs of sortBufferRows rows, every run is written to a temp file as blocks
+    # of rows with the same DSP, in DSP order. Returns the paths of the runs. The workers of runParallel() and
+    # runBatch() spill their rows this way: the main process merges a block at a time, and unless it needs the
+    # rows the blocks are already CSV text, so it only copies them to the output file
+    def spillGroupedRuns(self, outputRows):
+
+        encodeRows = self.encodesGroupedRuns()
+        groupedRuns = []
+        outputRows = iter(outputRows)
+        while True:
+            runRows = list(itertools.islice(outputRows, self.sortBufferRows))
+            if len(runRows) == 0:
+                return groupedRuns
+            wallStart = time.time()
+            cpuStart = cpuTime()
+            groupedRuns.append(self.writeGroupedRun(self.groupByDsp(runRows), encodeRows))
+            self.addStageTime('sortOutput', time.time() - wallStart, cpuTime() - cpuStart)
+
+    # Grouped runs hold CSV text, except for partitioned or SQLite output which need the rows
+    def encodesGroupedRuns(self):
+        return not (self.partitionOutput or self.sqliteOutput)
+
+    # Writes the DSP groups to a temp file as (DSP, row count, rows or CSV text) blocks of at most 4096 rows,
+    # returns the file path. Error lines have a DSP of their own, so the blocks are dumped in chunks of about
+    # 4096 rows
+    def writeGroupedRun(self, buckets, encodeRows):
+
+        textBuffer = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        wr = csv.writer(textBuffer, delimiter=self.csvDelimiter)
+        fileDescriptor, runFileName = tempfile.mkstemp(prefix='DSP_run_', suffix='.tmp', dir=self.sortTempDir)
+        with os.fdopen(fileDescriptor, 'wb') as runFile:
+            runChunk = []
+            chunkRows = 0
+            for dueDate in orderDueDates(buckets):
+                bucket = buckets[dueDate]
+                for blockStart in range(0, len(bucket), 4096):
+                    blockRows = bucket[blockStart:blockStart + 4096]
+                    if encodeRows:
+                        wr.writerows(blockRows)
+                        runChunk.append((dueDate, len(blockRows), textBuffer.getvalue()))
+                        textBuffer.seek(0)
+                        textBuffer.truncate()
+                    else:
+                        runChunk.append((dueDate, len(blockRows), blockRows))
+                    chunkRows += len(blockRows)
+                    if chunkRows >= 4096:
+                        marshal.dump(runChunk, runFile)
+                        runChunk = []
+                        chunkRows = 0
+            if runChunk:
+                marshal.dump(runChunk, runFile)
+
+        return runFileName
+
+    # Yields the blocks of a run written by writeGroupedRun() as (DSP, run index, block index, row count, block)
+    def readGroupedRun(self, runFileName, runIndex):
+
+        with open(runFileName, 'rb') as runFile:
+            blockIndex = 0
+            while True:
+                try:
+                    runChunk = marshal.load(runFile)
+                except EOFError:
+                    return
+                for dueDate, rowCount, blockData in runChunk:
+                    yield (dueDate, runIndex, blockIndex, rowCount, blockData)
+                    blockIndex += 1
+
+    # K-way merge of the runs written by spillGroupedRuns(), yields their (DSP, row count, block) blocks. Blocks are
+    # merged on the DSP and then on the run index, so the rows come out in the order of mergeSortedRuns()
+    def mergeGroupedRuns(self, groupedRuns):
+
+        try:
+            blockIterators = [self.readGroupedRun(runFileName, runIndex)
+                              for runIndex, runFileName in enumerate(groupedRuns)]
+            for mergedBlock in heapq.merge(*blockIterators):
+                yield mergedBlock[0], mergedBlock[3], mergedBlock[4]
+
+        finally:
+            # remove the spilled runs
+            for runFileName in groupedRuns:
+                if os.path.exists(runFileName):
+                    os.remove(runFileName)
+
+    # Writes the output file from the runs of spillGroupedRuns(). CSV text blocks are copied to the file, the
+    # summary counts are taken from the block DSP and row count. Row blocks are written by saveSortedStreamToFile()
+    def saveGroupedRunsToFile(self, groupedRuns):
+
+        mergedBlocks = self.mergeGroupedRuns(groupedRuns)
+        if not self.encodesGroupedRuns():
+            self.saveSortedStreamToFile(itertools.chain.from_iterable(
+                mergedBlock[2] for mergedBlock in mergedBlocks))
+            return
+
+        try:
+            # the first block is read before creating the file, so empty files write nothing
+            firstBlock = next(mergedBlocks, None)
+            if firstBlock is None and self.rejectReport.total() == 0:
+                self.error = {'error': 'Empty file'}
+                return
+
+            if self.outputFileName is None:
+                self.outputFileName = self.createOutputFileName()
+            if firstBlock is not None:
+                mergedBlocks = itertools.chain([firstBlock], mergedBlocks)
+            with openCsvOutput(self.outputFileName, self.ioBufferSize) as myfile:
+                wr = csv.writer(myfile, delimiter=self.csvDelimiter)
+                wr.writerow(self.outputCols)
+                for dueDate, rowCount, blockText in mergedBlocks:
+                    myfile.write(blockText)
+                    if self.summaryFile and not isErrorDueDate(dueDate):
+                        self.dueDateCounts[dueDate] += rowCount
+                    self.outputRowCount += rowCount
+
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.errorHandler(e, 'saveGroupedRunsToFile()', exc_tb.tb_lineno)
+
+    # Yields the rows of a run as (DSP, run index, row index, row) tuples, the merge key
+    def decorateSortedRun(self, runRows, runIndex):
+        for rowIndex, row in enumerate(runRows):
+            yield (row[2], runIndex, rowIndex, row)
+
+    # K-way merge of the sorted runs, a run is either the path of a spilled run or an iterable of sorted rows.
+    # Ties are broken on the run index and then on the row position, which keeps the sort stable
+    def mergeSortedRuns(self, sortedRuns):
+
+        try:
+            runIterators = []
+            for runIndex, sortedRun in enumerate(sortedRuns):
+                if isinstance(sortedRun, fileNameTypes):
+                    runRows = self.readSortedRun(sortedRun)
+                else:
+                    runRows = iter(sortedRun)
+                runIterators.append(self.decorateSortedRun(runRows, runIndex))
+
+            for mergedRow in heapq.merge(*runIterators):
+                yield mergedRow[3]
+
+        finally:
+            # remove the spilled runs
+            for sortedRun in sortedRuns:
+                if isinstance(sortedRun, fileNameTypes) and os.path.exists(sortedRun):
+                    os.remove(sortedRun)
+
@@ -0,0 +1,136 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_api.py                         #
+# File Desc: in-process DSP API over row iterables  #
+#####################################################
+
+import sys
+import logging
+import operator
+import itertools
+import fatturazione
+
+# used when the caller does not pass a logger, messages are discarded
+apiLogger = logging.getLogger('fatturazione_api')
+apiLogger.addHandler(logging.NullHandler())
+
+
+# Computes the DSP of rows already in memory, nothing is read from or written to disk. The config is a dict with the
+# keys of conf_fatturazione.json, the file related ones (sqliteOutput, partitionOutput, inputCacheDir, ...) are
+# ignored. The DSP table is kept between calls, every call gets its own worker so calls can run in threads
+class DspEngine:
+
+    def __init__(self, cfgData=None, logger=None):
+        self.logger = logger if logger is not None else apiLogger
+
+        self.template = fatturazione.Fatturazione(None, None, self.logger)
+        self.template.applyCfgData(cfgData or {})
+
+    # Returns a new worker with the engine config, copied from the template without compiling it again
+    def createWorker(self):
+
+        worker = fatturazione.Fatturazione(None, None, self.logger)
+        worker.copyConfig(self.template)
+        return worker
+
+    # Returns a DspResult over the rows, computed lazily while it is iterated. Rows are dicts keyed by the input
+    # columns, or tuples/lists in the order of fileCols (the config inputCols by default). With sortOutput the rows
+    # are returned in DSP order, which means they are all computed before the first one is returned
+    def computeDsp(self, rows, fileCols=None, sortOutput=False):
+
+        worker = self.createWorker()
+        return DspResult(worker, rows, fileCols, sortOutput)
+
+
+# Output of DspEngine.computeDsp(), an iterable of (id, date, DSP) tuples. Rejected rows are (id, date, error message)
+# tuples as in the output file, or with "rejectsFile": true they are left out and listed by getRejects() as
+# [id, date, mode, error message]. The rejects, counters and error are complete once the rows have been iterated
+class DspResult:
+
+    def __init__(self, worker, rows, fileCols, sortOutput):
+        self.worker = worker
+        self.rows = rows
+        self.fileCols = fileCols
+        self.sortOutput = sortOutput
+        self.consumed = False
+
+    def __iter__(self):
+
+        if self.consumed:
+            raise RuntimeError('DSP result already iterated')
+        self.consumed = True
+
+        outputRows = self.computeRows()
+        if self.sortOutput:
+            outputRows = self.sortRows(outputRows)
+        return outputRows
+
+    # Yields the output tuples of the rows, the row type is taken from the first row
+    def computeRows(self):
+
+        worker = self.worker
+        inputRows = iter(self.rows)
+        firstRow = next(inputRows, None)
+        if firstRow is not None:
+            worker.fileCols = list(self.fileCols if self.fileCols is not None else worker.inputCols)
+            inputRows = itertools.chain([firstRow], inputRows)
+
+            if isinstance(firstRow, dict) or worker.tenantWorkers is not None:
+                # dict rows go through parseLine(), whose handlers write lists. Tenant configs route dict rows only
+                if not isinstance(firstRow, dict):
+                    inputRows = (dict(zip(worker.fileCols, inputRow)) for inputRow in inputRows)
+                worker.engine = 'row'
+                for outputLine in worker.parseStream(inputRows):
+                    yield tuple(outputLine)
+            else:
+                worker.engine = 'compact'
+                for outputLine in worker.parseStream(inputRows):
+                    yield outputLine
+
+        worker.logRejects()
+
+    # Returns the output rows in DSP order, with the sort method of the config
+    def sortRows(self, outputRows):
+
+        try:
+            if self.worker.sortMethod == 'bucket':
+                return self.worker.orderByDsp(outputRows)
+            return iter(sorted(outputRows, key=operator.itemgetter(2)))
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            self.worker.errorHandler(e, 'sortRows()', exc_tb.tb_lineno)
+            return iter([])
+
+    # Returns the output rows as a list
+    def toList(self):
+
+        return list(self)
+
+    # Returns the rejected rows, listed only with "rejectsFile": true
+    def getRejects(self):
+
+        return self.worker.rejectReport.rows
+
+    # Returns the error, None if there was none
+    def getError(self):
+
+        return self.worker.error
+
+    # Returns the row counters, as written by run() in the metrics file
+    def getCounters(self):
+
+        return self.worker.getCounters()
+
+
+# Computes the DSP of the rows with a one-off engine, see DspEngine.computeDsp(). Returns the list of output rows
+# and the error, None if there was none. Callers with many batches should keep a DspEngine instead, so the DSP
+# table is not rebuilt every time
+def computeDsp(rows, cfgData=None, fileCols=None, sortOutput=True, logger=None):
+
+    dspResult = DspEngine(cfgData, logger).computeDsp(rows, fileCols, sortOutput)
+    outputRows = dspResult.toList()
+    return outputRows, dspResult.getError()
@@ -0,0 +1,288 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_bench.py                       #
+# File Desc: synthetic data and stage benchmarks    #
+#####################################################
+
+from __future__ import print_function
+
+import os
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import bisect
+import logging
+import argparse
+import datetime
+import platform
+import tempfile
+import fatturazione
+
+# peak RSS is only available on unix, per stage python memory only on python 3
+try:
+    import resource
+except ImportError:
+    resource = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+# stages of Fatturazione.run(), in execution order. saveToFile only writes the rows sorted by sortOutput
+benchStages = ['openCfgFile', 'openInputFile', 'parseInput', 'sortOutput', 'saveToFile']
+
+invalidDates = ['2019-02-30', '2019-13-01', '2019-00-10', '2019-04-31', '2019/04/01', '']
+invalidModes = ['DF_ERROR', 'DF90', 'df', '']
+
+# I/O variants of benchmarkIo(): (name, input compression, config overrides). 'unbuffered' is the old path,
+# default buffers and no memory map
+ioVariants = [
+    ('unbuffered', None, {'ioBufferSize': -1, 'mmapThreshold': None}),
+    ('buffered', None, {'mmapThreshold': None}),
+    ('mmap', None, {'mmapThreshold': 0}),
+    ('gz', 'gz', {'outputCompression': 'gz'}),
+    ('bz2', 'bz2', {'outputCompression': 'bz2'}),
+    ('xz', 'xz', {'outputCompression': 'xz'})
+]
+
+
+# Writes a random invoice CSV in the format of inputfile.csv. modeMix maps each mode to its weight, the
+# invalid rates are the share of rows with an invalid date or mode, dates are taken in [startDate, endDate].
+# The same seed always gives the same file
+def generateInvoiceCsv(fileName, rows, modeMix=None, invalidDateRate=0.0, invalidModeRate=0.0,
+                       startDate='2019-01-01', endDate='2019-12-31', seed=0, csvDelimiter=';'):
+
+    if modeMix is None:
+        modeMix = {'DF': 1, 'DFFM': 1, 'DF60': 1}
+
+    randomGen = random.Random(seed)
+
+    # cumulative weights, sorted so the file does not depend on the dict order
+    modes = sorted(modeMix)
+    cumulativeWeights = []
+    totalWeight = 0.0
+    for mode in modes:
+        totalWeight += modeMix[mode]
+        cumulativeWeights.append(totalWeight)
+
+    firstDay = datetime.datetime.strptime(startDate, '%Y-%m-%d').date().toordinal()
+    lastDay = datetime.datetime.strptime(endDate, '%Y-%m-%d').date().toordinal()
+
+    with fatturazione.openCsvOutput(fileName) as csvFile:
+        wr = csv.writer(csvFile, delimiter=csvDelimiter, quoting=csv.QUOTE_ALL)
+        wr.writerow(['NrFattura', 'DataFattura', 'ModalitaDiPagamento'])
+
+        for rowNumber in range(rows):
+            if randomGen.random() < invalidDateRate:
+                dateStr = randomGen.choice(invalidDates)
+            else:
+                dateStr = datetime.date.fromordinal(randomGen.randint(firstDay, lastDay)).isoformat()
+
+            if randomGen.random() < invalidModeRate:
+                mode = randomGen.choice(invalidModes)
+            else:
+                mode = modes[bisect.bisect_right(cumulativeWeights, randomGen.random() * totalWeight)]
+
+            wr.writerow(['FATT-{:010d}'.format(rowNumber + 1), dateStr, mode])
+
+
+# Returns the peak RSS of the process in bytes, None if not available
+def peakRss():
+
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    if sys.platform == 'darwin':
+        return maxRss
+    return maxRss * 1024
+
+
+# Runs the stages of Fatturazione.run() one by one on the input file, timing each of them. Returns a dict
+# with wall and cpu seconds, rows/s, peak RSS (process wide, so it never decreases) and, with traceMemory
+# under python 3, the peak memory allocated by python during the stage. Tracing slows down the stages a lot,
+# so its timings are not comparable with the untraced ones
+def benchmarkStages(inputFile, configFile, logger, traceMemory=False):
+
+    fattWorker = fatturazione.Fatturazione(inputFile, configFile, logger)
+    results = {}
+    rows = 0
+
+    for stage in benchStages:
+        stageMethod = stage
+        if stage == 'parseInput' and fattWorker.engine == 'columnar':
+            stageMethod = 'parseInputColumnar'
+        elif stage == 'parseInput' and fattWorker.engine == 'compact':
+            stageMethod = 'parseInputCompact'
+
+        if traceMemory:
+            tracemalloc.start()
+
+        wallStart = time.time()
+        cpuStart = fatturazione.cpuTime()
+        getattr(fattWorker, stageMethod)()
+        cpuSeconds = fatturazione.cpuTime() - cpuStart
+        wallSeconds = time.time() - wallStart
+
+        stageResult = {
+            'wallSeconds': wallSeconds,
+            'cpuSeconds': cpuSeconds,
+            'peakRssBytes': peakRss()
+        }
+        if traceMemory:
+            stageResult['peakAllocatedBytes'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        if fattWorker.error is not None:
+            stageResult['error'] = fattWorker.error['error']
+            results[stage] = stageResult
+            break
+
+        if stage == 'openInputFile':
+            rows = len(fattWorker.inputData)
+        stageResult['rowsPerSecond'] = rows / wallSeconds if rows > 0 and wallSeconds > 0 else None
+        results[stage] = stageResult
+
+    if fattWorker.outputFileName is not None and os.path.exists(fattWorker.outputFileName):
+        os.remove(fattWorker.outputFileName)
+
+    return {'rows': rows, 'engine': fattWorker.engine, 'stages': results}
+
+
+# Runs Fatturazione.run() on the input file with each I/O variant: plain file with and without buffers, memory
+# mapped, compressed input and output. Returns a dict with the read and write wall seconds, the rows/s of the whole
+# run and the input and output file sizes of each variant. Variants whose compression is not available are skipped
+def benchmarkIo(inputFile, configFile, logger):
+
+    with open(configFile) as cfgFile:
+        cfgData = json.load(cfgFile)
+
+    results = {}
+    for variant, compression, cfgOverrides in ioVariants:
+        if compression == 'xz' and fatturazione.lzma is None:
+            continue
+
+        variantInput = inputFile
+        if compression is not None:
+            variantInput = 'io_{}.csv.{}'.format(variant, compression)
+            with open(inputFile, 'rb') as plainFile:
+                compressedFile = fatturazione.openCompressedFile(variantInput, compression, 'wb')
+                try:
+                    shutil.copyfileobj(plainFile, compressedFile)
+                finally:
+                    compressedFile.close()
+
+        variantCfg = dict(cfgData)
+        variantCfg.update(cfgOverrides)
+        variantConfigFile = 'io_{}.json'.format(variant)
+        with open(variantConfigFile, 'w') as cfgFile:
+            json.dump(variantCfg, cfgFile)
+
+        fattWorker = fatturazione.Fatturazione(variantInput, variantConfigFile, logger)
+        runStart = time.time()
+        fattWorker.run()
+        runSeconds = time.time() - runStart
+
+        variantResult = {
+            'readSeconds': fattWorker.stageTimes['openInputFile']['wallSeconds'],
+            'runSeconds': runSeconds,
+            'rowsPerSecond': fattWorker.rowCount / runSeconds if runSeconds > 0 else None,
+            'inputBytes': os.path.getsize(variantInput)
+        }
+        if fattWorker.error is not None:
+            variantResult['error'] = fattWorker.error['error']
+        if 'saveToFile' in fattWorker.stageTimes:
+            variantResult['writeSeconds'] = fattWorker.stageTimes['saveToFile']['wallSeconds']
+        if fattWorker.outputFileName is not None and os.path.exists(fattWorker.outputFileName):
+            variantResult['outputBytes'] = os.path.getsize(fattWorker.outputFileName)
+            os.remove(fattWorker.outputFileName)
+        if variantInput != inputFile:
+            os.remove(variantInput)
+        os.remove(variantConfigFile)
+
+        results[variant] = variantResult
+
+    return results
+
+
+# Parses "DF=1,DFFM=1,DF60=2" into a mode mix dict
+def parseModeMix(mixStr):
+
+    modeMix = {}
+    for item in mixStr.split(','):
+        mode, weight = item.split('=')
+        modeMix[mode.strip()] = float(weight)
+    return modeMix
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Benchmark the Fatturazione stages on synthetic invoices')
+    parser.add_argument('--rows', type=int, default=100000, help='number of invoices to generate')
+    parser.add_argument('--mix', type=str, default='DF=1,DFFM=1,DF60=1', help='mode weights, as DF=1,DFFM=1,DF60=1')
+    parser.add_argument('--invalid-date-rate', type=float, default=0.0, help='share of rows with an invalid date')
+    parser.add_argument('--invalid-mode-rate', type=float, default=0.0, help='share of rows with an invalid mode')
+    parser.add_argument('--start', type=str, default='2019-01-01', help='first invoice date')
+    parser.add_argument('--end', type=str, default='2019-12-31', help='last invoice date')
+    parser.add_argument('--seed', type=int, default=0, help='random seed')
+    parser.add_argument('--conf', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'conf_fatturazione.json'), help='config file name')
+    parser.add_argument('--trace-memory', action='store_true', help='measure the python memory of each stage')
+    parser.add_argument('--io', action='store_true', help='benchmark compressed, buffered and mapped file i/o')
+    parser.add_argument('--output', type=str, help='json report file name, stdout if not given')
+    args = parser.parse_args()
+
+    # the log messages are not part of the benchmark
+    logger = logging.getLogger('fatturazione_bench')
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+    configFile = os.path.abspath(args.conf)
+    oldDir = os.getcwd()
+    workDir = tempfile.mkdtemp(prefix='fatturazione_bench_')
+    try:
+        # the output file is written next to the input, so everything runs in the temp folder
+        os.chdir(workDir)
+        generateStart = time.time()
+        generateInvoiceCsv('bench.csv', args.rows, parseModeMix(args.mix), args.invalid_date_rate,
+                           args.invalid_mode_rate, args.start, args.end, args.seed)
+        generateSeconds = time.time() - generateStart
+
+        report = benchmarkStages('bench.csv', configFile, logger, args.trace_memory and tracemalloc is not None)
+        if args.io:
+            report['io'] = benchmarkIo('bench.csv', configFile, logger)
+    finally:
+        os.chdir(oldDir)
+        shutil.rmtree(workDir)
+
+    report['generator'] = {
+        'rows': args.rows,
+        'mix': parseModeMix(args.mix),
+        'invalidDateRate': args.invalid_date_rate,
+        'invalidModeRate': args.invalid_mode_rate,
+        'start': args.start,
+        'end': args.end,
+        'seed': args.seed,
+        'seconds': generateSeconds
+    }
+    report['python'] = platform.python_version()
+    report['timestamp'] = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+    reportStr = json.dumps(report, indent=2, sort_keys=True)
+    if args.output is None:
+        print(reportStr)
+    else:
+        with open(args.output, 'w') as reportFile:
+            reportFile.write(reportStr)
+
+
+# Main
+if __name__ == '__main__':
+
+    main()
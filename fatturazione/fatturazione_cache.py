@@ -0,0 +1,239 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_cache.py                       #
+# File Desc: parse-once binary cache of input files #
+#####################################################
+
+import os
+import sys
+import mmap
+import json
+import struct
+import hashlib
+from array import array
+
+cacheMagic = b'FATTCACHE1\n'
+cacheExtension = '.fcache'
+# read size of the content hash
+hashBlockBytes = 1024 * 1024
+
+# typecodes of the cached arrays, checked on load since their item size depends on the platform
+codeType = 'I'
+offsetType = 'L'
+
+
+# Returns a new hash object of the input file content
+def newContentHash():
+    return hashlib.md5()
+
+
+# Returns the hex digest of the whole content of a file
+def hashFile(fileName):
+    contentHash = newContentHash()
+    with open(fileName, 'rb') as inputHandle:
+        while True:
+            block = inputHandle.read(hashBlockBytes)
+            if not block:
+                break
+            contentHash.update(block)
+    return contentHash.hexdigest()
+
+
+# Parsed id, date and mode columns of the input files, one cache file per input path. A cache file is the magic
+# line, the length of the JSON header and the header, then the id offsets, the id blob, the date codes and the
+# mode codes at the offsets given in the header. Dates and modes are interned: the header has the distinct
+# strings, the rows their index. The least recently used files are evicted over maxBytes
+class InputCache:
+
+    def __init__(self, cacheDir, maxBytes):
+        self.cacheDir = cacheDir
+        self.maxBytes = maxBytes
+
+    # Cache file of an input file
+    def cacheFileName(self, inputFile):
+        pathKey = hashlib.md5(os.path.abspath(inputFile).encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheDir, pathKey + cacheExtension)
+
+    # Identity of the input file: path, size, modification time and the hash of the whole content, so any
+    # rewrite is caught even when it keeps size and mtime. contentHash is the hex digest of hashFile() when the
+    # caller already hashed the content while parsing it
+    def fileKey(self, inputFile, fieldNames, csvDelimiter, contentHash=None):
+        fileStat = os.stat(inputFile)
+        if contentHash is None:
+            contentHash = hashFile(inputFile)
+
+        return {
+            'path': os.path.abspath(inputFile),
+            'size': fileStat.st_size,
+            'mtime': fileStat.st_mtime,
+            'contentHash': contentHash,
+            'fields': list(fieldNames),
+            'delimiter': csvDelimiter,
+            'codeSize': array(codeType).itemsize,
+            'offsetSize': array(offsetType).itemsize,
+            'byteOrder': sys.byteorder
+        }
+
+    # Returns (file columns, ids, dates, modes) of the input file, None if it is not cached or it changed. The
+    # whole input file is hashed, which is still much cheaper than parsing it
+    def load(self, inputFile, fieldNames, csvDelimiter):
+
+        cacheFileName = self.cacheFileName(inputFile)
+        if not os.path.exists(cacheFileName) or os.path.getsize(cacheFileName) < len(cacheMagic) + 8:
+            return None
+
+        with open(cacheFileName, 'rb') as cacheFile:
+            cacheMap = mmap.mmap(cacheFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                if cacheMap[:len(cacheMagic)] != cacheMagic:
+                    return None
+                headerStart = len(cacheMagic) + 8
+                headerSize = struct.unpack('<Q', cacheMap[len(cacheMagic):headerStart])[0]
+                header = json.loads(cacheMap[headerStart:headerStart + headerSize].decode('utf-8'))
+                if header['key'] != self.fileKey(inputFile, fieldNames, csvDelimiter):
+                    return None
+
+                sections = header['sections']
+                idOffsets = self.readArray(cacheMap, offsetType, sections['idOffsets'])
+                idBlob = cacheMap[sections['idBlob'][0]:sections['idBlob'][1]]
+                dateCodes = self.readArray(cacheMap, codeType, sections['dateCodes'])
+                modeCodes = self.readArray(cacheMap, codeType, sections['modeCodes'])
+            finally:
+                cacheMap.close()
+
+        # ids are joined by NUL, which the csv module does not allow in a field
+        idStrings = self.fromBytes(idBlob).split('\x00')
+        if len(idStrings) != len(idOffsets) - 1:
+            return None
+        dateTable = [self.fromJson(dateStr) for dateStr in header['dates']]
+        modeTable = [self.fromJson(modeStr) for modeStr in header['modes']]
+
+        # most recently used, then the limit is applied again as maxBytes may have been lowered
+        os.utime(cacheFileName, None)
+        self.evict()
+        fileCols = [self.fromJson(fileCol) for fileCol in header['fileCols']]
+        return fileCols, idStrings, list(map(dateTable.__getitem__, dateCodes)), \
+            list(map(modeTable.__getitem__, modeCodes))
+
+    # Writes the cache file of the input file, then evicts the oldest files over maxBytes. contentHash is the hash
+    # of the content that was parsed into the columns, taken while it was read
+    def save(self, inputFile, fieldNames, csvDelimiter, fileCols, ids, dates, modes, contentHash=None):
+
+        dateCodes, dateTable = self.internStrings(dates)
+        modeCodes, modeTable = self.internStrings(modes)
+
+        idBlob = self.toBytes('\x00'.join(ids) if ids else '')
+        idOffsets = array(offsetType, [0])
+        position = 0
+        for idStr in ids:
+            position += len(self.toBytes(idStr)) + 1
+            idOffsets.append(position)
+
+        sectionData = [
+            ('idOffsets', self.arrayBytes(idOffsets)),
+            ('idBlob', idBlob),
+            ('dateCodes', self.arrayBytes(dateCodes)),
+            ('modeCodes', self.arrayBytes(modeCodes))
+        ]
+
+        # the header holds the section offsets, which depend on the header size: compute them with a fixed
+        # width placeholder first
+        header = {
+            'key': self.fileKey(inputFile, fieldNames, csvDelimiter, contentHash),
+            'fileCols': [self.toJson(fileCol) for fileCol in fileCols],
+            'dates': [self.toJson(dateStr) for dateStr in dateTable],
+            'modes': [self.toJson(modeStr) for modeStr in modeTable],
+            'sections': dict((sectionName, [0, 0]) for sectionName, data in sectionData)
+        }
+        headerSize = len(json.dumps(header).encode('utf-8')) + 32 * len(sectionData)
+        position = len(cacheMagic) + 8 + headerSize
+        for sectionName, data in sectionData:
+            # arrays are aligned to their item size, so the file could be mapped as arrays
+            position += -position % 8
+            header['sections'][sectionName] = [position, position + len(data)]
+            position += len(data)
+        headerBytes = json.dumps(header).encode('utf-8')
+        headerBytes += b' ' * (headerSize - len(headerBytes))
+
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+        cacheFileName = self.cacheFileName(inputFile)
+        with open(cacheFileName + '.tmp', 'wb') as cacheFile:
+            cacheFile.write(cacheMagic)
+            cacheFile.write(struct.pack('<Q', headerSize))
+            cacheFile.write(headerBytes)
+            for sectionName, data in sectionData:
+                cacheFile.write(b'\x00' * (header['sections'][sectionName][0] - cacheFile.tell()))
+                cacheFile.write(data)
+        if os.path.exists(cacheFileName):
+            os.remove(cacheFileName)
+        os.rename(cacheFileName + '.tmp', cacheFileName)
+
+        self.evict()
+
+    # Removes the least recently used cache files until the cache fits in maxBytes
+    def evict(self):
+
+        cacheFiles = []
+        for fileName in os.listdir(self.cacheDir):
+            if fileName.endswith(cacheExtension):
+                fileStat = os.stat(os.path.join(self.cacheDir, fileName))
+                cacheFiles.append((fileStat.st_mtime, fileStat.st_size, fileName))
+
+        cacheFiles.sort()
+        totalBytes = sum(fileSize for fileMtime, fileSize, fileName in cacheFiles)
+        for fileMtime, fileSize, fileName in cacheFiles:
+            if totalBytes <= self.maxBytes:
+                break
+            os.remove(os.path.join(self.cacheDir, fileName))
+            totalBytes -= fileSize
+
+    # Returns the codes array and the table of the distinct strings
+    def internStrings(self, values):
+        codes = {}
+        for value in values:
+            if value not in codes:
+                codes[value] = len(codes)
+        table = [None] * len(codes)
+        for value, code in codes.items():
+            table[code] = value
+        return array(codeType, map(codes.__getitem__, values)), table
+
+    def readArray(self, cacheMap, typeCode, section):
+        values = array(typeCode)
+        data = cacheMap[section[0]:section[1]]
+        if sys.version_info[0] < 3:
+            values.fromstring(data)
+        else:
+            values.frombytes(data)
+        return values
+
+    def arrayBytes(self, values):
+        if sys.version_info[0] < 3:
+            return values.tostring()
+        return values.tobytes()
+
+    # Strings are bytes under python 2, text under python 3
+    def toBytes(self, value):
+        if sys.version_info[0] < 3:
+            return value
+        return value.encode('utf-8', 'surrogateescape')
+
+    def fromBytes(self, data):
+        if sys.version_info[0] < 3:
+            return data
+        return data.decode('utf-8', 'surrogateescape')
+
+    # JSON header strings, python 2 byte strings go through latin-1 so any byte survives
+    def toJson(self, value):
+        if sys.version_info[0] < 3:
+            return value.decode('latin-1')
+        return value.encode('utf-8', 'surrogateescape').decode('latin-1')
+
+    def fromJson(self, value):
+        if sys.version_info[0] < 3:
+            return value.encode('latin-1')
+        return value.encode('latin-1').decode('utf-8', 'surrogateescape')
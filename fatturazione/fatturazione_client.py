@@ -0,0 +1,137 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_client.py                      #
+# File Desc: DSP service client and load test       #
+#####################################################
+
+from __future__ import print_function
+
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import threading
+import fatturazione_bench
+
+# urllib was split in python 3
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, HTTPError
+
+
+# Posts a batch to the DSP service, body is the CSV file content or, with jsonBatch, the JSON rows.
+# Returns (HTTP status, response body)
+def postBatch(url, body, jsonBatch=False):
+
+    contentType = 'application/json' if jsonBatch else 'text/csv'
+    request = Request(url.rstrip('/') + '/dsp', data=body, headers={'Content-Type': contentType})
+    try:
+        response = urlopen(request)
+        try:
+            return response.getcode(), response.read()
+        finally:
+            response.close()
+    except HTTPError as e:
+        return e.code, e.read()
+
+
+# Returns the value at the given percentile of sorted values
+def percentile(sortedValues, percent):
+
+    if not sortedValues:
+        return None
+    index = int(round(percent / 100.0 * (len(sortedValues) - 1)))
+    return sortedValues[index]
+
+
+# Sends the same batch requests times from concurrency threads, returns requests/s and latency percentiles
+def loadTest(url, body, requests, concurrency, jsonBatch=False):
+
+    latencies = []
+    failures = []
+    lock = threading.Lock()
+    requestsLeft = [requests]
+
+    def sendRequests():
+        while True:
+            with lock:
+                if requestsLeft[0] == 0:
+                    return
+                requestsLeft[0] -= 1
+
+            requestStart = time.time()
+            status, responseBody = postBatch(url, body, jsonBatch)
+            latency = time.time() - requestStart
+            with lock:
+                latencies.append(latency)
+                if status != 200:
+                    failures.append(status)
+
+    testStart = time.time()
+    threads = [threading.Thread(target=sendRequests) for threadNumber in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    testSeconds = time.time() - testStart
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'failures': len(failures),
+        'seconds': testSeconds,
+        'requestsPerSecond': requests / testSeconds if testSeconds > 0 else None,
+        'latencyP50Ms': percentile(latencies, 50) * 1000 if latencies else None,
+        'latencyP99Ms': percentile(latencies, 99) * 1000 if latencies else None,
+        'latencyMaxMs': latencies[-1] * 1000 if latencies else None
+    }
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Send invoice batches to the DSP service')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080', help='service url')
+    parser.add_argument('--inputfile', type=str, help='CSV batch to send, a synthetic one if not given')
+    parser.add_argument('--rows', type=int, default=100, help='rows of the synthetic batch')
+    parser.add_argument('--requests', type=int, default=1, help='number of requests, more than 1 for a load test')
+    parser.add_argument('--concurrency', type=int, default=1, help='number of client threads of the load test')
+    parser.add_argument('--output', type=str, help='DSP output file name of a single request, stdout if not given')
+    args = parser.parse_args()
+
+    if args.inputfile is not None:
+        with open(args.inputfile, 'rb') as inputFile:
+            body = inputFile.read()
+    else:
+        workDir = tempfile.mkdtemp(prefix='fatturazione_client_')
+        try:
+            batchFileName = os.path.join(workDir, 'batch.csv')
+            fatturazione_bench.generateInvoiceCsv(batchFileName, args.rows)
+            with open(batchFileName, 'rb') as inputFile:
+                body = inputFile.read()
+        finally:
+            shutil.rmtree(workDir)
+
+    if args.requests > 1:
+        print(json.dumps(loadTest(args.url, body, args.requests, args.concurrency), indent=2, sort_keys=True))
+        return
+
+    status, responseBody = postBatch(args.url, body)
+    if status != 200 or args.output is None:
+        print(responseBody.decode('utf-8'))
+    else:
+        with open(args.output, 'wb') as outputFile:
+            outputFile.write(responseBody)
+
+
+# Main
+if __name__ == '__main__':
+
+    main()
@@ -0,0 +1,106 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_db.py                          #
+# File Desc: SQLite DSP output and due date queries #
+#####################################################
+
+from __future__ import print_function
+
+import sys
+import csv
+import sqlite3
+import argparse
+import datetime
+
+
+# DSP rows by invoice id, the latest run of an invoice replaces the previous one
+createStatements = [
+    'CREATE TABLE IF NOT EXISTS dsp ('
+    'invoice_id TEXT PRIMARY KEY, invoice_date TEXT NOT NULL, due_date TEXT NOT NULL, '
+    'source_file TEXT, updated_at TEXT NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS dsp_due_date ON dsp (due_date, invoice_id)'
+]
+upsertStatement = ('INSERT OR REPLACE INTO dsp (invoice_id, invoice_date, due_date, source_file, updated_at) '
+                   'VALUES (?, ?, ?, ?, ?)')
+deleteStatement = 'DELETE FROM dsp WHERE invoice_id = ?'
+rangeQuery = ('SELECT invoice_id, invoice_date, due_date FROM dsp WHERE due_date BETWEEN ? AND ? '
+              'ORDER BY due_date, invoice_id')
+
+
+# Under python 2 the rows are byte strings, as the csv module reads and writes them
+def setTextFactory(connection):
+    if sys.version_info[0] < 3:
+        connection.text_factory = str
+
+
+# SQLite database of the DSP rows. Rows are upserted with executemany inside a single transaction, which is
+# committed by close()
+class DspDatabase:
+
+    def __init__(self, dbFileName, sourceFile=None):
+        self.dbFileName = dbFileName
+        self.sourceFile = sourceFile
+        self.updatedAt = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        self.rowCount = 0
+
+        # transactions are handled here, not by the sqlite3 module
+        self.connection = sqlite3.connect(dbFileName, timeout=60, isolation_level=None)
+        setTextFactory(self.connection)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        for statement in createStatements:
+            self.connection.execute(statement)
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    # Upserts a batch of (id, invoice date, DSP) rows, error lines are left to the caller
+    def upsertRows(self, outputRows):
+        dbRows = [(outputRow[0], outputRow[1], outputRow[2], self.sourceFile, self.updatedAt)
+                  for outputRow in outputRows]
+        self.connection.executemany(upsertStatement, dbRows)
+        self.rowCount += len(dbRows)
+
+    # Deletes the rows of the given invoice ids, for the rows rejected by a run
+    def deleteRows(self, invoiceIds):
+        self.connection.executemany(deleteStatement, [(invoiceId,) for invoiceId in invoiceIds])
+
+    # Commits the rows, or rolls them back if the run failed, and closes the database
+    def close(self, commit=True):
+        try:
+            self.connection.execute('COMMIT' if commit else 'ROLLBACK')
+        finally:
+            self.connection.close()
+
+
+# Returns the (id, invoice date, DSP) rows with a DSP between fromDate and toDate included, by DSP and id.
+# The due date index turns the range into an index seek
+def queryDueDates(dbFileName, fromDate, toDate):
+
+    connection = sqlite3.connect(dbFileName, timeout=60)
+    setTextFactory(connection)
+    try:
+        return connection.execute(rangeQuery, (fromDate, toDate)).fetchall()
+    finally:
+        connection.close()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='List the invoices falling due in a date range')
+    parser.add_argument('--db', type=str, required=True, help='database file written with the sqliteOutput config')
+    parser.add_argument('--from', dest='fromDate', type=str, required=True, help='first due date, YYYY-MM-DD')
+    parser.add_argument('--to', dest='toDate', type=str, required=True, help='last due date, YYYY-MM-DD')
+    parser.add_argument('--delimiter', type=str, default=';', help='csv delimiter of the output')
+    args = parser.parse_args()
+
+    wr = csv.writer(sys.stdout, delimiter=args.delimiter, lineterminator='\n')
+    wr.writerow(['NrFattura', 'DataFattura', 'DataScadenzaPagamento'])
+    wr.writerows(queryDueDates(args.db, args.fromDate, args.toDate))
+
+
+# Main
+if __name__ == '__main__':
+
+    main()
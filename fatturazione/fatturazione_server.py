@@ -0,0 +1,300 @@
+#####################################################
+# Author: Michele Sarchioto                         #
+# Date: 2026-10-18                                  #
+# Project: Test Fatturazione                        #
+# Description: Billing projects for Vayu            #
+# File: fatturazione_server.py                      #
+# File Desc: resident DSP service over local HTTP   #
+#####################################################
+
+import io
+import os
+import sys
+import csv
+import json
+import logging
+import argparse
+import threading
+from logging import handlers
+import fatturazione
+
+# http server modules were renamed in python 3
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+# Keeps a configured Fatturazione instance and its DSP lookup table warm between requests. Every request gets its
+# own worker sharing the table, the config file is reloaded when its modification time changes
+class DspService:
+
+    def __init__(self, configFile, logger):
+        self.configFile = configFile
+        self.logger = logger
+        self.lock = threading.Lock()
+
+        self.template = None
+        self.cfgMtime = None
+
+        # statistics
+        self.requestCount = 0
+        self.errorCount = 0
+        self.rowCount = 0
+        self.reloadCount = 0
+
+    # Loads the config file into a new template instance, the previous one is kept if the config is not valid.
+    # Returns the error, None if the config was loaded
+    def reloadConfig(self):
+
+        cfgMtime = os.path.getmtime(self.configFile)
+        template = fatturazione.Fatturazione(None, self.configFile, self.logger)
+        template.openCfgFile()
+        if template.error is not None:
+            self.logger.error('Config file not loaded: {}'.format(template.error['error']))
+            # do not try again until the file changes
+            self.cfgMtime = cfgMtime
+            return template.error
+
+        self.template = template
+        self.cfgMtime = cfgMtime
+        self.reloadCount += 1
+        self.logger.info('Config file loaded: {}'.format(self.configFile))
+        return None
+
+    # Reloads the config file if it changed since the last load
+    def checkConfig(self):
+
+        try:
+            cfgMtime = os.path.getmtime(self.configFile)
+        except OSError:
+            # keep the loaded config while the file is being replaced
+            return
+        if cfgMtime != self.cfgMtime:
+            with self.lock:
+                if cfgMtime != self.cfgMtime:
+                    self.reloadConfig()
+
+    # Returns a new worker with the loaded config, copied from the template without compiling it again
+    def createWorker(self):
+
+        worker = fatturazione.Fatturazione('batch', None, self.logger)
+        worker.copyConfig(self.template)
+        return worker
+
+    # Parses the rows of a batch and sorts them by DSP, rows are dicts or, for the compact engine, lists
+    def computeDsp(self, worker, fileCols, inputData):
+
+        worker.fileCols = fileCols
+        worker.inputData = inputData
+        worker.rowCount = len(inputData)
+        if worker.rowCount == 0:
+            worker.error = {'error': 'Empty file'}
+            return
+
+        if worker.engine == 'columnar':
+            worker.parseInputColumnar()
+        elif worker.engine == 'compact' and not isinstance(inputData[0], dict):
+            worker.parseInputCompact()
+        else:
+            worker.parseInput()
+        worker.logRejects()
+
+        if worker.error is None:
+            worker.sortOutput()
+
+    # Processes a CSV batch, with header, and returns the DSP output CSV as written by run()
+    def processCsv(self, worker, body):
+
+        if sys.version_info[0] >= 3:
+            body = body.decode('utf-8')
+        inputLines = body.splitlines(True)
+
+        if worker.engine == 'compact':
+            inputReader = csv.reader(inputLines, delimiter=worker.csvDelimiter)
+            fileCols = next(inputReader, None)
+            inputData = [row for row in inputReader if row]
+        else:
+            inputReader = csv.DictReader(inputLines, delimiter=worker.csvDelimiter)
+            inputData = [row for row in inputReader]
+            fileCols = inputReader.fieldnames
+
+        if fileCols is None:
+            worker.error = {'error': 'Empty file'}
+            return None
+        self.computeDsp(worker, fileCols, inputData)
+        if worker.error is not None:
+            return None
+
+        # csv writes str, which is bytes under python 2
+        outputBuffer = io.StringIO() if sys.version_info[0] >= 3 else io.BytesIO()
+        wr = csv.writer(outputBuffer, delimiter=worker.csvDelimiter)
+        wr.writerow(worker.outputCols)
+        wr.writerows(worker.outputData)
+        outputBody = outputBuffer.getvalue()
+        if sys.version_info[0] >= 3:
+            outputBody = outputBody.encode('utf-8')
+        return outputBody
+
+    # Processes a JSON batch, a list of row objects or {"rows": [...]}. Returns a JSON object with the DSP sorted
+    # rows, the rejected rows when the config has a rejects file, and the row counters
+    def processJson(self, worker, body):
+
+        inputData = json.loads(body.decode('utf-8'))
+        if isinstance(inputData, dict):
+            inputData = inputData.get('rows', [])
+
+        fileCols = sorted(inputData[0]) if inputData else worker.inputCols
+        self.computeDsp(worker, fileCols, inputData)
+        if worker.error is not None:
+            return None
+
+        response = {'rows': [list(outputRow) for outputRow in worker.outputData], 'counters': worker.getCounters()}
+        if worker.rejectsFile:
+            response['rejects'] = worker.rejectReport.rows
+        return json.dumps(response).encode('utf-8')
+
+    # Processes a batch, returns (worker, output body), the output body is None if the worker has an error
+    def processBatch(self, body, jsonBatch):
+
+        self.checkConfig()
+        worker = self.createWorker()
+        try:
+            if jsonBatch:
+                outputBody = self.processJson(worker, body)
+            else:
+                outputBody = self.processCsv(worker, body)
+        except Exception as e:
+            # handle unexpected script errors
+            exc_type, exc_obj, exc_tb = sys.exc_info()
+            worker.errorHandler(e, 'processBatch()', exc_tb.tb_lineno)
+            outputBody = None
+
+        with self.lock:
+            self.requestCount += 1
+            self.rowCount += worker.rowCount
+            if worker.error is not None:
+                self.errorCount += 1
+
+        return worker, outputBody
+
+    # Returns the service statistics as a dict
+    def stats(self):
+
+        with self.lock:
+            return {
+                'requests': self.requestCount,
+                'errors': self.errorCount,
+                'rows': self.rowCount,
+                'configReloads': self.reloadCount,
+                'dueDateTable': self.template.dueDateTable.stats()
+            }
+
+
+# HTTP interface of the service: POST /dsp with a CSV (text/csv) or JSON (application/json) batch, GET /health
+# and GET /stats
+class DspRequestHandler(BaseHTTPRequestHandler):
+
+    # keep alive connections, the clients send many small batches
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+
+        if self.path != '/dsp':
+            self.sendResponse(404, 'application/json', json.dumps({'error': 'Not found'}).encode('utf-8'))
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        jsonBatch = 'json' in self.headers.get('Content-Type', '')
+        worker, outputBody = self.server.service.processBatch(body, jsonBatch)
+
+        if worker.error is not None:
+            self.sendResponse(400, 'application/json', json.dumps(worker.error).encode('utf-8'))
+        elif jsonBatch:
+            self.sendResponse(200, 'application/json', outputBody)
+        else:
+            self.sendResponse(200, 'text/csv', outputBody)
+
+    def do_GET(self):
+
+        if self.path == '/health':
+            self.sendResponse(200, 'application/json', json.dumps({'status': 'ok'}).encode('utf-8'))
+        elif self.path == '/stats':
+            self.sendResponse(200, 'application/json', json.dumps(self.server.service.stats()).encode('utf-8'))
+        else:
+            self.sendResponse(404, 'application/json', json.dumps({'error': 'Not found'}).encode('utf-8'))
+
+    def sendResponse(self, status, contentType, body):
+
+        self.send_response(status)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # requests are not logged one by one
+    def log_message(self, format, *args):
+        pass
+
+
+# One thread per connection
+class DspServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+
+# Creates the server with a loaded service, port 0 picks a free port. Returns None if the config is not valid
+def createServer(configFile, logger, host='127.0.0.1', port=8080):
+
+    service = DspService(configFile, logger)
+    if service.reloadConfig() is not None:
+        return None
+
+    server = DspServer((host, port), DspRequestHandler)
+    server.service = service
+    return server
+
+
+def createServerLogger():
+
+    logger = logging.getLogger('fatturazione_server')
+    logger.setLevel(logging.INFO)
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    logFileName = __file__.split('.py')[0] + '.log'
+    logHandler = handlers.TimedRotatingFileHandler(logFileName, when='D', interval=1, backupCount=2)
+    logHandler.setFormatter(formatter)
+    logger.addHandler(logHandler)
+
+    return logger
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description='Resident DSP service on localhost HTTP')
+    parser.add_argument('--conf', type=str, default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'conf_fatturazione.json'), help='config file name, reloaded when it changes')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='listening address')
+    parser.add_argument('--port', type=int, default=8080, help='listening port')
+    args = parser.parse_args()
+
+    logger = createServerLogger()
+    server = createServer(args.conf, logger, args.host, args.port)
+    if server is None:
+        return sys.exit(1)
+
+    logger.info('Listening on {}:{}'.format(args.host, server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info('Server stopped')
+
+
+# Main
+if __name__ == '__main__':
+
+    main()
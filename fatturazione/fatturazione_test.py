@@ -1,8 +1,62 @@
+import os
+import bz2
+import gzip
+import json
+import shutil
+import logging
+import tempfile
+import threading
 import unittest
 import fatturazione
+import fatturazione_db
+import fatturazione_api
+import fatturazione_bench
+import fatturazione_client
+import fatturazione_server
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+
+# logger used by the tests that run the whole process, messages are discarded
+testLogger = logging.getLogger('fatturazione_test')
+testLogger.addHandler(logging.NullHandler())
+testLogger.propagate = False
 
 class TestFatturazione(unittest.TestCase):
 
+    # Creates a temp folder with a copy of the sample input and config files, the tests run inside it
+    def setUp(self):
+        self.oldDir = os.getcwd()
+        self.tempDir = tempfile.mkdtemp()
+        shutil.copy(os.path.join(testDir, 'inputfile.csv'), self.tempDir)
+        shutil.copy(os.path.join(testDir, 'conf_fatturazione.json'), self.tempDir)
+        os.chdir(self.tempDir)
+
+    def tearDown(self):
+        os.chdir(self.oldDir)
+        shutil.rmtree(self.tempDir)
+
+    # Runs the given Fatturazione method on the sample files, returns the error and the output file content
+    def runSample(self, methodName, inputFile='inputfile.csv', configFile='conf_fatturazione.json'):
+        fattWorker = fatturazione.Fatturazione(inputFile, configFile, testLogger)
+        error = getattr(fattWorker, methodName)()
+
+        outputContent = None
+        if fattWorker.outputFileName is not None:
+            with open(fattWorker.outputFileName, 'rb') as outputFile:
+                outputContent = outputFile.read()
+            os.remove(fattWorker.outputFileName)
+
+        return error, outputContent
+
+    # Writes a copy of the sample config with some keys overwritten, returns the config file name
+    def writeConfig(self, configFile, **overrides):
+        with open('conf_fatturazione.json') as cfgFile:
+            cfgData = json.load(cfgFile)
+        cfgData.update(overrides)
+        with open(configFile, 'w') as cfgFile:
+            json.dump(cfgData, cfgFile)
+        return configFile
+
     # This method tests the date check
     def testCheckDate(self):
         inputDate1 = '2019-05-06'
@@ -138,6 +192,833 @@ class TestFatturazione(unittest.TestCase):
         self.assertItemsEqual(result, sortedOutputManual, 'Arrays Should Be Equal')
 
 
+    # This method tests that the streaming pipeline writes the same output as run()
+    def testRunStream(self):
+
+        runError, runOutput = self.runSample('run')
+        streamError, streamOutput = self.runSample('runStream')
+
+        self.assertEqual(runError, None, 'Run should not fail')
+        self.assertEqual(streamError, None, 'Stream run should not fail')
+        self.assertEqual(streamOutput, runOutput, 'Outputs Should Be Equal')
+
+        # an input file with the header only is an empty file, no output is written
+        with open('emptyfile.csv', 'w') as emptyFile:
+            emptyFile.write('NrFattura;DataFattura;ModalitaDiPagamento\n')
+        streamError, streamOutput = self.runSample('runStream', 'emptyfile.csv')
+
+        self.assertEqual(streamError, {'error': 'Empty file'}, 'Empty file should fail')
+        self.assertEqual(streamOutput, None, 'No output should be written')
+
+    # This method tests that the external sort spills to temp files and keeps the run() ordering
+    def testExternalSort(self):
+
+        # tiny sort buffer, so the output is sorted in several spilled runs
+        os.mkdir('sortruns')
+        self.writeConfig('conf_spill.json', sortBufferRows=3, sortTempDir='sortruns')
+
+        runError, runOutput = self.runSample('run')
+        streamError, streamOutput = self.runSample('runStream', configFile='conf_spill.json')
+
+        self.assertEqual(streamError, None, 'Stream run should not fail')
+        self.assertEqual(streamOutput, runOutput, 'Outputs Should Be Equal')
+        self.assertEqual(os.listdir('sortruns'), [], 'Temp runs should be removed')
+
+        # ties on the DSP keep the input order across runs
+        fattWorker = fatturazione.Fatturazione(None, None, None)
+        fattWorker.sortBufferRows = 2
+        outputRows = [['F1', '', '2019-02-01'], ['F2', '', '2019-01-01'], ['F3', '', '2019-02-01'],
+                      ['F4', '', '2019-01-01'], ['F5', '', '2019-02-01']]
+        result = [row[0] for row in fattWorker.sortStream(outputRows)]
+
+        self.assertEqual(result, ['F2', 'F4', 'F1', 'F3', 'F5'], 'Sort should be stable')
+
+    # This method tests the DSP lookup table against the direct computation
+    def testDueDateTable(self):
+
+        # declare class instance - input files and logger not required for this test
+        fattWorker = fatturazione.Fatturazione(None, None, None)
+        dueDateTable = fattWorker.dueDateTable
+
+        inputDates = ['2019-05-06', '2018-12-30', '2019-02-06', '2019-05-06']
+        for inputDate in inputDates:
+            self.assertEqual(dueDateTable.lookup(inputDate, 'DFFM'), fattWorker.endOfMonth(inputDate), 'Date Should Be Equal')
+            self.assertEqual(dueDateTable.lookup(inputDate, 'DF60'), fattWorker.addTwoMonthsToDate(inputDate), 'Date Should Be Equal')
+
+        self.assertEqual(dueDateTable.isValid('2019-01-32'), False, 'Date should be invalid')
+        self.assertEqual(dueDateTable.isValid('2019-01-31'), True, 'Date should be valid')
+        self.assertEqual(dueDateTable.isValid('2019-01-32'), False, 'Date should be invalid')
+
+        # the repeated date is a hit for both modes, the repeated invalid date too
+        stats = dueDateTable.stats()
+        self.assertEqual(stats['hits'], 3, 'Wrong number of hits')
+        self.assertEqual(stats['misses'], 8, 'Wrong number of misses')
+        self.assertEqual(stats['size'], 8, 'Wrong table size')
+
+    # This method tests that the columnar engine gives the same output as the row engine
+    def testColumnarEngine(self):
+
+        inputData = [
+                        {'NrFattura': 'Mock-Fattura-1', 'DataFattura': '2019-05-06', 'ModalitaDiPagamento': 'DF'},
+                        {'NrFattura': 'Mock-Fattura-2', 'DataFattura': '2018-12-30', 'ModalitaDiPagamento': 'DF60'},
+                        {'NrFattura': 'Mock-Fattura-3', 'DataFattura': '2019-11-30', 'ModalitaDiPagamento': 'DF60'},
+                        {'NrFattura': 'Mock-Fattura-4', 'DataFattura': '2020-02-06', 'ModalitaDiPagamento': 'DFFM'},
+                        {'NrFattura': 'Mock-Fattura-5', 'DataFattura': '2019-4-3', 'ModalitaDiPagamento': 'DFFM'},
+                        {'NrFattura': 'Mock-Fattura-6', 'DataFattura': '2019-02-30', 'ModalitaDiPagamento': 'DF'},
+                        {'NrFattura': 'Mock-Fattura-7', 'DataFattura': '2019-05-06', 'ModalitaDiPagamento': 'DF_ERROR'},
+                        {'NrFattura': 'Mock-Fattura-8', 'DataFattura': '2019-05-06', 'ModalitaDiPagamento': 'DF60'}
+        ]
+
+        outputs = []
+        for parseMethod in ['parseInput', 'parseInputColumnar']:
+            fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+            fattWorker.inputData = inputData
+            fattWorker.fileCols = fattWorker.inputCols
+            getattr(fattWorker, parseMethod)()
+            fattWorker.sortOutput()
+            # the columnar engine yields the rows as tuples
+            outputs.append([list(outputRow) for outputRow in fattWorker.outputData])
+
+        self.assertEqual(outputs[1], outputs[0], 'Outputs Should Be Equal')
+
+        # whole process with the engine selected by the config file
+        self.writeConfig('conf_columnar.json', engine='columnar')
+
+        runError, runOutput = self.runSample('run')
+        columnarError, columnarOutput = self.runSample('run', configFile='conf_columnar.json')
+
+        self.assertEqual(columnarError, None, 'Columnar run should not fail')
+        self.assertEqual(columnarOutput, runOutput, 'Outputs Should Be Equal')
+
+    # This method tests that the compact engine, reading rows as lists, gives the same output as the row engine
+    def testCompactEngine(self):
+
+        fileCols = ['ModalitaDiPagamento', 'NrFattura', 'DataFattura']
+        inputRows = [
+                        ['DF', 'Mock-Fattura-1', '2019-05-06'],
+                        ['DF60', 'Mock-Fattura-2', '2018-12-30'],
+                        ['DFFM', 'Mock-Fattura-3', '2020-02-06'],
+                        [],
+                        ['DF', 'Mock-Fattura-4', '2019-02-30'],
+                        ['DF_ERROR', 'Mock-Fattura-5', '2019-05-06'],
+                        ['DF60', 'Mock-Fattura-6', '2019-13-01']
+        ]
+
+        outputs = []
+        for parseMethod in ['parseInput', 'parseInputCompact']:
+            fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+            if parseMethod == 'parseInput':
+                fattWorker.inputData = [dict(zip(fileCols, row)) for row in inputRows if row]
+            else:
+                fattWorker.inputData = inputRows
+                # modes without an inline DSP still get the row as a dict
+                fattWorker.funcPointer['DFFM'] = lambda line: fattWorker.dffmHandler(line)
+            fattWorker.fileCols = fileCols
+            getattr(fattWorker, parseMethod)()
+            fattWorker.sortOutput()
+            outputs.append([list(outputRow) for outputRow in fattWorker.outputData])
+            self.assertEqual(fattWorker.getCounters()['invalidDate'], 2, 'Wrong number of invalid dates')
+
+        self.assertEqual(outputs[1], outputs[0], 'Outputs Should Be Equal')
+
+        self.writeConfig('conf_compact.json', engine='compact')
+
+        runError, runOutput = self.runSample('run')
+        for methodName in ['run', 'runStream']:
+            compactError, compactOutput = self.runSample(methodName, configFile='conf_compact.json')
+            self.assertEqual(compactError, None, 'Compact run should not fail')
+            self.assertEqual(compactOutput, runOutput, 'Outputs Should Be Equal')
+
+    # This method tests the payment modes defined by config rules
+    def testPaymentRules(self):
+
+        fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+        fattWorker.applyCfgData({'paymentRules': {
+                        'DF30': {'days': 30},
+                        'DF90': {'months': 3, 'overflow': 'roll'},
+                        'DF1M': {'months': 1},
+                        'DFFM+30': {'base': 'DFFM', 'days': 30},
+                        'DFFM10': {'base': 'DFFM', 'days': 10},
+                        'DF2FM': {'base': 'DFFM', 'months': 2}
+        }})
+
+        expectedDates = [
+                        ('DF30', '2019-12-15', '2020-01-14'),
+                        ('DF90', '2019-05-15', '2019-08-15'),
+                        ('DF90', '2019-11-30', '2020-03-01'),
+                        ('DF1M', '2020-01-31', '2020-02-29'),
+                        ('DFFM+30', '2019-02-10', '2019-03-30'),
+                        ('DFFM10', '2019-12-05', '2020-01-10'),
+                        ('DF2FM', '2019-12-05', '2020-02-29'),
+                        ('DF', '2019-12-05', '2019-12-05')
+        ]
+        fattWorker.outputData = []
+        for modeType, invoiceDate, dueDate in expectedDates:
+            fattWorker.parseLine({'NrFattura': modeType, 'DataFattura': invoiceDate, 'ModalitaDiPagamento': modeType})
+        self.assertEqual([outputLine[2] for outputLine in fattWorker.outputData],
+                         [dueDate for modeType, invoiceDate, dueDate in expectedDates], 'Wrong rule DSP')
+
+        fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+        with self.assertRaises(ValueError):
+            fattWorker.applyCfgData({'paymentRules': {'DF30': {'base': 'DFX'}}})
+
+        # a config listing validModes can leave a rule mode out to disable it
+        fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+        fattWorker.applyCfgData({'validModes': ['DF'], 'paymentRules': {'DF30': {'days': 30}}})
+        fattWorker.parseLine({'NrFattura': 'DF30', 'DataFattura': '2019-12-15', 'ModalitaDiPagamento': 'DF30'})
+        self.assertEqual(fattWorker.outputData[0][2], 'Invalid Mode at ID DF30: DF30', 'Rule mode should be disabled')
+
+        # DF60 written as a rule gives the same output with every engine
+        runError, runOutput = self.runSample('run')
+        for engine in ['row', 'columnar', 'compact']:
+            self.writeConfig('conf_rules.json', engine=engine, paymentRules={'DF60': {'months': 2, 'overflow': 60}})
+            rulesError, rulesOutput = self.runSample('run', configFile='conf_rules.json')
+            self.assertEqual(rulesError, None, 'Rules run should not fail')
+            self.assertEqual(rulesOutput, runOutput, 'Outputs Should Be Equal')
+
+    # This method tests that the parallel run writes the same output as run()
+    def testRunParallel(self):
+
+        runError, runOutput = self.runSample('run')
+
+        for workers in [1, 2, 4, 20]:
+            fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_fatturazione.json', testLogger)
+            parallelError = fattWorker.runParallel(workers)
+            with open(fattWorker.outputFileName, 'rb') as outputFile:
+                parallelOutput = outputFile.read()
+            os.remove(fattWorker.outputFileName)
+
+            self.assertEqual(parallelError, None, 'Parallel run should not fail')
+            self.assertEqual(parallelOutput, runOutput, 'Outputs Should Be Equal')
+            self.assertEqual(fattWorker.rowCount, 11, 'All the rows should be parsed')
+            self.assertTrue('sortOutput' in fattWorker.stageTimes, 'Worker sort should be timed')
+            self.assertTrue(fattWorker.stageTimes['sortOutput']['wallSeconds'] <=
+                            fattWorker.stageTimes['parseInput']['wallSeconds'],
+                            'Worker sort should not take longer than the parsing it is part of')
+
+    # This method tests the batch processing of many files, with one output per file and merged
+    def testRunBatch(self):
+
+        runError, runOutput = self.runSample('run')
+
+        # a copy of the sample in a sub folder and a file with wrong columns
+        os.mkdir('office')
+        shutil.copy('inputfile.csv', os.path.join('office', 'inputfile.csv'))
+        with open('wrongcols.csv', 'w') as wrongFile:
+            wrongFile.write('NrFattura;Data;ModalitaDiPagamento\nFATT-0001;2019-04-03;DF\n')
+        inputFiles = ['inputfile.csv', 'wrongcols.csv', os.path.join('office', 'inputfile.csv')]
+
+        fileResults, mergeFileName = fatturazione.runBatch(inputFiles, 'conf_fatturazione.json', testLogger, workers=2)
+
+        self.assertEqual(mergeFileName, None, 'No merged output expected')
+        self.assertEqual([fileResult[0] for fileResult in fileResults], inputFiles, 'Results should follow the input order')
+        self.assertNotEqual(fileResults[1][2], None, 'Wrong columns should fail')
+        for inputFile, outputFileName, fileError in [fileResults[0], fileResults[2]]:
+            self.assertEqual(fileError, None, 'File should not fail')
+            self.assertEqual(os.path.dirname(outputFileName), os.path.dirname(inputFile), 'Output next to the input')
+            with open(outputFileName, 'rb') as outputFile:
+                self.assertEqual(outputFile.read(), runOutput, 'Outputs Should Be Equal')
+
+        # dotted names keep their own output, the same base name twice fails instead of overwriting
+        shutil.copy('inputfile.csv', 'ledger.north.csv')
+        shutil.copy('inputfile.csv', 'ledger.south.csv')
+        with gzip.open('ledger.north.csv.gz', 'wb') as gzipFile:
+            gzipFile.write(b'NrFattura;DataFattura;ModalitaDiPagamento\nFATT-0001;2019-04-03;DF\n')
+        ledgerFiles = ['ledger.north.csv', 'ledger.south.csv', 'ledger.north.csv.gz']
+        fileResults, mergeFileName = fatturazione.runBatch(ledgerFiles, 'conf_fatturazione.json', testLogger, workers=2)
+
+        self.assertEqual([fileResult[2] for fileResult in fileResults[:2]], [None, None], 'Files should not fail')
+        self.assertTrue(os.path.basename(fileResults[0][1]).startswith('DSP_ledger.north_'), 'Wrong output name')
+        self.assertTrue(os.path.basename(fileResults[1][1]).startswith('DSP_ledger.south_'), 'Wrong output name')
+        self.assertNotEqual(fileResults[2][2], None, 'Same output name should fail')
+        with open(fileResults[0][1], 'rb') as outputFile:
+            self.assertEqual(outputFile.read(), runOutput, 'Output should not be overwritten')
+
+        # merged output of the two valid files, every row twice and ties in file order
+        fileResults, mergeFileName = fatturazione.runBatch(inputFiles, 'conf_fatturazione.json', testLogger,
+                                                           mergeOutput=True, mergeFileName='merged.csv')
+
+        self.assertEqual(mergeFileName, 'merged.csv', 'Merged output expected')
+        with open(mergeFileName, 'rb') as outputFile:
+            mergedLines = outputFile.read().splitlines()
+        runLines = runOutput.splitlines()
+        expectedLines = runLines[:1] + sorted(runLines[1:] * 2, key = lambda x: x.split(b';')[2])
+        self.assertEqual(mergedLines, expectedLines, 'Merged output should contain both files')
+
+    # This method tests that the incremental runs only parse the changed rows and match a full run
+    def testRunIncremental(self):
+
+        runError, runOutput = self.runSample('run')
+
+        # first incremental run, without index, parses all the rows
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_fatturazione.json', testLogger)
+        incrementalError = fattWorker.runIncremental('runindex')
+        with open(fattWorker.outputFileName, 'rb') as outputFile:
+            incrementalOutput = outputFile.read()
+
+        self.assertEqual(incrementalError, None, 'Incremental run should not fail')
+        self.assertEqual(incrementalOutput, runOutput, 'Outputs Should Be Equal')
+        self.assertEqual(len(fattWorker.outputData), 11, 'All the rows should be parsed')
+
+        # change a row, delete a row and add a new one, new DSPs do not tie with the old ones, since on ties
+        # the incremental run keeps the previous rows first
+        with open('inputfile.csv') as inputFile:
+            inputLines = inputFile.read().splitlines()
+        inputLines[1] = '"FATT-0001";"2019-04-10";"DF"'
+        del inputLines[3]
+        inputLines.append('"FATT-0012";"2019-05-20";"DF60"')
+        with open('inputfile.csv', 'w') as inputFile:
+            inputFile.write('\n'.join(inputLines))
+
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_fatturazione.json', testLogger)
+        incrementalError = fattWorker.runIncremental('runindex')
+        with open(fattWorker.outputFileName, 'rb') as outputFile:
+            incrementalOutput = outputFile.read()
+        os.remove(fattWorker.outputFileName)
+        runError, runOutput = self.runSample('run')
+
+        self.assertEqual(incrementalError, None, 'Incremental run should not fail')
+        self.assertEqual(incrementalOutput, runOutput, 'Outputs Should Be Equal')
+        # the changed and new rows, plus the two rejected rows which are parsed on every run
+        self.assertEqual(len(fattWorker.outputData), 4, 'Only the changed and rejected rows should be parsed')
+
+        # an unchanged file still reports its rejected rows
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_fatturazione.json', testLogger)
+        incrementalError = fattWorker.runIncremental('runindex')
+        with open(fattWorker.outputFileName, 'rb') as outputFile:
+            incrementalOutput = outputFile.read()
+        os.remove(fattWorker.outputFileName)
+
+        self.assertEqual(incrementalError, None, 'Incremental run should not fail')
+        self.assertEqual(incrementalOutput, runOutput, 'Outputs Should Be Equal')
+        self.assertEqual(fattWorker.getCounters()['invalidDate'], 1, 'Rejected row should be reported again')
+        self.assertEqual(fattWorker.getCounters()['invalidMode'], 1, 'Rejected row should be reported again')
+
+    # This method tests the synthetic invoice generator and the stage benchmark
+    def testBenchmark(self):
+
+        fatturazione_bench.generateInvoiceCsv('bench1.csv', 500, {'DF': 1, 'DF60': 3}, 0.1, 0.1, seed=7)
+        fatturazione_bench.generateInvoiceCsv('bench2.csv', 500, {'DF': 1, 'DF60': 3}, 0.1, 0.1, seed=7)
+
+        with open('bench1.csv', 'rb') as benchFile1:
+            with open('bench2.csv', 'rb') as benchFile2:
+                self.assertEqual(benchFile1.read(), benchFile2.read(), 'Same seed should give the same file')
+
+        report = fatturazione_bench.benchmarkStages('bench1.csv', 'conf_fatturazione.json', testLogger)
+
+        self.assertEqual(report['rows'], 500, 'Wrong number of rows')
+        self.assertEqual(sorted(report['stages']), sorted(fatturazione_bench.benchStages), 'Every stage should be timed')
+        self.assertEqual([name for name in os.listdir('.') if name.startswith('DSP_')], [], 'Output should be removed')
+
+        # the write stage takes the rows as the sort stage left them, the sort is not timed twice
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_fatturazione.json', testLogger)
+        fattWorker.openCfgFile()
+        fattWorker.outputData = [['FATT-0002', '2019-02-01', '2019-02-01'], ['FATT-0001', '2019-01-01', '2019-01-01']]
+        fattWorker.saveToFile()
+        with open(fattWorker.outputFileName) as outputFile:
+            self.assertEqual(outputFile.read().splitlines()[1:], ['FATT-0002;2019-02-01;2019-02-01',
+                             'FATT-0001;2019-01-01;2019-01-01'], 'saveToFile should not sort the rows')
+
+    # This method tests the metrics of a run, for both engines
+    def testMetrics(self):
+
+        self.writeConfig('conf_columnar.json', engine='columnar')
+
+        for configFile in ['conf_fatturazione.json', 'conf_columnar.json']:
+            fattWorker = fatturazione.Fatturazione('inputfile.csv', configFile, testLogger)
+            fattWorker.run()
+            os.remove(fattWorker.outputFileName)
+            metrics = fattWorker.getMetrics()
+
+            self.assertEqual(metrics['rowsIn'], 11, 'Wrong number of input rows')
+            self.assertEqual(metrics['rowsOut'], 11, 'Wrong number of output rows')
+            self.assertEqual(metrics['modes'], {'DF': 3, 'DFFM': 3, 'DF60': 3}, 'Wrong mode counters')
+            self.assertEqual(metrics['invalidDate'], 1, 'Wrong number of invalid dates')
+            self.assertEqual(metrics['invalidMode'], 1, 'Wrong number of invalid modes')
+            self.assertEqual(metrics['df60Fallback'], 1, 'Wrong number of DF60 fallbacks')
+            self.assertEqual(sorted(metrics['stages']), ['openCfgFile', 'openInputFile', 'parseInput', 'saveToFile',
+                             'sortOutput'], 'Every stage should be timed')
+
+        fattWorker.writeMetrics('metrics.json')
+        with open('metrics.json') as metricsFile:
+            self.assertEqual(json.load(metricsFile)['rowsIn'], 11, 'Wrong number of input rows')
+
+        fattWorker.writeMetrics('metrics.prom')
+        with open('metrics.prom') as metricsFile:
+            metricsLines = metricsFile.read().splitlines()
+        self.assertTrue('fatturazione_mode_rows{mode="DF60"} 3' in metricsLines, 'Mode counter missing')
+        self.assertTrue('fatturazione_invalid_rows{reason="date"} 1' in metricsLines, 'Invalid counter missing')
+        self.assertTrue('fatturazione_invalid_rows{reason="tenant"} 0' in metricsLines, 'Invalid counter missing')
+
+
+    # This method tests the reject report and the rejects file, rejected rows leave the DSP output
+    def testRejectsFile(self):
+
+        runError, runOutput = self.runSample('run')
+        errorLines = [line for line in runOutput.splitlines() if b'Invalid' in line]
+        validLines = [line for line in runOutput.splitlines() if b'Invalid' not in line]
+
+        self.writeConfig('conf_rejects.json', rejectsFile=True, errorSamples=1)
+        self.writeConfig('conf_rejects_columnar.json', rejectsFile=True, errorSamples=1, engine='columnar')
+
+        for methodName, configFile in [('run', 'conf_rejects.json'), ('runStream', 'conf_rejects.json'),
+                                       ('run', 'conf_rejects_columnar.json')]:
+            fattWorker = fatturazione.Fatturazione('inputfile.csv', configFile, testLogger)
+            self.assertEqual(getattr(fattWorker, methodName)(), None, 'Run should not fail')
+
+            with open(fattWorker.outputFileName, 'rb') as outputFile:
+                outputLines = outputFile.read().splitlines()
+            os.remove(fattWorker.outputFileName)
+            with open(fattWorker.rejectsFileName, 'rb') as rejectsFile:
+                rejectsLines = rejectsFile.read().splitlines()
+            os.remove(fattWorker.rejectsFileName)
+
+            self.assertEqual(outputLines, validLines, 'Output should only have the valid rows')
+            self.assertEqual(os.path.basename(fattWorker.rejectsFileName)[:4], 'REJ_', 'Wrong rejects file name')
+            self.assertEqual(rejectsLines, [b'NrFattura;DataFattura;ModalitaDiPagamento;Errore',
+                                            b'FATT-0010;2019-04-03;DF_ERROR;' + errorLines[1].split(b';')[2],
+                                            b'FATT-0011;2019-99-04;DFFM;' + errorLines[0].split(b';')[2]],
+                             'Rejects should be in input order')
+            self.assertEqual(fattWorker.rejectReport.counts, {'Invalid Date': 1, 'Invalid Mode': 1},
+                             'Wrong reject counters')
+            self.assertEqual(fattWorker.getCounters()['invalidMode'], 1, 'Wrong number of invalid modes')
+
+
+    # This method tests the resident service: CSV and JSON batches and config reload
+    def testServer(self):
+
+        runError, runOutput = self.runSample('run')
+        with open('inputfile.csv', 'rb') as inputFile:
+            inputBody = inputFile.read()
+
+        server = fatturazione_server.createServer('conf_fatturazione.json', testLogger, port=0)
+        serverThread = threading.Thread(target=server.serve_forever)
+        serverThread.start()
+        try:
+            url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+            status, responseBody = fatturazione_client.postBatch(url, inputBody)
+            self.assertEqual(status, 200, 'Batch should not fail')
+            self.assertEqual(responseBody, runOutput, 'Outputs Should Be Equal')
+
+            jsonBody = json.dumps({'rows': [
+                            {'NrFattura': 'FATT-1', 'DataFattura': '2019-04-05', 'ModalitaDiPagamento': 'DFFM'},
+                            {'NrFattura': 'FATT-2', 'DataFattura': '2019-04-03', 'ModalitaDiPagamento': 'DF'}
+            ]}).encode('utf-8')
+            status, responseBody = fatturazione_client.postBatch(url, jsonBody, jsonBatch=True)
+            self.assertEqual(status, 200, 'Batch should not fail')
+            self.assertEqual(json.loads(responseBody.decode('utf-8'))['rows'],
+                             [['FATT-2', '2019-04-03', '2019-04-03'], ['FATT-1', '2019-04-05', '2019-04-30']],
+                             'Wrong JSON output')
+
+            # the config is reloaded when the file changes
+            self.writeConfig('conf_fatturazione.json', validModes=['DF'])
+            cfgMtime = os.path.getmtime('conf_fatturazione.json') + 10
+            os.utime('conf_fatturazione.json', (cfgMtime, cfgMtime))
+
+            status, responseBody = fatturazione_client.postBatch(url, jsonBody, jsonBatch=True)
+            self.assertEqual(json.loads(responseBody.decode('utf-8'))['counters']['invalidMode'], 1,
+                             'DFFM should not be valid after the reload')
+
+            status, responseBody = fatturazione_client.postBatch(url, b'')
+            self.assertEqual(status, 400, 'Empty batch should fail')
+            self.assertEqual(server.service.stats()['requests'], 4, 'Wrong number of requests')
+        finally:
+            server.shutdown()
+            server.server_close()
+            serverThread.join()
+
+        # request workers copy the loaded config: rules and calendar are compiled once, the rows stay in the worker
+        self.writeConfig('conf_service.json', paymentRules={'DF30': {'days': 30}}, businessDays={'roll': 'following'},
+                         validModes=['DF', 'DF30'])
+        service = fatturazione_server.DspService('conf_service.json', testLogger)
+        self.assertEqual(service.reloadConfig(), None, 'Config should be loaded')
+        for callIndex in range(2):
+            worker = service.createWorker()
+            self.assertTrue(worker.businessCalendar is service.template.businessCalendar, 'Calendar should be shared')
+            self.assertTrue(worker.dueDateTable is service.template.dueDateTable, 'DSP table should be shared')
+            worker.parseLine({'NrFattura': 'FATT-1', 'DataFattura': '2019-04-05', 'ModalitaDiPagamento': 'DF30'})
+            self.assertEqual(worker.outputData, [['FATT-1', '2019-04-05', '2019-05-06']], 'Wrong rule DSP')
+        self.assertEqual(service.template.outputData, [], 'Template should not get the rows')
+        self.assertEqual(service.template.dueDateTable.stats()['misses'], 2, 'Date and DSP should be computed once')
+
+
+    # This method tests compressed inputs and outputs and the memory mapped input, the output must not change
+    def testCompressedIo(self):
+
+        runError, runOutput = self.runSample('run')
+
+        self.writeConfig('conf_mmap.json', mmapThreshold=0, ioBufferSize=16)
+        for methodName in ['run', 'runStream']:
+            mmapError, mmapOutput = self.runSample(methodName, configFile='conf_mmap.json')
+            self.assertEqual(mmapOutput, runOutput, 'Outputs Should Be Equal')
+
+        with open('inputfile.csv', 'rb') as plainFile:
+            inputContent = plainFile.read()
+        with gzip.open('inputfile.csv.gz', 'wb') as compressedFile:
+            compressedFile.write(inputContent)
+        gzError, gzOutput = self.runSample('run', 'inputfile.csv.gz')
+        self.assertEqual(gzError, None, 'Compressed input should not fail')
+        self.assertEqual(gzOutput, runOutput, 'Outputs Should Be Equal')
+
+        self.writeConfig('conf_bz2.json', mmapThreshold=0, ioBufferSize=16, outputCompression='bz2')
+        for methodName in ['run', 'runStream', 'runParallel']:
+            fattWorker = fatturazione.Fatturazione('inputfile.csv.gz', 'conf_bz2.json', testLogger)
+            if methodName == 'runParallel':
+                self.assertEqual(fattWorker.runParallel(2), None, 'Compressed run should not fail')
+            else:
+                self.assertEqual(getattr(fattWorker, methodName)(), None, 'Compressed run should not fail')
+            self.assertTrue(fattWorker.outputFileName.endswith('.csv.bz2'), 'Wrong output file name')
+            with bz2.BZ2File(fattWorker.outputFileName) as outputFile:
+                self.assertEqual(outputFile.read(), runOutput, 'Outputs Should Be Equal')
+            os.remove(fattWorker.outputFileName)
+
+
+    # This method tests the bucket ordering against the comparison sort and the output partitioned by month and week
+    def testPartitionedOutput(self):
+
+        mockOutput = [
+                        ['Mock-Fattura-1', '2019-05-06', '2019-05-31'],
+                        ['Mock-Fattura-2', '2019-4-3', '2019-4-3'],
+                        ['Mock-Fattura-3', '2019-05-06', 'Invalid Mode at ID Mock-Fattura-3: DF_ERROR'],
+                        ['Mock-Fattura-4', '2019-05-31', '2019-05-31'],
+                        ['Mock-Fattura-5', '2018-12-30', '2019-02-28'],
+                        ['Mock-Fattura-6', '2019-05-06', '2019-05-06']
+        ]
+        fattWorker = fatturazione.Fatturazione(None, None, testLogger)
+        self.assertEqual(list(fattWorker.orderByDsp(mockOutput)), sorted(mockOutput, key=lambda x: x[2]),
+                         'Bucket ordering should match the stable sort')
+        fattWorker.partitionOutput = 'month'
+        self.assertEqual([fattWorker.dspPartition(outputRow[2]) for outputRow in mockOutput],
+                         ['2019-05', '2019-04', 'errors', '2019-05', '2019-02', '2019-05'], 'Wrong partitions')
+
+        runError, runOutput = self.runSample('run')
+        runLines = runOutput.splitlines()
+
+        for partitionOutput, partitions in [('month', ['2019-01', '2019-02', '2019-03', '2019-04', '2019-06', 'errors']),
+                                            ('week', ['2019-W01', '2019-W09', '2019-W13', '2019-W14', '2019-W18',
+                                                      '2019-W23', 'errors'])]:
+            self.writeConfig('conf_partition.json', partitionOutput=partitionOutput)
+
+            for methodName in ['run', 'runStream']:
+                fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_partition.json', testLogger)
+                self.assertEqual(getattr(fattWorker, methodName)(), None, 'Partitioned run should not fail')
+
+                partitionLines = []
+                for partitionFileName in fattWorker.partitionFileNames:
+                    with open(partitionFileName, 'rb') as partitionFile:
+                        fileLines = partitionFile.read().splitlines()
+                    os.remove(partitionFileName)
+                    self.assertEqual(fileLines[0], runLines[0], 'Every partition should have the header')
+                    partitionLines.extend(fileLines[1:])
+
+                self.assertEqual(sorted(os.path.basename(fileName).split('_')[-1][:-4]
+                                        for fileName in fattWorker.partitionFileNames), partitions,
+                                 'Wrong partitions')
+                self.assertEqual(partitionLines, runLines[1:], 'Partitions should keep the DSP order')
+
+        # a DSP not written as YYYY-MM-DD sorts after the other months, its partition file is written again
+        with open('inputfile.csv') as inputFile:
+            inputContent = inputFile.read()
+        with open('inputfile_partition.csv', 'w') as inputFile:
+            inputFile.write(inputContent + '\n"FATT-0012";"2019-4-3";"DF"')
+        aprilLines = [line for line in runLines if line.split(b';')[2][:8] == b'2019-04-'] + \
+                     [b'FATT-0012;2019-4-3;2019-4-3']
+        for outputCompression, openFunc in [(None, open), ('gz', gzip.GzipFile), ('bz2', bz2.BZ2File)]:
+            self.writeConfig('conf_partition.json', partitionOutput='month', outputCompression=outputCompression)
+            fattWorker = fatturazione.Fatturazione('inputfile_partition.csv', 'conf_partition.json', testLogger)
+            self.assertEqual(fattWorker.run(), None, 'Partitioned run should not fail')
+
+            aprilFileName = [fileName for fileName in fattWorker.partitionFileNames if '_2019-04' in fileName][0]
+            partitionFile = openFunc(aprilFileName, 'rb')
+            try:
+                fileLines = partitionFile.read().splitlines()
+            finally:
+                partitionFile.close()
+            for partitionFileName in fattWorker.partitionFileNames:
+                os.remove(partitionFileName)
+            self.assertEqual(len(fattWorker.partitionFileNames), 6, 'One file per partition')
+            self.assertEqual(fileLines, runLines[:1] + aprilLines, 'Appended rows should follow the partition rows')
+
+
+    # This method tests the SQLite output: range queries and upsert of the rows of a new run
+    def testSqliteOutput(self):
+
+        self.writeConfig('conf_sqlite.json', sqliteOutput='dsp.db')
+
+        runError, runOutput = self.runSample('run', configFile='conf_sqlite.json')
+        self.assertEqual(runError, None, 'Run should not fail')
+        self.assertEqual(fatturazione_db.queryDueDates('dsp.db', '2019-04-01', '2019-04-30'), [
+                        ('FATT-0001', '2019-04-03', '2019-04-03'),
+                        ('FATT-0005', '2019-02-04', '2019-04-04'),
+                        ('FATT-0009', '2019-04-05', '2019-04-30')
+        ], 'Wrong due date range')
+
+        # a new run replaces the rows of the same invoices, error lines are not stored
+        with open('inputfile.csv') as inputFile:
+            inputContent = inputFile.read()
+        with open('inputfile.csv', 'w') as inputFile:
+            inputFile.write(inputContent.replace('"FATT-0001";"2019-04-03"', '"FATT-0001";"2019-05-03"'))
+        streamError, streamOutput = self.runSample('runStream', configFile='conf_sqlite.json')
+        self.assertEqual(streamError, None, 'Run should not fail')
+
+        self.assertEqual(fatturazione_db.queryDueDates('dsp.db', '2019-04-01', '2019-05-31'), [
+                        ('FATT-0005', '2019-02-04', '2019-04-04'),
+                        ('FATT-0009', '2019-04-05', '2019-04-30'),
+                        ('FATT-0001', '2019-05-03', '2019-05-03')
+        ], 'Rows should be replaced')
+        self.assertEqual(len(fatturazione_db.queryDueDates('dsp.db', '0000-00-00', '9999-99-99')), 9,
+                         'Wrong number of rows')
+
+        # an invoice rejected by a later run loses its previous DSP, with error lines or with a rejects file
+        inputContent = inputContent.replace('"FATT-0005";"2019-02-04";"DF60"', '"FATT-0005";"2019-02-04";"XX"')
+        with open('inputfile.csv', 'w') as inputFile:
+            inputFile.write(inputContent)
+        rejectError, rejectOutput = self.runSample('run', configFile='conf_sqlite.json')
+        self.assertEqual(rejectError, None, 'Run should not fail')
+        self.writeConfig('conf_sqlite.json', sqliteOutput='dsp.db', rejectsFile=True)
+        with open('inputfile.csv', 'w') as inputFile:
+            inputFile.write(inputContent.replace('"FATT-0009";"2019-04-05";"DFFM"', '"FATT-0009";"2019-04-05";"XX"'))
+        rejectError, rejectOutput = self.runSample('runStream', configFile='conf_sqlite.json')
+        self.assertEqual(rejectError, None, 'Run should not fail')
+
+        self.assertEqual(fatturazione_db.queryDueDates('dsp.db', '2019-04-01', '2019-04-30'), [
+                        ('FATT-0001', '2019-04-03', '2019-04-03')
+        ], 'Rejected invoices should be deleted')
+
+
+    # This method tests the parsed input cache: the second run reads the cache and gives the same output with every
+    # engine, a changed input file is parsed again and a cache over its size limit is evicted
+    def testInputCache(self):
+
+        referenceError, referenceOutput = self.runSample('run')
+
+        for engine in ['row', 'columnar', 'compact']:
+            self.writeConfig('conf_cache.json', inputCacheDir='cache', engine=engine)
+
+            fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_cache.json', testLogger)
+            fattWorker.openCfgFile()
+            fattWorker.openInputFile()
+            self.assertEqual(fattWorker.inputCacheHit, engine != 'row', 'Only the first run should parse the file')
+
+            cacheError, cacheOutput = self.runSample('run', configFile='conf_cache.json')
+            self.assertEqual(cacheError, None, 'Run should not fail')
+            self.assertEqual(cacheOutput, referenceOutput, 'Cached input should give the same output')
+        self.assertEqual(len(os.listdir('cache')), 1, 'One cache file per input file')
+
+        with open('inputfile.csv', 'a') as inputFile:
+            inputFile.write('\n"FATT-0012";"2019-04-05";"DF"')
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_cache.json', testLogger)
+        fattWorker.openCfgFile()
+        fattWorker.openInputFile()
+        self.assertEqual(fattWorker.inputCacheHit, False, 'Changed file should be parsed again')
+        self.assertEqual(fattWorker.rowCount, 12, 'New row should be read')
+
+        # a rewrite in the middle of a bigger file keeping size and mtime is caught by the content hash
+        with open('inputfile.csv', 'a') as inputFile:
+            for rowIndex in range(8000):
+                inputFile.write('\n"FATT-{:05d}";"2019-04-05";"DF"'.format(rowIndex + 100))
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_cache.json', testLogger)
+        fattWorker.openCfgFile()
+        fattWorker.openInputFile()
+        inputStat = os.stat('inputfile.csv')
+        with open('inputfile.csv') as inputFile:
+            inputContent = inputFile.read()
+        with open('inputfile.csv', 'w') as inputFile:
+            inputFile.write(inputContent.replace('"FATT-04100";"2019-04-05";"DF"', '"FATT-04100";"2019-04-05";"XX"'))
+        os.utime('inputfile.csv', (inputStat.st_atime, inputStat.st_mtime))
+        self.assertEqual(os.path.getsize('inputfile.csv'), inputStat.st_size, 'Size should not change')
+        fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_cache.json', testLogger)
+        self.assertEqual(fattWorker.run(), None, 'Run should not fail')
+        os.remove(fattWorker.outputFileName)
+        self.assertEqual(fattWorker.inputCacheHit, False, 'Rewritten file should be parsed again')
+        self.assertEqual(fattWorker.getCounters()['invalidMode'], 2, 'Rewritten row should be read')
+
+        self.writeConfig('conf_cache.json', inputCacheDir='cache', inputCacheMaxBytes=0)
+        cacheError, cacheOutput = self.runSample('run', configFile='conf_cache.json')
+        self.assertEqual(cacheError, None, 'Run should not fail')
+        self.assertEqual(os.listdir('cache'), [], 'Cache over its limit should be evicted')
+
+
+    # This method tests the in-process API: dict and tuple rows give the output of run() without any file written,
+    # rejected rows are listed apart with rejectsFile
+    def testLibraryApi(self):
+
+        referenceError, referenceOutput = self.runSample('run')
+        with open('inputfile.csv') as inputFile:
+            inputRows = [tuple(inputLine.strip().replace('"', '').split(';')) for inputLine in inputFile
+                         if inputLine.strip()]
+        fileCols = list(inputRows.pop(0))
+        dirContent = sorted(os.listdir('.'))
+
+        outputRows, apiError = fatturazione_api.computeDsp(inputRows, fileCols=fileCols)
+        self.assertEqual(apiError, None, 'Computation should not fail')
+        expectedRows = [tuple(outputLine.replace('"', '').split(';'))
+                        for outputLine in referenceOutput.decode('utf-8').splitlines()[1:]]
+        self.assertEqual(outputRows, expectedRows, 'Same output rows as run()')
+
+        dspEngine = fatturazione_api.DspEngine({'rejectsFile': True, 'sortMethod': 'comparison'})
+        dspResult = dspEngine.computeDsp(iter([dict(zip(fileCols, inputRow)) for inputRow in inputRows]),
+                                         sortOutput=True)
+        self.assertEqual(dspResult.toList(), expectedRows[:-2], 'Rejected rows should be left out')
+        self.assertEqual([rejectRow[0] for rejectRow in dspResult.getRejects()], ['FATT-0010', 'FATT-0011'],
+                         'Wrong rejected rows')
+        self.assertEqual(dspResult.getCounters()['rowsIn'], 11, 'Wrong row count')
+
+        # unsorted rows come in input order, one by one
+        dspResult = dspEngine.computeDsp(inputRows, fileCols)
+        self.assertEqual(next(iter(dspResult)), ('FATT-0001', '2019-04-03', '2019-04-03'), 'Wrong first row')
+        self.assertEqual(sorted(os.listdir('.')), dirContent, 'No file should be written')
+
+
+    # This method tests the business day adjustment: weekends, fixed and computed holidays move the DSP, the
+    # modified following roll stays in the month, and every engine gives the same output
+    def testBusinessDays(self):
+
+        businessCalendar = fatturazione.BusinessCalendar()
+        self.assertEqual(fatturazione.easterSunday(2019), fatturazione.datetime.date(2019, 4, 21), 'Wrong Easter')
+        self.assertEqual(businessCalendar.rollDate('2019-04-20'), '2019-04-23', 'Easter Monday should be skipped')
+        self.assertEqual(businessCalendar.rollDate('2019-12-25'), '2019-12-27', 'Christmas should be skipped')
+        self.assertEqual(businessCalendar.rollDate('2022-12-31'), '2023-01-02', 'Should move to the next year')
+        self.assertEqual(businessCalendar.rollDate('2019-04-03'), '2019-04-03', 'Business day should not move')
+        modifiedCalendar = fatturazione.BusinessCalendar(['08-14'], 'modifiedFollowing')
+        self.assertEqual(modifiedCalendar.rollDate('2019-08-31'), '2019-08-30', 'Should stay in the month')
+        self.assertEqual(modifiedCalendar.rollDate('2019-08-14'), '2019-08-15', 'Only the configured holidays')
+
+        referenceError, referenceOutput = self.runSample('run')
+        for roll, dueDate in [('following', '2019-04-01'), ('modifiedFollowing', '2019-03-29')]:
+            # 2019-03-31 is a sunday, the other DSPs of the sample are business days
+            expectedOutput = referenceOutput.replace(b';2019-03-31', ';{}'.format(dueDate).encode('ascii'))
+            for engine in ['row', 'columnar', 'compact']:
+                self.writeConfig('conf_business.json', businessDays={'roll': roll}, engine=engine)
+
+                runError, runOutput = self.runSample('run', configFile='conf_business.json')
+                self.assertEqual(runError, None, 'Run should not fail')
+                self.assertEqual(runOutput, expectedOutput, 'Wrong DSP with {} roll'.format(roll))
+
+        self.writeConfig('conf_business.json', businessDays={'roll': 'preceding'})
+        runError, runOutput = self.runSample('run', configFile='conf_business.json')
+        self.assertNotEqual(runError, None, 'Unknown roll should be refused')
+
+
+    # This method tests the summary file: counts per DSP, DSP week, mode and reject reason, the same for every run
+    def testSummaryFile(self):
+
+        self.writeConfig('conf_summary.json', summaryFile=True)
+
+        summaries = []
+        for methodName in ['run', 'runStream']:
+            fattWorker = fatturazione.Fatturazione('inputfile.csv', 'conf_summary.json', testLogger)
+            self.assertEqual(getattr(fattWorker, methodName)(), None, 'Run should not fail')
+            self.assertEqual(os.path.basename(fattWorker.summaryFileName),
+                             'SUM_' + os.path.basename(fattWorker.outputFileName)[len('DSP_'):-len('.csv')] + '.json',
+                             'Wrong summary file name')
+            with open(fattWorker.summaryFileName) as summaryFile:
+                summaries.append(json.load(summaryFile))
+            os.remove(fattWorker.summaryFileName)
+            os.remove(fattWorker.outputFileName)
+
+        summary = summaries[0]
+        self.assertEqual(summary['rowsIn'], 11, 'Wrong row count')
+        self.assertEqual(summary['modes'], {'DF': 3, 'DFFM': 3, 'DF60': 3}, 'Wrong mode counts')
+        self.assertEqual(summary['rejected'], {'Invalid Date': 1, 'Invalid Mode': 1}, 'Wrong reject counts')
+        self.assertEqual(sum(summary['dueDates'].values()), 9, 'Error lines should not be counted')
+        self.assertEqual(summary['dueDates']['2019-02-28'], 2, 'Wrong DSP count')
+        self.assertEqual(summary['dueWeeks'], {'2019-W01': 1, '2019-W09': 2, '2019-W13': 1, '2019-W14': 2,
+                                               '2019-W18': 1, '2019-W23': 2}, 'Wrong DSP week counts')
+        self.assertEqual(summaries[1], dict(summary, outputFile=summaries[1]['outputFile']),
+                         'Streaming run should give the same summary')
+
+        # merged batch output, the counts of both files
+        shutil.copy('inputfile.csv', 'inputfile.copy.csv')
+        fileResults, mergeFileName = fatturazione.runBatch(['inputfile.csv', 'inputfile.copy.csv'], 'conf_summary.json',
+                                                           testLogger, mergeOutput=True, mergeFileName='merged.csv')
+        self.assertEqual(mergeFileName, 'merged.csv', 'Merged output expected')
+        with open('SUM_merged.json') as summaryFile:
+            mergedSummary = json.load(summaryFile)
+        self.assertEqual(mergedSummary['rowsIn'], 22, 'Wrong row count')
+        self.assertEqual(mergedSummary['modes'], {'DF': 6, 'DFFM': 6, 'DF60': 6}, 'Wrong mode counts')
+        self.assertEqual(mergedSummary['rejected'], {'Invalid Date': 2, 'Invalid Mode': 2}, 'Wrong reject counts')
+        self.assertEqual(mergedSummary['dueDates'], dict((dueDate, dueDateCount * 2) for dueDate, dueDateCount in
+                         summary['dueDates'].items()), 'Wrong DSP counts')
+
+
+    # This method tests the multi tenant configs: rows are routed by column or id prefix to the modes and rules of
+    # their tenant, into a merged output or a file per tenant
+    def testTenants(self):
+
+        with open('inputfile_tenants.csv', 'w') as inputFile:
+            inputFile.write('"NrFattura";"DataFattura";"ModalitaDiPagamento";"Societa"\n'
+                            '"ACME-0001";"2019-04-03";"DF60";"ACME"\n'
+                            '"BETA-0002";"2019-04-03";"DF60";"BETA"\n'
+                            '"ACME-0003";"2019-01-10";"DF30";"ACME"\n'
+                            '"BETA-0004";"2019-01-10";"DF30";"BETA"\n'
+                            '"ZETA-0005";"2019-01-10";"DF";"ZETA"\n')
+        with open('conf_acme.json', 'w') as cfgFile:
+            json.dump({'validModes': ['DF', 'DF60']}, cfgFile)
+        tenantCfg = {
+            'inputCols': ['NrFattura', 'DataFattura', 'ModalitaDiPagamento', 'Societa'],
+            'tenants': {'ACME': 'conf_acme.json', 'BETA': {'paymentRules': {'DF30': {'days': 30}}}}
+        }
+        self.writeConfig('conf_tenants.json', tenantField='Societa', **tenantCfg)
+
+        runError, runOutput = self.runSample('run', 'inputfile_tenants.csv', 'conf_tenants.json')
+        self.assertEqual(runError, None, 'Run should not fail')
+        self.assertEqual(runOutput.decode('utf-8').splitlines(), [
+                        'NrFattura;DataFattura;DataScadenzaPagamento',
+                        'BETA-0004;2019-01-10;2019-02-09',
+                        'ACME-0001;2019-04-03;2019-06-03',
+                        'BETA-0002;2019-04-03;2019-06-03',
+                        'ACME-0003;2019-01-10;Invalid Mode at ID ACME-0003: DF30',
+                        'ZETA-0005;2019-01-10;Invalid Tenant at ID ZETA-0005: ZETA'
+        ], 'Rows should follow the rules of their tenant')
+
+        # same routing by id prefix, in a single streaming pass
+        self.writeConfig('conf_tenants.json', tenantIdSeparator='-', **tenantCfg)
+        streamError, streamOutput = self.runSample('runStream', 'inputfile_tenants.csv', 'conf_tenants.json')
+        self.assertEqual(streamError, None, 'Run should not fail')
+        self.assertEqual(streamOutput, runOutput, 'Id prefix routing should give the same output')
+
+        self.writeConfig('conf_tenants.json', tenantIdSeparator='-', tenantOutput='split', **tenantCfg)
+        fattWorker = fatturazione.Fatturazione('inputfile_tenants.csv', 'conf_tenants.json', testLogger)
+        self.assertEqual(fattWorker.run(), None, 'Run should not fail')
+        outputName = os.path.basename(fattWorker.outputFileName)[:-len('.csv')]
+        self.assertEqual([os.path.basename(fileName) for fileName in fattWorker.partitionFileNames],
+                         [outputName + '_ACME.csv', outputName + '_BETA.csv', outputName + '_errors.csv'],
+                         'One output file per tenant')
+        with open(fattWorker.partitionFileNames[1]) as outputFile:
+            self.assertEqual(outputFile.read().splitlines()[1:], ['BETA-0004;2019-01-10;2019-02-09',
+                             'BETA-0002;2019-04-03;2019-06-03'], 'Wrong tenant output')
+
+        # the tenant configs use the column names of the main config
+        with open('inputfile_columns.csv', 'w') as inputFile:
+            inputFile.write('"Inv";"Date";"Mode"\n'
+                            '"A-0001";"2019-04-03";"DF60"\n'
+                            '"A-0002";"2019-01-10";"DF"\n'
+                            '"B-0003";"2019-01-10";"DF"\n')
+        self.writeConfig('conf_columns.json', inputCols=['Inv', 'Date', 'Mode'], outputCols=['Inv', 'Date', 'DSP'],
+                         idField='Inv', dateField='Date', modeField='Mode', tenantIdSeparator='-',
+                         tenants={'A': {'validModes': ['DF60']}, 'B': {}})
+        columnsError, columnsOutput = self.runSample('run', 'inputfile_columns.csv', 'conf_columns.json')
+        self.assertEqual(columnsError, None, 'Run should not fail')
+        self.assertEqual(columnsOutput.decode('utf-8').splitlines(), [
+                        'Inv;Date;DSP',
+                        'B-0003;2019-01-10;2019-01-10',
+                        'A-0001;2019-04-03;2019-06-03',
+                        'A-0002;2019-01-10;Invalid Mode at ID A-0002: DF'
+        ], 'Tenant workers should read the columns of the main config')
+
+        # the API workers share the tenant DSP tables of the engine, so the second call only has hits
+        with open('conf_columns.json') as cfgFile:
+            dspEngine = fatturazione_api.DspEngine(json.load(cfgFile), testLogger)
+        tenantRows = [('A-0001', '2019-04-03', 'DF60'), ('B-0003', '2019-01-10', 'DF'), ('C-0004', '2019-01-10', 'DF')]
+        for callIndex in range(2):
+            dspResult = dspEngine.computeDsp(tenantRows)
+            self.assertEqual(len(dspResult.toList()), 3, 'Every row should be returned')
+        self.assertEqual(dspEngine.template.tenantWorkers['A'].dueDateTable.stats()['hits'], 2,
+                         'Tenant table should be kept between calls')
+        self.assertEqual(dspResult.getCounters()['invalidTenant'], 1, 'Wrong number of invalid tenants')
+
 
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -9,13 +9,25 @@
 
 import fatturazione
 import argparse
+import glob
+import os
 import sys
 import logging
 from logging import handlers
 
+# log records are written by a background thread when the queue handlers are available (python 3)
+try:
+    import queue
+    QueueHandler = handlers.QueueHandler
+except (ImportError, AttributeError):
+    QueueHandler = None
+
 sysError = 1
 fileNotSpecifiedError = 3
 
+# listener thread of the log queue, stopped at the end of main()
+logListener = None
+
 def createNewLogger():
 
     logger = logging.getLogger(__name__)
@@ -27,10 +39,41 @@ def createNewLogger():
     logHandler.setLevel(logging.INFO)
     # set logHandler's formatter
     logHandler.setFormatter(formatter)
-    logger.addHandler(logHandler)
+
+    if QueueHandler is None:
+        logger.addHandler(logHandler)
+    else:
+        # the file is written by the listener thread, logging a message only puts it in the queue
+        global logListener
+        logQueue = queue.Queue(-1)
+        logListener = handlers.QueueListener(logQueue, logHandler, respect_handler_level=True)
+        logListener.start()
+        logger.addHandler(QueueHandler(logQueue))
 
     return logger
 
+# Expands the inputfile arguments: folders give all their csv files, compressed too, glob patterns their matches
+def expandInputFiles(inputArgs):
+
+    inputFiles = []
+    for inputArg in inputArgs:
+        if os.path.isdir(inputArg):
+            matches = []
+            for pattern in ['*.csv', '*.csv.gz', '*.csv.bz2', '*.csv.xz']:
+                matches.extend(glob.glob(os.path.join(inputArg, pattern)))
+            matches.sort()
+        elif glob.has_magic(inputArg):
+            matches = sorted(glob.glob(inputArg))
+        else:
+            matches = [inputArg]
+
+        for inputFile in matches:
+            # skip our own output and rejects files and duplicates
+            if not os.path.basename(inputFile).startswith(('DSP_', 'REJ_')) and inputFile not in inputFiles:
+                inputFiles.append(inputFile)
+
+    return inputFiles
+
 # Main function - take input from sys argv (input) and pass it to fatturazione Class
 def main():
 
@@ -41,30 +84,79 @@ def main():
 
         # parse input arguments
         parser = argparse.ArgumentParser(description='Process input file and config file')
-        parser.add_argument('--inputfile', type=str, help='input file name')
+        parser.add_argument('--inputfile', type=str, nargs='+', help='input file names, glob patterns or folders')
         parser.add_argument('--conf', type=str, help='config file name')
+        parser.add_argument('--stream', action='store_true', help='process the input file row by row')
+        parser.add_argument('--workers', type=int, default=1, help='number of processes parsing the input file(s)')
+        parser.add_argument('--merge', action='store_true', help='merge all the input files into one output file')
+        parser.add_argument('--output', type=str, help='merged output file name')
+        parser.add_argument('--index', type=str, help='index file of the incremental runs of a single file')
+        parser.add_argument('--metrics', type=str, help='metrics file of a single file run, json or .prom')
 
         args = parser.parse_args()
 
+        inputFiles = expandInputFiles(args.inputfile or [])
+
+        # the index and the metrics belong to a single file run, a batch would silently skip them
+        if len(inputFiles) > 1 or args.merge:
+            for optionName in ['index', 'metrics']:
+                if getattr(args, optionName) is not None:
+                    parser.error('--{} is only supported with a single input file'.format(optionName))
+
         # check arguments
-        if args.inputfile is None or args.inputfile == '':
+        if len(inputFiles) == 0 or inputFiles == ['']:
             # file not specified
             logger.error('Parameter "inputfile" not specified, try to "python main.py -h" for help')
             # return system error, file not specified
             return sys.exit(fileNotSpecifiedError)
+        elif len(inputFiles) > 1 or args.merge:
+            logger.info('Starting Fatturazione batch with the following parameters:')
+            logger.info('Input files - {}'.format(', '.join(inputFiles)))
+            logger.info('Config file - {}'.format(args.conf))
+            fileResults, mergeFileName = fatturazione.runBatch(inputFiles, args.conf, logger, args.workers,
+                                                               args.stream, args.merge, args.output)
+
+            failedFiles = 0
+            for inputFile, outputFileName, fileError in fileResults:
+                if fileError is not None:
+                    failedFiles += 1
+                elif outputFileName is not None:
+                    logger.info('Output file name for {}: {}'.format(inputFile, outputFileName))
+            if mergeFileName is not None:
+                logger.info('Merged output file name: {}'.format(mergeFileName))
+
+            logger.info('Ending Fatturazione batch: {} files, {} with errors'.format(len(inputFiles), failedFiles))
         else:
             logger.info('Starting Fatturazione with the following parameters:')
-            logger.info('Input file - {}'.format(args.inputfile))
+            logger.info('Input file - {}'.format(inputFiles[0]))
             logger.info('Config file - {}'.format(args.conf))
             # create instance of class Fatturazione
-            fattWorker = fatturazione.Fatturazione(args.inputfile, args.conf, logger)
-            returnError = fattWorker.run()
+            fattWorker = fatturazione.Fatturazione(inputFiles[0], args.conf, logger)
+            if args.index is not None:
+                returnError = fattWorker.runIncremental(args.index)
+            elif args.workers > 1:
+                returnError = fattWorker.runParallel(args.workers)
+            elif args.stream:
+                returnError = fattWorker.runStream()
+            else:
+                returnError = fattWorker.run()
 
             # Check output error and file name
             if returnError is not None:
                 logger.error('Error while processing file: {}'.format(returnError['error']))
             else:
-                logger.info('Output file name: {}'.format(fattWorker.outputFileName))
+                if fattWorker.partitionFileNames:
+                    logger.info('Output file names: {}'.format(', '.join(fattWorker.partitionFileNames)))
+                else:
+                    logger.info('Output file name: {}'.format(fattWorker.outputFileName))
+                if fattWorker.rejectsFileName is not None:
+                    logger.info('Rejects file name: {}'.format(fattWorker.rejectsFileName))
+                if fattWorker.summaryFileName is not None:
+                    logger.info('Summary file name: {}'.format(fattWorker.summaryFileName))
+
+            if args.metrics is not None:
+                fattWorker.writeMetrics(args.metrics)
+                logger.info('Metrics file name: {}'.format(args.metrics))
 
             logger.info('Ending Fatturazione process')
 
@@ -74,6 +166,10 @@ def main():
         logger.error('Exception while running main() function: {} - line {}'.format(e, exc_tb.tb_lineno))
         # return system error
         return sys.exit(sysError)
+    finally:
+        # flush the queued log records
+        if logListener is not None:
+            logListener.stop()
 
 # Main
 if __name__ == '__main__':